@@ -0,0 +1,142 @@
+"""Peak memory and time of the contextual loss with the old per-sample distances and the batched/chunked paths.
+
+The old distances looped over the batch (a conv2d with H*W kernels per sample for the cosine
+distance, a broadcast |I - T| tensor of C*(H*W)^2 elements per sample for L1). The current path
+computes them for the whole batch with bmm/cdist, and with chunk_size set it computes the relative
+distance and the CX max over blocks of query positions (checkpointed per block under autograd).
+calculate_CX_Loss is run forward + backward on random feature maps. The equivalence of the variants
+with the per-sample one below is tested in tests/test_contextual_loss.py.
+
+Usage (the malloc threshold makes CPU peak RSS track freed tensors):
+    MALLOC_MMAP_THRESHOLD_=65536 python src/benchmarks/contextual_loss.py --size 32 32 --channels 512 --chunk_sizes 128 256
+"""
+import argparse
+import time
+
+import pyrootutils
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+import torch
+import torch.nn.functional as F
+
+from src.losses.contextual_loss import Contextual_Loss, Distance_Type
+
+
+class LoopContextual_Loss(Contextual_Loss):
+    # Distances as they were before: one sample at a time
+
+    @staticmethod
+    def _create_using_L2(I_features, T_features):
+        N, C, H, W = I_features.size()
+        Ivecs, Tvecs = I_features.view(N, C, -1), T_features.view(N, C, -1)
+        square_I, square_T = torch.sum(Ivecs * Ivecs, dim=1), torch.sum(Tvecs * Tvecs, dim=1)
+        raw_distance = []
+        for i in range(N):
+            AB = Ivecs[i].permute(1, 0) @ Tvecs[i]
+            dist = square_I[i].view(-1, 1) + square_T[i].view(1, -1) - 2 * AB
+            raw_distance.append(dist.view(1, H, W, H * W))
+        return torch.clamp(torch.cat(raw_distance, dim=0), 0.0)
+
+    @staticmethod
+    def _create_using_L1(I_features, T_features):
+        N, C, H, W = I_features.size()
+        Ivecs, Tvecs = I_features.view(N, C, -1), T_features.view(N, C, -1)
+        raw_distance = []
+        for i in range(N):
+            dist = torch.sum(torch.abs(Ivecs[i].view(C, -1, 1) - Tvecs[i].view(C, 1, -1)), dim=0)
+            raw_distance.append(dist.view(1, H, W, H * W))
+        return torch.cat(raw_distance, dim=0)
+
+    @staticmethod
+    def _create_using_dotP(I_features, T_features):
+        I_features, T_features = Contextual_Loss._centered_by_T(I_features, T_features)
+        I_features = Contextual_Loss._normalized_L2_channelwise(I_features)
+        T_features = Contextual_Loss._normalized_L2_channelwise(T_features)
+        N, C, H, W = I_features.size()
+        cosine_dist = []
+        for i in range(N):
+            T_features_i = T_features[i].view(1, 1, C, H * W).permute(3, 2, 0, 1).contiguous()
+            dist = F.conv2d(I_features[i].unsqueeze(0), T_features_i).permute(0, 2, 3, 1).contiguous()
+            cosine_dist.append(dist)
+        cosine_dist = (1 - torch.cat(cosine_dist, dim=0)) / 2
+        return cosine_dist.clamp(min=0.0)
+
+
+def make_losses(args, distance_type):
+    # feature_extractor is only stored, so no VGG is built
+    kwargs = dict(layers_weights={}, distance_type=distance_type, feature_extractor=torch.nn.Identity())
+    losses = {"per-sample": LoopContextual_Loss(**kwargs), "batched": Contextual_Loss(**kwargs)}
+    for chunk_size in args.chunk_sizes:
+        losses[f"chunk={chunk_size}"] = Contextual_Loss(chunk_size=chunk_size, **kwargs)
+    return losses
+
+
+def make_inputs(args, device):
+    generator = torch.Generator().manual_seed(0)
+    n, c, (h, w) = args.batch_size, args.channels, args.size
+    return [torch.randn(n, c, h, w, generator=generator).to(device).requires_grad_() for _ in range(2)]
+
+
+def run(loss, feats):
+    value = loss.calculate_CX_Loss(*feats)
+    value.backward()
+    return value
+
+
+def _read_status(field):
+    # Resident memory of this process in bytes, Linux only
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError(f"{field} not found in /proc/self/status")
+
+
+def measure(loss, args, device):
+    feats = make_inputs(args, device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    else:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # resets the peak resident set size (VmHWM)
+        baseline = _read_status("VmRSS")
+    start = time.perf_counter()
+    run(loss, feats)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - baseline
+    else:
+        peak = _read_status("VmHWM") - baseline
+    return peak, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, nargs=2, default=[32, 32], help="Feature map size (H W)")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=512)
+    parser.add_argument("--distances", nargs="+", default=["cosine", "l2", "l1"], choices=["cosine", "l2", "l1"])
+    parser.add_argument("--chunk_sizes", type=int, nargs="*", default=[128, 256], help="Chunked variants to add")
+    args = parser.parse_args()
+
+    distance_types = {
+        "cosine": Distance_Type.Cosine_Distance,
+        "l2": Distance_Type.L2_Distance,
+        "l1": Distance_Type.L1_Distance,
+    }
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"device: {device}, n={args.batch_size}, channels={args.channels}, size={args.size}")
+    for distance in args.distances:
+        losses = make_losses(args, distance_types[distance])
+        report = []
+        for name, loss in losses.items():
+            peak, elapsed = measure(loss, args, device)
+            report.append(f"{name}: {peak / 2**20:7.1f} MiB {elapsed * 1000:7.1f} ms")
+        print(f"{distance:6s} | " + " | ".join(report))
+
+
+if __name__ == "__main__":
+    main()
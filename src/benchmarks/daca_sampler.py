@@ -0,0 +1,143 @@
+"""Peak memory and time of DACA attention with the old and the current key/value sampling paths.
+
+The old sampler replicated the feature map k^2 times before grid_sample, sampled key and value
+separately and materialized all k^2 attention weights. The current path gathers both from the
+un-replicated maps with a stacked grid and streams the neighbourhood through an online softmax,
+chunk_size neighbours at a time (checkpointed per chunk under autograd). All variants are run
+through MultiHeadAttention (forward + backward) and checked for equal outputs and gradients.
+
+Usage (the malloc threshold makes CPU peak RSS track freed tensors):
+    MALLOC_MMAP_THRESHOLD_=65536 python src/benchmarks/daca_sampler.py --size 96 96 --p_sizes 5 13 21 28 --chunk_sizes 49 196
+"""
+import argparse
+import time
+
+import pyrootutils
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+import torch
+import torch.nn.functional as F
+
+from src.models.components.network_RbG import (
+    MultiHeadAttention,
+    deformation_grid,
+    softmax_attention,
+)
+
+
+def replicated_sampler(feat, grid, p_size):
+    # Sampler as it was before: feat is expanded to (n*k^2, c, h, w) first
+    n, c, h, w = feat.size()
+    feat = feat.view(n, 1, c, h, w).expand(-1, p_size**2, -1, -1, -1).reshape(-1, c, h, w)
+    return F.grid_sample(feat, grid, mode="bilinear", padding_mode="zeros", align_corners=True).view(
+        n, p_size**2, c, h, w
+    )
+
+
+class ReplicatedMultiHeadAttention(MultiHeadAttention):
+    def forward(self, query, key, value, deform_field, sampling_grid=None, need_weights=False):
+        d_k, d_v, n_head = self.d_k, self.d_v, self.num_head
+        query, key, value = self.w_q(query), self.w_k(key), self.w_v(value)
+        n, c, h, w = query.shape
+
+        sampling_grid = deformation_grid(deform_field, self.p_size)
+        sample_key = replicated_sampler(key, sampling_grid, self.p_size)
+        sample_value = replicated_sampler(value, sampling_grid, self.p_size)
+
+        query = query.view(n, 1, n_head, d_k, h, w)
+        key = sample_key.view(n, self.p_size**2, n_head, d_k, h, w)
+        value = sample_value.view(n, self.p_size**2, n_head, d_v, h, w)
+        query, attn = softmax_attention(query, key, value)
+        return self.fc(query.reshape(n, -1, h, w).float()), attn
+
+
+def make_inputs(args, device):
+    generator = torch.Generator().manual_seed(0)
+    n, c, (h, w) = args.batch_size, args.feat_dim, args.size
+    feats = [torch.randn(n, c, h, w, generator=generator).to(device).requires_grad_() for _ in range(3)]
+    deform_field = (torch.randn(n, 2, h, w, generator=generator) * 2).to(device)
+    return feats, deform_field
+
+
+def make_modules(args, p_size, device):
+    replicated = ReplicatedMultiHeadAttention(args.feat_dim, args.num_head, p_size=p_size).to(device)
+    modules = {"replicated": replicated}
+    for chunk_size in [None] + args.chunk_sizes:
+        module = MultiHeadAttention(args.feat_dim, args.num_head, p_size=p_size, chunk_size=chunk_size).to(device)
+        module.load_state_dict(replicated.state_dict())
+        modules[f"chunk={chunk_size or p_size**2}"] = module
+    return modules
+
+
+def run(module, feats, deform_field):
+    output, _ = module(*feats, deform_field)
+    output.square().mean().backward()
+    return output
+
+
+def _read_status(field):
+    # Resident memory of this process in bytes, Linux only
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError(f"{field} not found in /proc/self/status")
+
+
+def measure(module, args, device):
+    feats, deform_field = make_inputs(args, device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    else:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # resets the peak resident set size (VmHWM)
+        baseline = _read_status("VmRSS")
+    start = time.perf_counter()
+    run(module, feats, deform_field)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - baseline
+    else:
+        peak = _read_status("VmHWM") - baseline
+    return peak, time.perf_counter() - start
+
+
+def check_equivalence(modules, args, device):
+    results = []
+    for module in modules.values():
+        module.zero_grad()
+        feats, deform_field = make_inputs(args, device)
+        output = run(module, feats, deform_field)
+        results.append([output] + [feat.grad for feat in feats] + [p.grad for p in module.parameters()])
+    for result in results[1:]:
+        for reference, candidate in zip(results[0], result):
+            torch.testing.assert_close(candidate, reference, rtol=1e-4, atol=1e-5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, nargs=2, default=[96, 96])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--feat_dim", type=int, default=14)
+    parser.add_argument("--num_head", type=int, default=2)
+    parser.add_argument("--p_sizes", type=int, nargs="+", default=[5, 13, 21, 28])
+    parser.add_argument("--chunk_sizes", type=int, nargs="*", default=[49, 196], help="Chunked variants to add")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"device: {device}, n={args.batch_size}, feat_dim={args.feat_dim}, size={args.size}")
+    for p_size in args.p_sizes:
+        modules = make_modules(args, p_size, device)
+        check_equivalence(modules, args, device)
+        report = []
+        for name, module in modules.items():
+            peak, elapsed = measure(module, args, device)
+            report.append(f"{name}: {peak / 2**20:7.1f} MiB {elapsed * 1000:7.1f} ms")
+        print(f"p_size={p_size:3d} | " + " | ".join(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Random slice reads per second for the [H, W, D] and the slice-major [D, H, W] H5 layouts.
+
+Usage:
+    python src/benchmarks/h5_layout.py --file data/SynthRAD_MR_CT_Pelvis/train/demo.h5 --compression lzf
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import pyrootutils
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+import numpy as np
+import torch
+
+from src.data.components.h5_layout import convert_to_slice_major
+from src.data.components.transforms import dataset_SynthRAD
+
+
+def measure(dataset, n_reads, seed=0):
+    order = np.random.RandomState(seed).randint(0, len(dataset), size=n_reads)
+    start = time.perf_counter()
+    for idx in order:
+        dataset[idx]
+    return n_reads / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--file", required=True, help="H5 file in the original [H, W, D] layout")
+    parser.add_argument("--dst", default=None, help="Where to write the converted file (default: temp dir)")
+    parser.add_argument("--group_1", default="MR")
+    parser.add_argument("--group_2", default="CT")
+    parser.add_argument("--compression", default="lzf", choices=["none", "lzf", "gzip", "blosc"])
+    parser.add_argument("--n_reads", type=int, default=500)
+    args = parser.parse_args()
+
+    dst = args.dst or os.path.join(tempfile.mkdtemp(), "slice_major.h5")
+    convert_to_slice_major(args.file, dst, groups=[args.group_1, args.group_2], compression=args.compression)
+
+    datasets = {}
+    for name, path in (("HWD", args.file), ("DHW", dst)):
+        datasets[name] = dataset_SynthRAD(path, args.group_1, args.group_2, persistent_handles=True)
+
+    # Same slices must come back from both layouts
+    for idx in np.linspace(0, len(datasets["HWD"]) - 1, 5).astype(int):
+        for a, b in zip(datasets["HWD"][idx], datasets["DHW"][idx]):
+            assert torch.equal(a, b), f"Layouts disagree at slice {idx}"
+
+    for name, dataset in datasets.items():
+        size_mb = os.path.getsize(dataset.data_dir) / 2**20
+        print(f"{name}: {measure(dataset, args.n_reads):.1f} slices/sec ({size_mb:.1f} MB)")
+        dataset.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Dataloader throughput of dataset_SynthRAD with and without persistent H5 handles.
+
+Usage:
+    python src/benchmarks/h5_loader.py --file data/SynthRAD_MR_CT_Pelvis/train/demo.h5 --num_workers 6
+"""
+import argparse
+import time
+
+import pyrootutils
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from torch.utils.data import DataLoader
+
+from src.data.components.transforms import dataset_SynthRAD, h5_worker_init_fn
+
+
+def measure(dataset, batch_size, num_workers, epochs, max_batches):
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        shuffle=True,
+        worker_init_fn=h5_worker_init_fn,
+        persistent_workers=dataset.persistent_handles and num_workers > 0,
+    )
+    n_slices = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch_idx, batch in enumerate(loader):
+            n_slices += batch[0].shape[0]
+            if max_batches and batch_idx + 1 >= max_batches:
+                break
+    elapsed = time.perf_counter() - start
+    dataset.close()
+    return n_slices / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--file", required=True, help="H5 file with [H, W, D] patient datasets")
+    parser.add_argument("--group_1", default="MR")
+    parser.add_argument("--group_2", default="CT")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, default=6)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--max_batches", type=int, default=0, help="Batches per epoch (0: full epoch)")
+    parser.add_argument("--crop_size", type=int, nargs=2, default=[96, 96])
+    args = parser.parse_args()
+
+    for persistent_handles in (False, True):
+        dataset = dataset_SynthRAD(
+            args.file,
+            data_group_1=args.group_1,
+            data_group_2=args.group_2,
+            crop_size=args.crop_size,
+            persistent_handles=persistent_handles,
+        )
+        throughput = measure(dataset, args.batch_size, args.num_workers, args.epochs, args.max_batches)
+        print(f"persistent_handles={persistent_handles}: {throughput:.1f} slices/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Time of GradientCorrelationMetric and SharpnessMetric with the old OpenCV loops and the current batched tensor ports.
+
+The old update() copied every image to the CPU and ran cv2.Canny/Sobel/Laplacian on it one at a
+time. The current one runs the ported operators on the whole batch on the input's device. Canny
+edges are checked to be identical to cv2.Canny, and both metrics are checked against their
+OpenCV values, on smoothed random uint8 images (plus a constant image, which GC skips).
+
+Usage:
+    python src/benchmarks/image_metrics.py --size 384 320 --batch_size 16
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+import pyrootutils
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+import torch
+import torch.nn.functional as F
+
+from src.metrics.gradient_correlation import GradientCorrelationMetric, canny
+from src.metrics.sharpness import SharpnessMetric
+
+
+def loop_correlations(imgs1, imgs2):
+    # GradientCorrelationMetric.update as it was before
+    correlations = []
+    for img1, img2 in zip(imgs1, imgs2):
+        img1, img2 = img1.cpu().numpy().squeeze(), img2.cpu().numpy().squeeze()
+        edges1, edges2 = cv2.Canny(img1, 170, 190), cv2.Canny(img2, 30, 50)
+        grad_x1, grad_y1 = cv2.Sobel(edges1, cv2.CV_64F, 1, 0, ksize=3), cv2.Sobel(edges1, cv2.CV_64F, 0, 1, ksize=3)
+        grad_x2, grad_y2 = cv2.Sobel(edges2, cv2.CV_64F, 1, 0, ksize=3), cv2.Sobel(edges2, cv2.CV_64F, 0, 1, ksize=3)
+        magnitude1, magnitude2 = np.sqrt(grad_x1**2 + grad_y1**2), np.sqrt(grad_x2**2 + grad_y2**2)
+        if np.std(magnitude1) == 0 or np.std(magnitude2) == 0:
+            continue
+        correlations.append(np.corrcoef(magnitude1.flatten(), magnitude2.flatten())[0, 1])
+    return torch.tensor(correlations)
+
+
+def loop_scores(imgs):
+    # SharpnessMetric.update as it was before
+    imgs = imgs.squeeze(1)
+    return torch.tensor([np.var(cv2.Laplacian(img.cpu().numpy().astype(np.float32), cv2.CV_32F)) for img in imgs])
+
+
+def make_inputs(args, device):
+    generator = torch.Generator().manual_seed(0)
+    n, (h, w) = args.batch_size, args.size
+    imgs = F.avg_pool2d(torch.rand(2 * n, 1, h, w, generator=generator), 5, stride=1, padding=2)
+    low, high = imgs.amin(dim=(2, 3), keepdim=True), imgs.amax(dim=(2, 3), keepdim=True)
+    imgs = ((imgs - low) / (high - low) * 255).to(torch.uint8)
+    imgs[-1] = 128  # constant image
+    return imgs[:n].to(device), imgs[n:].to(device)
+
+
+def check_equivalence(imgs1, imgs2):
+    for imgs in (imgs1, imgs2):
+        for low, high in ((170, 190), (30, 50)):
+            reference = np.stack([cv2.Canny(img[0].cpu().numpy(), low, high) for img in imgs])
+            assert np.array_equal(canny(imgs, low, high).to(torch.uint8).cpu().numpy()[:, 0], reference)
+
+    gc = GradientCorrelationMetric().to(imgs1.device)
+    gc.update(imgs1, imgs2)
+    torch.testing.assert_close(gc.correlations.cpu(), loop_correlations(imgs1, imgs2).to(gc.correlations.dtype))
+
+    sharpness = SharpnessMetric().to(imgs2.device)
+    sharpness.update(imgs2)
+    torch.testing.assert_close(sharpness.scores.cpu(), loop_scores(imgs2), rtol=1e-5, atol=1e-4)
+
+
+def measure(fn, args, device):
+    fn()  # warm-up
+    elapsed = []
+    for _ in range(args.repeat):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed.append(time.perf_counter() - start)
+    return float(np.median(elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, nargs=2, default=[384, 320])
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    imgs1, imgs2 = make_inputs(args, device)
+    check_equivalence(imgs1, imgs2)
+
+    gc, sharpness = GradientCorrelationMetric().to(device), SharpnessMetric().to(device)
+    timings = {
+        "gc opencv": measure(lambda: loop_correlations(imgs1, imgs2), args, device),
+        "gc tensor": measure(lambda: gc.update(imgs1, imgs2), args, device),
+        "sharpness opencv": measure(lambda: loop_scores(imgs2), args, device),
+        "sharpness tensor": measure(lambda: sharpness.update(imgs2), args, device),
+    }
+    print(f"device: {device}, n={args.batch_size}, size={args.size}")
+    print(" | ".join(f"{name}: {elapsed * 1000:7.1f} ms" for name, elapsed in timings.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Time of MINDLoss with the old per-shift loop and the current grouped-convolution descriptor.
+
+The old mind() called Dp once per shift (4 for the variance, one per neighbour), each with its own
+torch.roll, Gaussian kernel build and conv2d, and grew the descriptor with torch.cat. The current
+one filters all shifted differences with one grouped conv2d of the cached kernel and describes
+pred and gt in one batched call. Both are timed forward + backward; their equivalence is tested in
+tests/test_mind_loss.py, which uses the loop implementation below as the reference.
+
+Usage:
+    python src/benchmarks/mind_loss.py --sizes 96 96 384 320 --batch_size 4
+"""
+import argparse
+import time
+
+import numpy as np
+import pyrootutils
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from src.losses.mind_loss import MINDLoss, get_gausian_filter
+
+
+def loop_Dp(image, sigma, patch_size, xshift, yshift):
+    # Dp as it was before: one roll, kernel build and conv2d per shift
+    shift_image = torch.roll(image, shifts=(xshift, yshift), dims=(-1, -2))
+    gaussian_filter = get_gausian_filter(sigma, patch_size).view(1, 1, patch_size, patch_size).to(image.device)
+    return F.conv2d((image - shift_image) ** 2, gaussian_filter, padding=patch_size // 2)
+
+
+def loop_mind(image, sigma=2.0, eps=1e-5, neigh_size=9, patch_size=7):
+    reduce_size = (patch_size + neigh_size - 2) // 2
+    Vimg = (
+        loop_Dp(image, sigma, patch_size, -1, 0)
+        + loop_Dp(image, sigma, patch_size, 1, 0)
+        + loop_Dp(image, sigma, patch_size, 0, -1)
+        + loop_Dp(image, sigma, patch_size, 0, 1)
+    )
+    Vimg = Vimg / 4 + eps * torch.ones_like(Vimg)
+
+    shift_vec = np.arange(-neigh_size // 2, neigh_size - neigh_size // 2)
+    output = None
+    for xshift in shift_vec:
+        for yshift in shift_vec:
+            if (xshift, yshift) == (0, 0):
+                continue
+            MIND_tmp = torch.exp(-loop_Dp(image, sigma, patch_size, xshift, yshift) / Vimg)
+            tmp = MIND_tmp[..., reduce_size:-reduce_size, reduce_size:-reduce_size, None]
+            output = tmp if output is None else torch.cat((output, tmp), -1)
+    return torch.divide(output, torch.max(output, dim=-1, keepdim=True)[0])
+
+
+class LoopMINDLoss(nn.Module):
+    def forward(self, pred, gt):
+        return F.l1_loss(loop_mind(pred), loop_mind(gt))
+
+
+def make_inputs(args, size, device):
+    generator = torch.Generator().manual_seed(0)
+    pred = torch.rand(args.batch_size, 1, *size, generator=generator).to(device).requires_grad_()
+    gt = torch.rand(args.batch_size, 1, *size, generator=generator).to(device)
+    return pred, gt
+
+
+def run(loss, pred, gt):
+    value = loss(pred, gt)
+    value.backward()
+    return value
+
+
+def measure(loss, args, size, device):
+    pred, gt = make_inputs(args, size, device)
+    run(loss, pred, gt)  # warm-up
+    elapsed = []
+    for _ in range(args.repeat):
+        pred.grad = None
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        run(loss, pred, gt)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed.append(time.perf_counter() - start)
+    return float(np.median(elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[96, 96, 384, 320], help="Image sizes as H W pairs")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    sizes = list(zip(args.sizes[0::2], args.sizes[1::2]))
+    losses = {"loop": LoopMINDLoss().to(device), "grouped": MINDLoss().to(device)}
+    print(f"device: {device}, n={args.batch_size}")
+    for size in sizes:
+        times = {name: measure(loss, args, size, device) for name, loss in losses.items()}
+        report = " | ".join(f"{name}: {elapsed * 1000:8.1f} ms" for name, elapsed in times.items())
+        print(f"size={size[0]}x{size[1]} | {report} | speedup {times['loop'] / times['grouped']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Speed and deviation of the block-wise StyleConv modulation (block_modulation) in PAdaIN synthesis.
+
+Runs the network with the per-pixel gamma/beta path and with block_modulation, with noise injection
+disabled so outputs are comparable. Reports time per forward and the deviation between both; their
+equivalence is tested in tests/test_padain_block_modulation.py.
+
+Usage:
+    python src/benchmarks/padain_block_modulation.py --ckpt pretrained/MR-CT/stage1_synthesis/PAdaIN_synthesis.ckpt \
+        --size 384 320
+"""
+import argparse
+import time
+
+import pyrootutils
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+import torch
+
+from src.models.components.network_PAdaIN_synthesis import PAdaINSynthesisModule, StyleConv
+
+
+def set_block_modulation(net, block_modulation):
+    for module in net.modules():
+        if isinstance(module, StyleConv):
+            module.block_modulation = block_modulation
+            module.randomize_noise = False
+
+
+def timed_forward(net, x, ref, repeats, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = net(x, ref)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ckpt", default=None, help="PAdaIN synthesis checkpoint (random weights if omitted)")
+    parser.add_argument("--feat_ch", type=int, default=256)
+    parser.add_argument("--size", type=int, nargs=2, default=[384, 320])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    net = PAdaINSynthesisModule(input_nc=1, feat_ch=args.feat_ch, output_nc=1, demodulate=True)
+    if args.ckpt is not None:
+        state_dict = torch.load(args.ckpt, map_location="cpu")["state_dict"]
+        net.load_state_dict({k.replace("netG_A.", ""): v for k, v in state_dict.items()}, strict=False)
+    net = net.to(device).eval()
+
+    generator = torch.Generator().manual_seed(0)
+    x = (torch.rand(args.batch_size, 1, *args.size, generator=generator) * 2 - 1).to(device)
+    ref = (torch.rand(args.batch_size, 1, *args.size, generator=generator) * 2 - 1).to(device)
+
+    with torch.no_grad():
+        set_block_modulation(net, False)
+        net(x, ref)  # warm-up
+        exact, exact_time = timed_forward(net, x, ref, args.repeats, device)
+        print(f"device: {device}, size={args.size}, per pixel: {exact_time * 1000:.1f} ms/forward")
+
+        set_block_modulation(net, True)
+        net(x, ref)  # warm-up
+        out, elapsed = timed_forward(net, x, ref, args.repeats, device)
+        diff = (out - exact).abs()
+        print(
+            f"block_modulation: {elapsed * 1000:8.1f} ms/forward (x{exact_time / elapsed:.1f}) "
+            f"| max abs diff {diff.max().item():.2e} | mean abs diff {diff.mean().item():.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
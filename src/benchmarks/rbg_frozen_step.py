@@ -0,0 +1,117 @@
+"""Training-step time of RbG_framework with frozen submodules vs. reloading their state_dict every step.
+
+The "reload" mode reproduces the previous behaviour (load_state_dict of deep-copied synthesis and
+registration weights on every forward). Random-weight checkpoints are written when no paths are given.
+
+Usage:
+    python src/benchmarks/rbg_frozen_step.py --synth_type padain_synthesis --size 96 96 --batch_size 4
+"""
+import argparse
+import copy
+import os
+import tempfile
+import time
+
+import pyrootutils
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+import torch
+
+from src.models.components.network_RbG import RbG_framework
+
+
+def make_checkpoints(synth_type, regist_size, tmp_dir):
+    from src.models.components.network_voxelmorph_original import VxmDense
+
+    regist_net = VxmDense(
+        inshape=regist_size,
+        nb_unet_features=[[16, 32, 32, 32], [32, 32, 32, 32, 32, 16, 16]],
+        nb_unet_levels=None,
+        unet_feat_mult=1,
+        nb_unet_conv_per_level=1,
+        int_steps=7,
+        int_downsize=2,
+        bidir=False,
+        use_probs=False,
+        src_feats=1,
+        trg_feats=1,
+        unet_half_res=False,
+    )
+    regist_path = os.path.join(tmp_dir, "regist.ckpt")
+    torch.save({"state_dict": {f"netR_A.{k}": v for k, v in regist_net.state_dict().items()}}, regist_path)
+
+    if synth_type == "munit":
+        from src.models.components.network_adainGen import AdaINGen
+
+        synth_net = AdaINGen(input_nc=1, output_nc=1, ngf=64)
+        state_dict = {f"netG_A.{k}": v for k, v in synth_net.state_dict().items()}
+        state_dict.update({f"netG_B.{k}": v for k, v in synth_net.state_dict().items()})
+    else:
+        from src.models.components.network_PAdaIN_synthesis import PAdaINSynthesisModule
+
+        synth_net = PAdaINSynthesisModule(input_nc=1, feat_ch=256, output_nc=1, demodulate=True)
+        state_dict = {f"netG_A.{k}": v for k, v in synth_net.state_dict().items()}
+    synth_path = os.path.join(tmp_dir, "synth.ckpt")
+    torch.save({"state_dict": state_dict}, synth_path)
+    return regist_path, synth_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--synth_type", default="padain_synthesis", choices=["padain_synthesis", "munit"])
+    parser.add_argument("--regist_path", default=None)
+    parser.add_argument("--synth_path", default=None)
+    parser.add_argument("--size", type=int, nargs=2, default=[96, 96])
+    parser.add_argument("--regist_size", type=int, nargs=2, default=None, help="Defaults to --size")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--p_size", type=int, default=28)
+    parser.add_argument("--steps", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    regist_size = args.regist_size or args.size
+    regist_path, synth_path = args.regist_path, args.synth_path
+    if regist_path is None or synth_path is None:
+        regist_path, synth_path = make_checkpoints(args.synth_type, regist_size, tempfile.mkdtemp())
+
+    net = RbG_framework(
+        in_ch=1, ref_ch=1, out_ch=1, feat_dim=14, num_head=2, mlp_ratio=2, p_size=args.p_size,
+        main_train=True, synth_train=False, synth_type=args.synth_type, synth_path=synth_path, synth_feat=64,
+        regist_train=False, regist_type="voxelmorph_original", regist_path=regist_path, regist_size=regist_size,
+    ).to(device)
+    net.train()
+    frozen = {name: copy.deepcopy(getattr(net, name).state_dict()) for name in net.frozen_modules}
+    optimizer = torch.optim.Adam(net.parameters(), lr=2e-4)
+
+    x = torch.rand(args.batch_size, 1, *args.size, device=device) * 2 - 1
+    y = torch.rand(args.batch_size, 1, *args.size, device=device) * 2 - 1
+
+    def step(reload):
+        if reload:
+            for name, state_dict in frozen.items():
+                getattr(net, name).load_state_dict(state_dict)
+        optimizer.zero_grad()
+        net(x, y).abs().mean().backward()
+        optimizer.step()
+
+    for reload in (True, False):
+        step(reload)  # warm-up
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            step(reload)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / args.steps
+        print(f"{'reload state_dict' if reload else 'frozen submodules'}: {elapsed * 1000:.1f} ms/step")
+
+    for name, state_dict in frozen.items():
+        current = getattr(net, name).state_dict()
+        assert all(torch.equal(current[k], v) for k, v in state_dict.items()), f"{name} weights changed"
+    print("Frozen weights unchanged:", ", ".join(frozen))
+
+
+if __name__ == "__main__":
+    main()
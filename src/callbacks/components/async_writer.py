@@ -0,0 +1,61 @@
+import gzip
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+
+
+def save_nifti(image: nib.Nifti1Image, path: str, compress_level: int = 1):
+    """Saves a Nifti1Image; `.nii.gz` paths are gzip-compressed with the given level (0-9)."""
+    if not path.endswith(".gz"):
+        nib.save(image, path)
+        return
+    with gzip.open(path, "wb", compresslevel=compress_level) as f:
+        f.write(image.to_bytes())
+
+
+class AsyncWriter:
+    """Runs file writing jobs on background threads, off the test loop.
+
+    gzip (zlib) and PIL encoding release the GIL, so threads overlap compression with the next
+    test batches. At most max_pending jobs are queued or running: submit() blocks beyond that,
+    which bounds the memory held by finished-but-unwritten volumes. flush() waits for every job
+    and re-raises the first error. With num_workers=0 jobs run synchronously in submit().
+
+    Args:
+        num_workers: Writer threads, or 0 to write synchronously.
+        max_pending: Maximum number of submitted jobs not yet written.
+    """
+
+    def __init__(self, num_workers: int = 2, max_pending: int = 4):
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(num_workers, thread_name_prefix="image_writer") if num_workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        if self.executor is None:
+            fn(*args, **kwargs)
+            return
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+        self.futures.append(future)
+
+    def flush(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
@@ -6,6 +6,9 @@ import torch
 from typing import Any, List, Optional
 from lightning.pytorch import Callback
 from src import utils
+from src.utils import split_sample_index
+from src.callbacks.components.async_writer import AsyncWriter, save_nifti
+from src.data.components.h5_layout import is_slice_major
 import numpy as np
 import nibabel as nib
 import h5py
@@ -17,6 +20,20 @@ from PIL import Image
 log = utils.get_pylogger(__name__)
 
 
+def step_images(pl_module, outputs, batch):
+    # validation_step/test_step of the base modules return {"images": <model_step outputs>};
+    # the network is only run again for modules that return nothing
+    if isinstance(outputs, dict) and "images" in outputs:
+        return outputs["images"]
+    batch, _ = split_sample_index(batch)
+    if len(batch[0].size()) == 5:  # 3D Image
+        return pl_module.model_step(batch, is_3d=True)
+    # Sliding-window inference (data.tiled_inference) for modules that support it, plain model_step otherwise
+    if hasattr(pl_module, "inference_step"):
+        return pl_module.inference_step(batch)
+    return pl_module.model_step(batch)
+
+
 class ImageLoggingCallback(Callback):
     def __init__(
         self,
@@ -25,7 +42,6 @@ class ImageLoggingCallback(Callback):
         center_crop: int = 256,
         every_epoch=5,
         log_test: bool = False,
-        use_split_inference: bool = False,
     ):
         """_summary_
 
@@ -40,8 +56,6 @@ class ImageLoggingCallback(Callback):
         self.every_epoch = every_epoch
         self.log_test = log_test  # log images on the testing stage as well
         self.center_crop = center_crop  # center crop the images to this size
-        self.use_split_inference = use_split_inference
-        # print("use_split_inference: ", use_split_inference)
 
     def saving_to_grid(self, res):
         # def gray2rgb(tensor):
@@ -128,43 +142,15 @@ class ImageLoggingCallback(Callback):
             
             if len(batch[0].size()) == 5: # 3D Image
                 d_index = 30 
-                evaluation_img, moving_img, fixed_img, warped_img = pl_module.model_step(batch, is_3d=True)
+                evaluation_img, moving_img, fixed_img, warped_img = step_images(pl_module, outputs, batch)
                 evaluation_img = evaluation_img[:, :, :, :, d_index].squeeze(-1)
                 moving_img = moving_img[:, :, :, :, d_index].squeeze(-1)
                 fixed_img = fixed_img[:, :, :, :, d_index].squeeze(-1)
                 warped_img = warped_img[:, :, :, :, d_index].squeeze(-1)
                 self.saving_to_grid([evaluation_img, moving_img, fixed_img, warped_img])
             elif len(batch[0].size()) == 4:
-                if self.use_split_inference:
-                    half_size = batch[0].shape[2] // 2
-                    first_half = [x[:, :, :half_size, :] for x in batch]
-                    second_half = [x[:, :, half_size:, :] for x in batch]
-
-                    res_first_half = pl_module.model_step(first_half)
-                    res_second_half = pl_module.model_step(second_half)
-
-                    if len(res_first_half) == 6 and len(res_second_half) == 6:
-                        a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                        b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                        a2 = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                        b2 = torch.cat([res_first_half[3], res_second_half[3]], dim=2)
-                        preds_a = torch.cat([res_first_half[4], res_second_half[4]], dim=2)
-                        preds_b = torch.cat([res_first_half[5], res_second_half[5]], dim=2)
-                        self.saving_to_grid([a, b, a2, b2, preds_a, preds_b])
-                    elif len(res_first_half) == 4 and len(res_second_half) == 4:
-                        a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                        b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                        preds_a = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                        preds_b = torch.cat([res_first_half[3], res_second_half[3]], dim=2)
-                        self.saving_to_grid([a, b, preds_a, preds_b])
-                    elif len(res_first_half) == 3 and len(res_second_half) == 3:
-                        a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                        b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                        preds_b = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                        self.saving_to_grid([a, b, preds_b])
-                else:
-                    res = pl_module.model_step(batch)
-                    self.saving_to_grid(res)
+                res = step_images(pl_module, outputs, batch)
+                self.saving_to_grid(res)
             
 
     def on_validation_epoch_end(self, trainer, pl_module) -> None:
@@ -199,45 +185,15 @@ class ImageLoggingCallback(Callback):
             
             if len(batch[0].size()) == 5: # 3D Image
                 d_index = 30 
-                evaluation_img, moving_img, fixed_img, warped_img = pl_module.model_step(batch, is_3d=True)
+                evaluation_img, moving_img, fixed_img, warped_img = step_images(pl_module, outputs, batch)
                 evaluation_img = evaluation_img[:, :, :, :, d_index].squeeze(-1)
                 moving_img = moving_img[:, :, :, :, d_index].squeeze(-1)
                 fixed_img = fixed_img[:, :, :, :, d_index].squeeze(-1)
                 warped_img = warped_img[:, :, :, :, d_index].squeeze(-1)
                 self.saving_to_grid([evaluation_img, moving_img, fixed_img, warped_img])
             elif len(batch[0].size()) == 4:
-                if self.use_split_inference:
-                    half_size = batch[0].shape[2] // 2
-                    first_half = [x[:, :, :half_size, :] for x in batch]
-                    second_half = [x[:, :, half_size:, :] for x in batch]
-
-                    res_first_half = pl_module.model_step(first_half)
-                    res_second_half = pl_module.model_step(second_half)
-
-                    if len(res_first_half) == 6 and len(res_second_half) == 6:
-                        a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                        b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                        a2 = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                        b2 = torch.cat([res_first_half[3], res_second_half[3]], dim=2)
-                        preds_a = torch.cat([res_first_half[4], res_second_half[4]], dim=2)
-                        preds_b = torch.cat([res_first_half[5], res_second_half[5]], dim=2)
-                        self.saving_to_grid([a, b, a2, b2, preds_a, preds_b])
-                    elif len(res_first_half) == 4 and len(res_second_half) == 4:
-                        a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                        b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                        preds_a = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                        preds_b = torch.cat([res_first_half[3], res_second_half[3]], dim=2)
-                        self.saving_to_grid([a, b, preds_a, preds_b])
-                    elif len(res_first_half) == 3 and len(res_second_half) == 3:
-                        a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                        b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                        preds_b = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                        self.saving_to_grid([a, b, preds_b])
-                    else:
-                        res = None
-                else:
-                    res = pl_module.model_step(batch)
-                    self.saving_to_grid(res)
+                res = step_images(pl_module, outputs, batch)
+                self.saving_to_grid(res)
 
     def on_test_end(self, trainer, pl_module):
         log.info(f"Saving test img_grid shape: <{len(self.img_grid)}>")
@@ -258,23 +214,37 @@ class ImageSavingCallback(Callback):
                  center_crop: int = 256, 
                  subject_number_length: int = 3, 
                  test_file: str = None,
-                 use_split_inference: bool = False,
                  flag_normalize: bool = True,
                  data_dir: str = None,
                  data_type:str = None,
+                 num_writers: int = 2,
+                 max_pending: int = 4,
+                 compress_level: int = 1,
                  ):
         """_summary_
         Image saving callback : Save images in nii format for each subject
 
+        Slices are copied into a preallocated volume per subject; finished volumes are converted,
+        compressed and written by a background AsyncWriter, flushed at the end of testing.
+
+        Args:
+            num_writers (int): Writer threads, 0 writes synchronously in on_test_batch_end.
+            max_pending (int): Subjects (nifti) or slices (photo) that may wait for the writer.
+            compress_level (int): gzip level (0-9) of the .nii.gz files.
         """
         super().__init__()
         self.center_crop = center_crop  # center crop the images to this size
         self.subject_number_length = subject_number_length
         self.test_file = test_file
-        self.use_split_inference = use_split_inference
         self.flag_normalize = flag_normalize
         self.data_dir = data_dir
         self.data_type = data_type
+        self.num_writers = num_writers
+        self.max_pending = max_pending
+        self.compress_level = compress_level
+        self.writer = None
+        self.volumes = {}
+        self.filled = {}
         # print("test_file: ", test_file)
         # print("flag_normalize: ", self.flag_normalize)
 
@@ -358,24 +328,24 @@ class ImageSavingCallback(Callback):
         return a, b, a2, b2, preds_a, preds_b
 
     @staticmethod
-    def save_nii(a_nii, b_nii, c_nii, d_nii, subject_number, folder_path):
-        nib.save(a_nii, os.path.join(folder_path, f"a_{subject_number}.nii.gz"))
-        nib.save(b_nii, os.path.join(folder_path, f"b_{subject_number}.nii.gz"))
-        nib.save(c_nii, os.path.join(folder_path, f"preds_a_{subject_number}.nii.gz"))
+    def save_nii(a_nii, b_nii, c_nii, d_nii, subject_number, folder_path, compress_level=1):
+        save_nifti(a_nii, os.path.join(folder_path, f"a_{subject_number}.nii.gz"), compress_level)
+        save_nifti(b_nii, os.path.join(folder_path, f"b_{subject_number}.nii.gz"), compress_level)
+        save_nifti(c_nii, os.path.join(folder_path, f"preds_a_{subject_number}.nii.gz"), compress_level)
         if d_nii is not None:
-            nib.save(
-                d_nii, os.path.join(folder_path, f"preds_b_{subject_number}.nii.gz")
+            save_nifti(
+                d_nii, os.path.join(folder_path, f"preds_b_{subject_number}.nii.gz"), compress_level
             )
         return
     
     @staticmethod
-    def save_nii_registration(a_nii, b_nii, c_nii, d_nii, subject_number, folder_path):
-        nib.save(a_nii, os.path.join(folder_path, f"evaluation_img_{subject_number}.nii.gz"))
-        nib.save(b_nii, os.path.join(folder_path, f"moving_img_{subject_number}.nii.gz"))
-        nib.save(c_nii, os.path.join(folder_path, f"fixed_img_{subject_number}.nii.gz"))
+    def save_nii_registration(a_nii, b_nii, c_nii, d_nii, subject_number, folder_path, compress_level=1):
+        save_nifti(a_nii, os.path.join(folder_path, f"evaluation_img_{subject_number}.nii.gz"), compress_level)
+        save_nifti(b_nii, os.path.join(folder_path, f"moving_img_{subject_number}.nii.gz"), compress_level)
+        save_nifti(c_nii, os.path.join(folder_path, f"fixed_img_{subject_number}.nii.gz"), compress_level)
         if d_nii is not None:
-            nib.save(
-                d_nii, os.path.join(folder_path, f"warped_img_{subject_number}.nii.gz")
+            save_nifti(
+                d_nii, os.path.join(folder_path, f"warped_img_{subject_number}.nii.gz"), compress_level
             )
         return
 
@@ -396,91 +366,95 @@ class ImageSavingCallback(Callback):
         preds_b_tif.save(os.path.join(folder_path, f"{subject_number}_preds_b.tif"))
         return
     
-    def saving_to_nii(self, a, b, preds_a, preds_b=None):
+    def saving_to_nii(self, a, b, preds_a, preds_b=None, indices=()):
+        """Copies a batch of slices (2D) or volumes (3D) into the subject buffers.
+
+        indices are the dataset indices of the batch elements (see batch_indices), so samples may
+        arrive in any order and with any batch size.
+        """
         if preds_a is None:
             preds_a = torch.zeros_like(a)
         if preds_b is None:
             preds_b = torch.zeros_like(b)
-            
-        a, b, preds_a, preds_b, _, _= self.change_torch_numpy(a, b, preds_a, preds_b)
-        if a.ndim == 2: # 2D image
-            self.img_a.append(a)
-            self.img_b.append(b)
-            self.img_preds_a.append(preds_a)
-            if preds_b is not None:
-                self.img_preds_b.append(preds_b)
-
-            if len(self.img_a) == self.subject_slice_num[0]:
-                a_nii = np.stack(self.img_a, -1)
-                b_nii = np.stack(self.img_b, -1)
-                preds_a_nii = np.stack(self.img_preds_a, -1)
-                if preds_b is not None:
-                    preds_b_nii = np.stack(self.img_preds_b, -1)
-                else:
-                    preds_b_nii = a_nii * 0  # Placeholder if preds_b is None
-
-                # convert numpy to nii
-                a_nii, b_nii, preds_a_nii, preds_b_nii = self.change_numpy_nii(
-                    a_nii, b_nii, preds_a_nii, preds_b_nii, flag_normalize=self.flag_normalize
-                )
-                # save nii image to (.nii) file
-                self.save_nii(
-                    a_nii,
-                    b_nii,
-                    preds_a_nii,
-                    preds_b_nii if preds_b is not None else None,
-                    subject_number=self.dataset_list[0],
+
+        # [N, H, W] (2D) or [N, H, W, D] (3D) per stream
+        streams = [x.detach()[:, 0].cpu().numpy() for x in (a, b, preds_a, preds_b)]
+        if streams[0].ndim == 3: # 2D image
+            for j in range(streams[0].shape[0]):
+                subject_idx, slice_idx = self.slice_location(indices[j])
+                if subject_idx not in self.volumes:
+                    # [4, H, W, D] buffer of a, b, preds_a, preds_b, handed over to the writer once complete
+                    self.volumes[subject_idx] = np.empty(
+                        (4,) + streams[0].shape[1:] + (self.subject_slice_num[subject_idx],), dtype=streams[0].dtype
+                    )
+                    self.filled[subject_idx] = 0
+                for volume, stream in zip(self.volumes[subject_idx], streams):
+                    volume[..., slice_idx] = stream[j]
+                self.filled[subject_idx] += 1
+
+                if self.filled[subject_idx] == self.subject_slice_num[subject_idx]:
+                    self.writer.submit(
+                        self.write_nii,
+                        self.volumes.pop(subject_idx),
+                        subject_number=self.dataset_list[subject_idx],
+                        folder_path=self.save_folder_name,
+                        flag_normalize=self.flag_normalize,
+                        compress_level=self.compress_level,
+                    )
+                    del self.filled[subject_idx]
+
+        elif streams[0].ndim == 4: # 3D image
+            for j in range(streams[0].shape[0]):
+                self.writer.submit(
+                    self.write_nii,
+                    np.stack([stream[j] for stream in streams]),
+                    subject_number=self.dataset_list[indices[j]],
                     folder_path=self.save_folder_name,
+                    flag_normalize=self.flag_normalize,
+                    compress_level=self.compress_level,
+                    registration=True,
                 )
 
-                # empty list
-                self.img_a = []
-                self.img_b = []
-                self.img_preds_a = []
-                if preds_b is not None:
-                    self.img_preds_b = []
-                self.dataset_list.pop(0)
-                self.subject_slice_num.pop(0)
-
-            if self.subject_number > self.subject_number_length:
-                log.info(f"Saving test images up to {self.subject_number_length}")
-                return
-            
-        elif a.ndim == 3: # 3D image
-            a_nii, b_nii, preds_a_nii, preds_b_nii = self.change_numpy_nii(
-                a, b, preds_a, preds_b if preds_b is not None else None,
-                flag_normalize=self.flag_normalize
-            )
-            
-            # save nii image to (.nii) file
-            self.save_nii_registration(
-                a_nii,
-                b_nii,
-                preds_a_nii,
-                preds_b_nii if preds_b is not None else None,
-                subject_number=self.dataset_list[0],
-                folder_path=self.save_folder_name,
-            )
-            self.dataset_list.pop(0)
+    def slice_location(self, index):
+        """Maps a test dataset index to (subject index, slice index)."""
+        subject_idx = int(np.searchsorted(self.subject_offsets, index, side="right")) - 1
+        return subject_idx, index - int(self.subject_offsets[subject_idx])
+
+    @classmethod
+    def write_nii(cls, volume, subject_number, folder_path, flag_normalize=True, compress_level=1, registration=False):
+        # runs on the writer threads: conversion and gzip compression of one [4, H, W, D] subject
+        a_nii, b_nii, preds_a_nii, preds_b_nii = cls.change_numpy_nii(*volume, flag_normalize=flag_normalize)
+        save_fn = cls.save_nii_registration if registration else cls.save_nii
+        # save nii image to (.nii) file
+        save_fn(
+            a_nii,
+            b_nii,
+            preds_a_nii,
+            preds_b_nii,
+            subject_number=subject_number,
+            folder_path=folder_path,
+            compress_level=compress_level,
+        )
+
+    @classmethod
+    def write_tif(cls, a, b, a2, b2, preds_a, preds_b, subject_number, folder_path):
+        a, b, a2, b2, preds_a, preds_b = cls.change_numpy_tif(a, b, a2, b2, preds_a, preds_b)
+        cls.save_tif(a, b, a2, b2, preds_a, preds_b, subject_number=subject_number, folder_path=folder_path)
 
-    def saving_to_tif(self, a, b, a2, b2, preds_a, preds_b=None):
+    def saving_to_tif(self, a, b, a2, b2, preds_a, preds_b=None, indices=()):
         if preds_a is None:
             preds_a = torch.zeros_like(a)
         if preds_b is None:
             preds_b = torch.zeros_like(b)
-            
-        a, b, a2, b2, preds_a, preds_b = self.change_torch_numpy(a, b, a2, b2, preds_a, preds_b)
-        a, b, a2, b2, preds_a, preds_b = self.change_numpy_tif(a, b, a2, b2, preds_a, preds_b)
-        self.save_tif(
-            a,
-            b,
-            a2,
-            b2,
-            preds_a,
-            preds_b if preds_b is not None else None,
-            subject_number=self.dataset_list.pop(0),  # Use the dataset name for saving
-            folder_path=self.save_folder_name,
-        )
+
+        streams = [x.detach()[:, 0].cpu().numpy() for x in (a, b, a2, b2, preds_a, preds_b)]
+        for j in range(streams[0].shape[0]):
+            self.writer.submit(
+                self.write_tif,
+                *[stream[j] for stream in streams],
+                subject_number=self.dataset_list[indices[j]],  # Use the dataset name for saving
+                folder_path=self.save_folder_name,
+            )
         
     def on_test_start(self, trainer, pl_module):
         # make save folder
@@ -492,10 +466,11 @@ class ImageSavingCallback(Callback):
 
         self.save_folder_name = folder_name
 
-        self.img_a = []
-        self.img_b = []
-        self.img_preds_a = []
-        self.img_preds_b = []
+        self.writer = AsyncWriter(num_workers=self.num_writers, max_pending=self.max_pending)
+        # subject index -> [4, H, W, D] buffer / number of slices written; only subjects in flight hold a buffer
+        self.volumes = {}
+        self.filled = {}
+        self.num_seen = 0
         self.i = 0
         self.subject_slice_num = []
         self.subject_number = 1
@@ -508,9 +483,12 @@ class ImageSavingCallback(Callback):
                 self.dataset_list = [
                     key for key in first_group.keys()
                 ]  
+                slice_axis = 0 if is_slice_major(file) else 2
                 self.subject_slice_num = [
-                    first_group[key].shape[2] for key in self.dataset_list
+                    first_group[key].shape[slice_axis] for key in self.dataset_list
                 ]
+                # dataset index of the first slice of each subject
+                self.subject_offsets = np.concatenate(([0], np.cumsum(self.subject_slice_num)[:-1]))
 
         elif self.data_type == 'photo':
             with h5py.File(data_path, "r") as file:
@@ -519,72 +497,58 @@ class ImageSavingCallback(Callback):
                     key for key in first_group.keys()
                 ]
 
-    def on_test_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
-        if self.use_split_inference:
-            half_size = batch[0].shape[2] // 2
-            first_half = [x[:, :, :half_size, :] for x in batch]
-            second_half = [x[:, :, half_size:, :] for x in batch]
-
-            res_first_half = pl_module.model_step(first_half)
-            res_second_half = pl_module.model_step(second_half)
-
-            if len(res_first_half) == 6 and len(res_second_half) == 6:
-                a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                a2 = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                b2 = torch.cat([res_first_half[3], res_second_half[3]], dim=2)
-                preds_a = torch.cat([res_first_half[4], res_second_half[4]], dim=2)
-                preds_b = torch.cat([res_first_half[5], res_second_half[5]], dim=2)
-                if self.data_type == 'nifti':
-                    self.saving_to_nii(a, b, a2, b2, preds_a, preds_b)
-                elif self.data_type == 'photo':
-                    self.saving_to_tif(a, b, a2, b2, preds_a, preds_b)
-            elif len(res_first_half) == 4 and len(res_second_half) == 4:
-                a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                preds_a = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                preds_b = torch.cat([res_first_half[3], res_second_half[3]], dim=2)
-                if self.data_type == 'nifti':
-                    self.saving_to_nii(a, b, preds_a, preds_b)
-                elif self.data_type == 'photo':
-                    self.saving_to_tif(a, b, preds_a, preds_b)
-            elif len(res_first_half) == 3 and len(res_second_half) == 3:
-                a = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-                b = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-                preds_b = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-                if self.data_type == 'nifti':
-                    self.saving_to_nii(a, b, preds_b)
-                elif self.data_type == 'photo':
-                    self.saving_to_tif(a, b, preds_b)
+    def batch_indices(self, batch):
+        """Dataset indices of the batch samples.
+
+        Taken from the batch when the dataset appends them (dataset_SynthRAD(return_index=True)), which
+        holds for any sampler. Otherwise the samples are assumed to arrive in dataset order, as with the
+        default sequential test loader on a single device.
+        """
+        _, indices = split_sample_index(batch)
+        if indices is not None:
+            indices = indices.tolist()
         else:
-            if len(batch[0].size()) == 5:
-                res = pl_module.model_step(batch, is_3d=True)
-            elif len(batch[0].size()) == 4:
-                res = pl_module.model_step(batch)
+            indices = list(range(self.num_seen, self.num_seen + batch[0].shape[0]))
+        self.num_seen += len(indices)
+        return indices
+
+    def on_test_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        res = step_images(pl_module, outputs, batch)
+        indices = self.batch_indices(batch)
+
+        if len(res) == 6:
+            a, b, a2, b2, preds_a, preds_b = res
+            if self.data_type == 'nifti':
+                self.saving_to_nii(a, b, a2, b2, preds_a, preds_b, indices=indices)
+            elif self.data_type == 'photo':
+                self.saving_to_tif(a, b, a2, b2, preds_a, preds_b, indices=indices)
             
-            if len(res) == 6:
-                a, b, a2, b2, preds_a, preds_b = res
-                if self.data_type == 'nifti':
-                    self.saving_to_nii(a, b, a2, b2, preds_a, preds_b)
-                elif self.data_type == 'photo':
-                    self.saving_to_tif(a, b, a2, b2, preds_a, preds_b)
-                
-            if len(res) == 4:
-                a, b, preds_a, preds_b = res
-                if self.data_type == 'nifti':
-                    self.saving_to_nii(a, b, preds_a, preds_b)
-                elif self.data_type == 'photo':
-                    self.saving_to_tif(a, b, preds_a, preds_b)
-
-            elif len(res) == 3:
-                a, b, preds_b = res
-                if self.data_type == 'nifti':
-                    self.saving_to_nii(a, b, preds_b)
-                elif self.data_type == 'photo':
-                    self.saving_to_tif(a, b, preds_b)
-
-            else:
-                log.error(f"Unexpected res length: {len(res)}. This case has not been implemented.")
-                raise NotImplementedError("This function has not been implemented yet.")
-            return
-        
\ No newline at end of file
+        if len(res) == 4:
+            a, b, preds_a, preds_b = res
+            if self.data_type == 'nifti':
+                self.saving_to_nii(a, b, preds_a, preds_b, indices=indices)
+            elif self.data_type == 'photo':
+                self.saving_to_tif(a, b, preds_a, preds_b, indices=indices)
+
+        elif len(res) == 3:
+            a, b, preds_b = res
+            if self.data_type == 'nifti':
+                self.saving_to_nii(a, b, preds_b, indices=indices)
+            elif self.data_type == 'photo':
+                self.saving_to_tif(a, b, preds_b, indices=indices)
+
+        else:
+            log.error(f"Unexpected res length: {len(res)}. This case has not been implemented.")
+            raise NotImplementedError("This function has not been implemented yet.")
+        return
+        
+    def on_test_end(self, trainer, pl_module):
+        # wait for the background writer (re-raises write errors)
+        if self.volumes:
+            log.warning(f"Incomplete subjects not saved: {[self.dataset_list[i] for i in self.volumes]}")
+        self.volumes = {}
+        self.filled = {}
+        if self.writer is not None:
+            log.info(f"Flushing test images to {self.save_folder_name}")
+            self.writer.close()
+            self.writer = None
@@ -8,10 +8,18 @@ import numpy as np
 from lightning import LightningDataModule
 from torch.utils.data import ConcatDataset, DataLoader, Dataset, random_split
 
+from src import utils
+from src.data.components.batch_transforms import BatchAugmentation
+from src.data.components.samplers import PatientSliceBatchSampler
+from src.data.components.slice_cache import build_slice_cache, dequantize, is_cache_valid
 from src.data.components.transforms import (
-    dataset_SynthRAD
+    dataset_SynthRAD,
+    h5_worker_init_fn,
 )
 
+log = utils.get_pylogger(__name__)
+
+
 class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
 
     def __init__(
@@ -24,7 +32,6 @@ class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
         batch_size: int,
         num_workers: int,
         pin_memory: bool,
-        use_split_inference: bool,
         train_file: str = "",
         val_file: str = "",
         test_file: str = "",
@@ -33,6 +40,14 @@ class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
         rot_prob: float = 0.0,  # augmentation for training (rot90)
         padding_size: Optional[Tuple[int, int]] = None,
         crop_size: Optional[Tuple[int, int]] = None,
+        persistent_handles: bool = False,  # Keep one H5 handle open per worker instead of reopening per slice
+        slice_cache_dir: Optional[str] = None,  # Build/use an int16 memmap slice cache per split in this directory
+        slice_run_length: Optional[int] = None,  # Training batches draw runs of this many contiguous slices per patient
+        augment_on_device: bool = False,  # Run training pad/flip/rot90/crop on whole batches after device transfer
+        use_stage1_cache: bool = False,  # Training batches also return precomputed (synth_img, deform_field)
+        stage1_synth_group: str = "stage1_synth",
+        stage1_deform_group: str = "stage1_deform",
+        test_batch_size: int = 1,  # Slices per test batch (ImageSavingCallback assembles volumes by slice index)
         **kwargs: Any
     ):
         super().__init__()
@@ -49,7 +64,6 @@ class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.pin_memory = pin_memory
-        self.use_split_inference = use_split_inference
         self.train_file = train_file
         self.val_file = val_file
         self.test_file = test_file
@@ -58,15 +72,50 @@ class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
         self.rot_prob = rot_prob
         self.padding_size = padding_size
         self.crop_size = crop_size
+        self.persistent_handles = persistent_handles
+        self.slice_cache_dir = slice_cache_dir
+        self.slice_run_length = slice_run_length
+        self.augment_on_device = augment_on_device
+        self.use_stage1_cache = use_stage1_cache
+        self.stage1_groups = (stage1_synth_group, stage1_deform_group) if use_stage1_cache else None
+        self.test_batch_size = test_batch_size
+        self.batch_augmentation = BatchAugmentation(
+            flip_prob=flip_prob,
+            rot_prob=rot_prob,
+            padding_size=padding_size,
+            crop_size=crop_size,
+        ) if augment_on_device else None
 
         self.data_train: Optional[Dataset] = None
         self.data_val: Optional[Dataset] = None
         self.data_test: Optional[Dataset] = None
 
+    def _split_files(self):
+        return {
+            'train': os.path.join(self.data_dir, 'train', self.train_file),
+            'val': os.path.join(self.data_dir, 'val', self.val_file),
+            'test': os.path.join(self.data_dir, 'test', self.test_file),
+        }
+
+    def _cache_dir(self, split):
+        return os.path.join(self.slice_cache_dir, split) if self.slice_cache_dir else None
+
+    def prepare_data(self):
+        """Builds the memmap slice caches (once, on rank 0) when `slice_cache_dir` is set."""
+        if not self.slice_cache_dir:
+            return
+        groups = [group for group in (self.data_group_1, self.data_group_2, self.data_group_3) if group]
+        for split, h5_path in self._split_files().items():
+            cache_dir = self._cache_dir(split)
+            if not is_cache_valid(h5_path, cache_dir, groups):
+                log.info(f"Building slice cache for {h5_path} in {cache_dir}")
+                build_slice_cache(h5_path, cache_dir, groups)
+
     def setup(self, stage: Optional[str] = None):
-        self.train_dir = os.path.join(self.data_dir, 'train', self.train_file)
-        self.val_dir = os.path.join(self.data_dir, 'val', self.val_file)
-        self.test_dir = os.path.join(self.data_dir, 'test', self.test_file)
+        split_files = self._split_files()
+        self.train_dir = split_files['train']
+        self.val_dir = split_files['val']
+        self.test_dir = split_files['test']
 
         self.data_train = dataset_SynthRAD(
             self.train_dir,
@@ -79,6 +128,10 @@ class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
             rot_prob=self.rot_prob,
             crop_size=self.crop_size,
             reverse=self.reverse,
+            persistent_handles=self.persistent_handles,
+            slice_cache_dir=self._cache_dir('train'),
+            augment_on_device=self.augment_on_device,
+            stage1_groups=self.stage1_groups,
         )  # Use flip and crop augmentation for training data
         self.data_val = dataset_SynthRAD(
             self.val_dir,
@@ -91,6 +144,8 @@ class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
             # rot_prob=0.0,
             # crop_size=self.crop_size,
             reverse=self.reverse,
+            persistent_handles=self.persistent_handles,
+            slice_cache_dir=self._cache_dir('val'),
         )
         self.data_test = dataset_SynthRAD(
             self.test_dir,
@@ -103,15 +158,42 @@ class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
             # rot_prob=0.0,
             # crop_size=self.crop_size,
             reverse=self.reverse,
-        )
+            persistent_handles=self.persistent_handles,
+            slice_cache_dir=self._cache_dir('test'),
+            return_index=True,
+        )  # Samples end with their dataset index: ImageSavingCallback places slices by it, test_step drops it
+
+    def _persistent_workers(self):
+        # Workers (and the handles they hold) survive across epochs, so each file is opened once per run
+        return self.persistent_handles and self.num_workers > 0
 
     def train_dataloader(self):
+        if self.slice_run_length and not self.is_3d:
+            batch_sampler = PatientSliceBatchSampler(
+                self.data_train.cumulative_slice_counts,
+                batch_size=self.batch_size,
+                run_length=self.slice_run_length,
+                shuffle=True,
+                # DDP: each rank keeps its share of the batches (needs trainer.use_distributed_sampler=False)
+                num_replicas=self.trainer.world_size if self.trainer is not None else 1,
+                rank=self.trainer.global_rank if self.trainer is not None else 0,
+            )
+            return DataLoader(
+                dataset=self.data_train,
+                batch_sampler=batch_sampler,
+                num_workers=self.num_workers,
+                pin_memory=self.pin_memory,
+                worker_init_fn=h5_worker_init_fn,
+                persistent_workers=self._persistent_workers(),
+            )
         return DataLoader(
             dataset=self.data_train,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
             shuffle=True,
+            worker_init_fn=h5_worker_init_fn,
+            persistent_workers=self._persistent_workers(),
         )
 
     def val_dataloader(self):
@@ -121,20 +203,34 @@ class SynthRAD_MR_CT_Pelvis_DataModule(LightningDataModule):
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
             shuffle=False,
+            worker_init_fn=h5_worker_init_fn,
+            persistent_workers=self._persistent_workers(),
         )
 
     def test_dataloader(self):
         return DataLoader(
             dataset=self.data_test,
-            batch_size=1,
+            batch_size=self.test_batch_size,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
             shuffle=False,
+            worker_init_fn=h5_worker_init_fn,
+            persistent_workers=self._persistent_workers(),
         )
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Slice-cache batches arrive as int16 in every stage and are dequantized here, after the transfer
+        batch = [dequantize(x) if torch.is_tensor(x) and x.dtype == torch.int16 else x for x in batch]
+        # Training augmentation on the device; val/test batches are left untouched as in the CPU pipeline
+        if self.batch_augmentation is not None and self.trainer is not None and self.trainer.training:
+            batch = list(self.batch_augmentation(batch))
+        return batch
+
     def teardown(self, stage: Optional[str] = None):
         """Clean up after fit or test."""
-        pass
+        for dataset in (self.data_train, self.data_val, self.data_test):
+            if dataset is not None:
+                dataset.close()
 
     def state_dict(self):
         """Extra things to save to checkpoint."""
@@ -0,0 +1,112 @@
+from typing import Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as nnF
+
+
+class BatchAugmentation:
+    """Pad / flip / rot90 / crop applied to whole batches on the device after transfer.
+
+    Counterpart of the per-sample CPU pipeline in dataset_SynthRAD (padding_height_width,
+    RandFlipd, RandRotate90d, random_crop_height_width / even_crop_height_width). Random
+    parameters are drawn per sample and applied identically to every image of the sample
+    (A, B and optionally C). Works on [B, C, H, W] and [B, C, H, W, D] tensors (H, W are augmented).
+
+    Args:
+        flip_prob (float): Probability of flipping both spatial axes (as RandFlipd(spatial_axis=[0, 1])).
+        rot_prob (float): Probability of a rot90 by k in {1, 2, 3} (as RandRotate90d). For non-square
+            images only k = 2 keeps the batch shape, so k is restricted to 2 there.
+        padding_size (tuple, optional): Pad height, width up to this size with `pad_value`.
+        crop_size (tuple, optional): Random crop size. If None, center-crop to a multiple of 16.
+        pad_value (float): Background value used for padding.
+    """
+
+    def __init__(
+        self,
+        flip_prob: float = 0.0,
+        rot_prob: float = 0.0,
+        padding_size: Optional[Tuple[int, int]] = None,
+        crop_size: Optional[Tuple[int, int]] = None,
+        pad_value: float = -1,
+    ):
+        self.flip_prob = flip_prob
+        self.rot_prob = rot_prob
+        self.padding_size = padding_size
+        if isinstance(crop_size, int):
+            crop_size = (crop_size, crop_size)
+        self.crop_size = crop_size
+        self.pad_value = pad_value
+
+    def __call__(self, images: Sequence[torch.Tensor]):
+        is_3d = images[0].dim() == 5
+        channels = [image.shape[1] for image in images]
+        x = torch.cat(images, dim=1)
+        if is_3d:
+            b, c, h, w, d = x.shape
+            x = x.permute(0, 1, 4, 2, 3).reshape(b, c * d, h, w)
+
+        x = self._pad(x)
+        x = self._flip(x)
+        x = self._rot90(x)
+        x = self._random_crop(x) if self.crop_size else self._even_crop(x)
+
+        if is_3d:
+            x = x.reshape(b, c, d, x.shape[-2], x.shape[-1]).permute(0, 1, 3, 4, 2)
+        return tuple(x.split(channels, dim=1))
+
+    def _pad(self, x):
+        if not self.padding_size:
+            return x
+        h, w = x.shape[-2:]
+        pad_top = (self.padding_size[0] - h + 1) // 2 if h < self.padding_size[0] else 0
+        pad_bottom = (self.padding_size[0] - h) // 2 if h < self.padding_size[0] else 0
+        pad_left = (self.padding_size[1] - w + 1) // 2 if w < self.padding_size[1] else 0
+        pad_right = (self.padding_size[1] - w) // 2 if w < self.padding_size[1] else 0
+        if pad_top == 0 and pad_left == 0:
+            return x
+        return nnF.pad(x, (pad_left, pad_right, pad_top, pad_bottom), value=self.pad_value)
+
+    def _flip(self, x):
+        if self.flip_prob <= 0:
+            return x
+        mask = torch.rand(x.shape[0], device=x.device) < self.flip_prob
+        return torch.where(mask[:, None, None, None], x.flip(-2, -1), x)
+
+    def _rot90(self, x):
+        if self.rot_prob <= 0:
+            return x
+        n = x.shape[0]
+        apply = torch.rand(n, device=x.device) < self.rot_prob
+        if x.shape[-2] == x.shape[-1]:
+            ks = torch.randint(1, 4, (n,), device=x.device)
+        else:
+            ks = torch.full((n,), 2, device=x.device)
+        ks = torch.where(apply, ks, torch.zeros_like(ks))
+        out = x.clone()
+        for k in (1, 2, 3):
+            idx = (ks == k).nonzero(as_tuple=True)[0]
+            if idx.numel() > 0:
+                out[idx] = torch.rot90(x[idx], k, dims=(-2, -1))
+        return out
+
+    def _random_crop(self, x):
+        n, _, h, w = x.shape
+        crop_h, crop_w = self.crop_size
+        if h <= crop_h and w <= crop_w:
+            return x
+        crop_h, crop_w = min(crop_h, h), min(crop_w, w)
+        top = torch.randint(0, h - crop_h + 1, (n,), device=x.device)
+        left = torch.randint(0, w - crop_w + 1, (n,), device=x.device)
+        rows = top[:, None] + torch.arange(crop_h, device=x.device)
+        cols = left[:, None] + torch.arange(crop_w, device=x.device)
+        batch_idx = torch.arange(n, device=x.device)[:, None, None]
+        # Advanced indexing moves the indexed dims first: [n, crop_h, crop_w, c]
+        return x.permute(0, 2, 3, 1)[batch_idx, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2).contiguous()
+
+    def _even_crop(self, x, multiple=(16, 16)):
+        h, w = x.shape[-2:]
+        new_h = (h // multiple[0]) * multiple[0]
+        new_w = (w // multiple[1]) * multiple[1]
+        top = (h - new_h) // 2
+        left = (w - new_w) // 2
+        return x[..., top : top + new_h, left : left + new_w]
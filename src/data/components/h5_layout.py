@@ -0,0 +1,85 @@
+"""Slice-major ([D, H, W]) layout for the SynthRAD H5 files.
+
+The original files store every patient as an [H, W, D] dataset, so reading one axial slice
+(`[..., slice_idx]`) strides over the whole volume. The converted file stores [D, H, W] with
+one-slice chunks, so a slice is a single contiguous (optionally compressed) chunk read.
+dataset_SynthRAD detects the converted layout from the `layout` file attribute.
+
+Usage:
+    python src/data/components/h5_layout.py --src train/demo.h5 --dst train/demo_dhw.h5 --compression lzf
+"""
+import argparse
+
+import h5py
+import numpy as np
+
+LAYOUT_ATTR = "layout"
+SLICE_MAJOR = "DHW"
+VOLUME_MAJOR = "HWD"
+
+
+def is_slice_major(file):
+    """Returns True if an open H5 file was written by convert_to_slice_major."""
+    layout = file.attrs.get(LAYOUT_ATTR, VOLUME_MAJOR)
+    if isinstance(layout, bytes):
+        layout = layout.decode()
+    return layout == SLICE_MAJOR
+
+
+def _compression_kwargs(compression, compression_level=None):
+    if compression in (None, "none"):
+        return {}
+    if compression == "lzf":
+        return {"compression": "lzf"}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 4 if compression_level is None else compression_level}
+    if compression == "blosc":
+        try:
+            import hdf5plugin
+        except ImportError as e:
+            raise ImportError("blosc compression requires hdf5plugin (pip install hdf5plugin)") from e
+        clevel = 5 if compression_level is None else compression_level
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=clevel, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError(f"Unknown compression '{compression}'. Choose from none, lzf, gzip, blosc")
+
+
+def convert_to_slice_major(src_path, dst_path, groups=None, compression="lzf", compression_level=None):
+    """Rewrites every [H, W, D] patient dataset of `groups` into [D, H, W] with one-slice chunks.
+
+    Args:
+        src_path (str): H5 file in the original [H, W, D] layout.
+        dst_path (str): Output H5 file.
+        groups (list, optional): Groups to convert (e.g. ["MR", "CT", "syn_CT"]). Defaults to all groups.
+        compression (str): none, lzf, gzip or blosc (blosc needs hdf5plugin).
+        compression_level (int, optional): Level for gzip/blosc.
+    """
+    kwargs = _compression_kwargs(compression, compression_level)
+    with h5py.File(src_path, "r") as src, h5py.File(dst_path, "w") as dst:
+        if is_slice_major(src):
+            raise ValueError(f"{src_path} is already in the slice-major layout")
+        groups = list(src.keys()) if groups is None else groups
+        for group in groups:
+            dst_group = dst.create_group(group)
+            for key, dataset in src[group].items():
+                if dataset.ndim != 3:
+                    raise ValueError(f"Expected [H, W, D] dataset, got {dataset.shape} for {group}/{key}")
+                h, w, d = dataset.shape
+                volume = np.ascontiguousarray(np.transpose(dataset[...], (2, 0, 1)))
+                dst_group.create_dataset(key, data=volume, chunks=(1, h, w), **kwargs)
+                for name, value in dataset.attrs.items():
+                    dst_group[key].attrs[name] = value
+        for name, value in src.attrs.items():
+            dst.attrs[name] = value
+        dst.attrs[LAYOUT_ATTR] = SLICE_MAJOR
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a SynthRAD H5 file to the slice-major layout")
+    parser.add_argument("--src", required=True, help="H5 file in [H, W, D] layout")
+    parser.add_argument("--dst", required=True, help="Output H5 file in [D, H, W] layout")
+    parser.add_argument("--groups", nargs="+", default=None, help="Groups to convert (default: all)")
+    parser.add_argument("--compression", default="lzf", choices=["none", "lzf", "gzip", "blosc"])
+    parser.add_argument("--compression_level", type=int, default=None)
+    args = parser.parse_args()
+
+    convert_to_slice_major(args.src, args.dst, args.groups, args.compression, args.compression_level)
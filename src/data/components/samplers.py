@@ -0,0 +1,106 @@
+from typing import Iterator, List, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class PatientSliceBatchSampler(Sampler):
+    """Yields batches made of contiguous slice runs of the same patient.
+
+    Every patient's slices are split into runs of `run_length` consecutive slices, and the runs
+    (not the slices) are shuffled each epoch. A batch therefore touches only a few patients, which
+    dataset_SynthRAD.__getitems__ reads with one H5 call per patient and group. Every slice is still
+    visited exactly once per epoch.
+
+    With num_replicas > 1 (DDP), every rank draws the same batch order and keeps every
+    num_replicas-th batch, starting at its rank; the batch list is padded by repeating its first
+    batches so that all ranks run the same number of steps. Lightning cannot inject its
+    DistributedSampler into a custom batch sampler, so the Trainer needs use_distributed_sampler=False.
+
+    Args:
+        cumulative_slice_counts (array): Slice offsets of the patients ([0, n_1, n_1 + n_2, ...]).
+        batch_size (int): Number of slices per batch.
+        run_length (int): Number of contiguous slices taken from a patient at a time.
+        shuffle (bool): Shuffle the runs every epoch.
+        drop_last (bool): Drop the last incomplete batch.
+        seed (int, optional): Base seed of the shuffle, offset by the epoch (set_epoch). By default a new
+            seed is drawn from torch's RNG every epoch, or 0 is used with num_replicas > 1 so that all
+            ranks agree on the order.
+        num_replicas (int): Number of processes the batches are split across (the DDP world size).
+        rank (int): Rank of the current process.
+    """
+
+    def __init__(
+        self,
+        cumulative_slice_counts,
+        batch_size: int,
+        run_length: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: Optional[int] = None,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ):
+        if batch_size < 1 or run_length < 1:
+            raise ValueError("batch_size and run_length must be positive integers")
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank should be in [0, {num_replicas - 1}], but got {rank}")
+        self.cumulative_slice_counts = np.asarray(cumulative_slice_counts)
+        self.batch_size = batch_size
+        self.run_length = run_length
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_slices = int(self.cumulative_slice_counts[-1])
+
+        self.runs = []
+        for start, end in zip(self.cumulative_slice_counts[:-1], self.cumulative_slice_counts[1:]):
+            for run_start in range(int(start), int(end), run_length):
+                self.runs.append((run_start, min(run_start + run_length, int(end))))
+
+    def set_epoch(self, epoch: int):
+        """Called by Lightning at the start of every epoch, like DistributedSampler.set_epoch."""
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = list(self._batches())
+        if self.num_replicas == 1:
+            return iter(batches)
+        num_batches = len(self) * self.num_replicas
+        batches += (batches * num_batches)[: num_batches - len(batches)]
+        return iter(batches[self.rank :: self.num_replicas])
+
+    def _batches(self) -> Iterator[List[int]]:
+        if self.shuffle:
+            if self.seed is None and self.num_replicas == 1:
+                seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            else:
+                seed = (self.seed or 0) + self.epoch
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            order = torch.randperm(len(self.runs), generator=generator).tolist()
+        else:
+            order = range(len(self.runs))
+
+        batch = []
+        for run_idx in order:
+            start, end = self.runs[run_idx]
+            for idx in range(start, end):
+                batch.append(idx)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if batch and not self.drop_last:
+            yield batch
+
+    def __len__(self) -> int:
+        """Number of batches of this rank."""
+        if self.drop_last:
+            num_batches = self.num_slices // self.batch_size
+        else:
+            num_batches = (self.num_slices + self.batch_size - 1) // self.batch_size
+        return (num_batches + self.num_replicas - 1) // self.num_replicas
@@ -0,0 +1,117 @@
+"""Memory-mapped int16 slice cache for the SynthRAD H5 files.
+
+Each group of a split is quantized from [-1, 1] float32 to int16 and written into one
+slice-major [N, H, W] memmap (`<group>.int16.npy`). `index.npz` stores the patient keys and
+their slice offsets, which replace `cumulative_slice_counts`. Memmaps are opened lazily in every
+process (copy-on-write, never written), so DataLoader workers share the same page-cache pages.
+Slices are served as int16 views and dequantized after the batch is on the device (see dequantize).
+"""
+import json
+import os
+
+import h5py
+import numpy as np
+import torch
+
+from src.data.components.h5_layout import is_slice_major
+
+QUANT_SCALE = 32767.0
+INDEX_FILE = "index.npz"
+META_FILE = "meta.json"
+
+
+def _source_signature(h5_path):
+    stat = os.stat(h5_path)
+    return {"source": os.path.abspath(h5_path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def is_cache_valid(h5_path, cache_dir, groups):
+    """Returns True if `cache_dir` holds a cache of `groups` built from the current `h5_path`."""
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    return meta.get("signature") == _source_signature(h5_path) and all(group in meta["groups"] for group in groups)
+
+
+def dequantize(tensor):
+    """Maps an int16 tensor served from the cache back to float32 in [-1, 1]."""
+    return tensor.float() / QUANT_SCALE
+
+
+def build_slice_cache(h5_path, cache_dir, groups):
+    """Quantizes `groups` of an H5 file to int16 and writes one [N, H, W] memmap per group.
+
+    Args:
+        h5_path (str): SynthRAD H5 file ([H, W, D] or slice-major [D, H, W]).
+        cache_dir (str): Output directory.
+        groups (list): Groups to cache, e.g. ["MR", "CT"]. The first group defines the patient order.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with h5py.File(h5_path, "r") as file:
+        slice_major = is_slice_major(file)
+        slice_axis = 0 if slice_major else -1
+        patient_keys = list(file[groups[0]].keys())
+        shapes = [file[groups[0]][key].shape for key in patient_keys]
+        slice_counts = [shape[slice_axis] for shape in shapes]
+        height, width = shapes[0][1:] if slice_major else shapes[0][:2]
+        offsets = np.cumsum([0] + slice_counts)
+
+        for group in groups:
+            memmap = np.lib.format.open_memmap(
+                os.path.join(cache_dir, f"{group}.int16.npy"),
+                mode="w+",
+                dtype=np.int16,
+                shape=(int(offsets[-1]), height, width),
+            )
+            for patient_idx, key in enumerate(patient_keys):
+                volume = file[group][key][...]
+                if not slice_major:
+                    volume = np.transpose(volume, (2, 0, 1))
+                if volume.shape[1:] != (height, width):
+                    raise ValueError(
+                        f"All patients must share the same height, width for the slice cache: {group}/{key} is {volume.shape[1:]}"
+                    )
+                memmap[offsets[patient_idx] : offsets[patient_idx + 1]] = np.round(
+                    np.clip(volume, -1.0, 1.0) * QUANT_SCALE
+                ).astype(np.int16)
+            memmap.flush()
+            del memmap
+
+    np.savez(os.path.join(cache_dir, INDEX_FILE), patient_keys=np.array(patient_keys), offsets=offsets)
+    # Written last: a partially built cache is never considered valid
+    with open(os.path.join(cache_dir, META_FILE), "w") as f:
+        json.dump({"signature": _source_signature(h5_path), "groups": list(groups)}, f)
+
+
+class SliceCache:
+    """Read-only view on a cache written by build_slice_cache."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        index = np.load(os.path.join(cache_dir, INDEX_FILE))
+        self.patient_keys = [str(key) for key in index["patient_keys"]]
+        self.offsets = index["offsets"]
+        self._arrays = {}
+
+    def __getstate__(self):
+        # Pickling an np.memmap copies its data; workers reopen the files instead
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def _array(self, group):
+        if group not in self._arrays:
+            # Copy-on-write mapping: views are writable for torch.from_numpy, pages stay shared as nothing writes them
+            self._arrays[group] = np.load(os.path.join(self.cache_dir, f"{group}.int16.npy"), mmap_mode="c")
+        return self._arrays[group]
+
+    def read_slice(self, group, idx):
+        """Returns global slice `idx` of `group` as an int16 [H, W] view on the memmap."""
+        return self._array(group)[idx]
+
+    def read_volume(self, group, patient_idx):
+        """Returns patient `patient_idx` of `group` as an int16 [H, W, D] view on the memmap."""
+        volume = self._array(group)[self.offsets[patient_idx] : self.offsets[patient_idx + 1]]
+        return np.transpose(volume, (1, 2, 0))
@@ -1,8 +1,11 @@
 from typing import Any, Dict, Optional, Tuple
+from contextlib import nullcontext
 import numpy as np
 import torch
 import h5py
 from src import utils
+from src.data.components.h5_layout import is_slice_major
+from src.data.components.slice_cache import QUANT_SCALE, SliceCache
 import os
 from torch.utils.data import Dataset
 from monai.transforms import RandFlipd, RandRotate90d, Compose, RandCropd
@@ -183,6 +186,20 @@ def even_crop_height_width(tensorA, tensorB, tensorC=None, tensorD=None, multipl
 
 log = utils.get_pylogger(__name__)
 
+
+def stage1_cache_path(h5_path):
+    """Sidecar H5 file holding the Stage-1 groups of `h5_path` (written by src/precompute_stage1.py)."""
+    return os.path.splitext(h5_path)[0] + "_stage1.h5"
+
+
+def h5_worker_init_fn(worker_id):
+    """Opens the persistent H5 handle of the worker's dataset copy once, right after the worker starts."""
+    worker_info = torch.utils.data.get_worker_info()
+    dataset = worker_info.dataset if worker_info is not None else None
+    if getattr(dataset, "persistent_handles", False):
+        dataset.open()
+
+
 class dataset_SynthRAD(Dataset):
     def __init__(
         self,
@@ -196,6 +213,11 @@ class dataset_SynthRAD(Dataset):
         rot_prob: float = 0.0,
         crop_size: Optional[Tuple[int, int]] = None,
         reverse: bool = False,
+        persistent_handles: bool = False,  # Keep one H5 handle (and its datasets) open per process
+        slice_cache_dir: Optional[str] = None,  # Serve slices from an int16 memmap cache (see slice_cache.py)
+        augment_on_device: bool = False,  # Skip pad/augmentation/crop here; BatchAugmentation runs them on the device
+        stage1_groups: Optional[Tuple[str, str]] = None,  # (synth_img, deform_field) groups in the stage1_cache_path sidecar
+        return_index: bool = False,  # Append each sample's dataset index (global slice index in 2D) to its tuple
         *args,
         **kwargs,
     ):
@@ -208,14 +230,38 @@ class dataset_SynthRAD(Dataset):
         self.padding_size = padding_size
         self.crop_size = crop_size
         self.reverse = reverse
+        self.persistent_handles = persistent_handles
+        self.augment_on_device = augment_on_device
+        self.stage1_groups = tuple(stage1_groups) if stage1_groups else None
+        self.stage1_path = stage1_cache_path(data_dir) if stage1_groups else None
+        self.return_index = return_index
+
+        # Per-process handle pool (see open/close). Never shared across fork: the owning pid is stored with it.
+        self._file = None
+        self._stage1_file = None
+        self._file_pid = None
+        self._datasets = {}
 
         os.environ["HDF5_USE_FILE_LOCKING"] = "TRUE"
 
         self.patient_keys = []
+        self.slice_cache = SliceCache(slice_cache_dir) if slice_cache_dir else None
 
-        if self.is_3d:
+        if self.slice_cache is not None:
+            self.patient_keys = self.slice_cache.patient_keys
+            self.cumulative_slice_counts = self.slice_cache.offsets
+            self.slice_counts = np.diff(self.cumulative_slice_counts).tolist()
+
+            self.aug_func = Compose(
+                [
+                    RandFlipd(keys=["A", "B"] if not self.data_group_3 else ["A", "B", "C"], prob=flip_prob, spatial_axis=[0, 1]),
+                    RandRotate90d(keys=["A", "B"] if not self.data_group_3 else ["A", "B", "C"], prob=rot_prob, spatial_axes=[0, 1]),
+                ]
+            )
+        elif self.is_3d:
             with h5py.File(self.data_dir, "r") as file:
                 self.patient_keys = list(file[self.data_group_1].keys())
+                self.slice_major = is_slice_major(file)
 
             self.aug_func = Compose(
                 [
@@ -226,7 +272,9 @@ class dataset_SynthRAD(Dataset):
         else:
             with h5py.File(self.data_dir, "r") as file:
                 self.patient_keys = list(file[self.data_group_1].keys())
-                self.slice_counts = [file[self.data_group_1][key].shape[-1] for key in self.patient_keys]
+                self.slice_major = is_slice_major(file)  # [D, H, W] file written by h5_layout.convert_to_slice_major
+                slice_axis = 0 if self.slice_major else -1
+                self.slice_counts = [file[self.data_group_1][key].shape[slice_axis] for key in self.patient_keys]
                 self.cumulative_slice_counts = np.cumsum([0] + self.slice_counts)
 
             self.aug_func = Compose(
@@ -236,34 +284,219 @@ class dataset_SynthRAD(Dataset):
                 ]
             )
 
+        if self.stage1_groups:
+            self._check_stage1_groups(flip_prob, rot_prob)
+
+    def _check_stage1_groups(self, flip_prob, rot_prob):
+        if self.is_3d or self.data_group_3 or self.slice_cache is not None:
+            raise ValueError("The Stage-1 cache is only supported for 2D datasets with two groups read from H5")
+        if flip_prob > 0 or rot_prob > 0 or self.padding_size:
+            # Displacement vectors would have to be flipped/rotated with the images and padded with zeros
+            raise ValueError("flip_prob, rot_prob and padding_size must be disabled when using the Stage-1 cache")
+        input_group, ref_group = (
+            (self.data_group_2, self.data_group_1) if self.reverse else (self.data_group_1, self.data_group_2)
+        )
+        if not os.path.exists(self.stage1_path):
+            raise ValueError(f"Stage-1 cache {self.stage1_path} not found. Run src/precompute_stage1.py first")
+        with h5py.File(self.stage1_path, "r") as file:
+            for group in self.stage1_groups:
+                if group not in file:
+                    raise ValueError(f"Stage-1 group '{group}' not found in {self.stage1_path}. Run src/precompute_stage1.py first")
+                attrs = file[group].attrs
+                if attrs.get("input_group") != input_group or attrs.get("ref_group") != ref_group:
+                    raise ValueError(
+                        f"Stage-1 group '{group}' was computed for {attrs.get('input_group')} -> {attrs.get('ref_group')}, "
+                        f"but the dataset uses {input_group} -> {ref_group}"
+                    )
+
     def __len__(self):
         if self.is_3d:
             return len(self.patient_keys)
         else:
             return self.cumulative_slice_counts[-1]
 
+    def open(self):
+        """Returns the H5 handle of the current process, opening it on first use.
+
+        A handle inherited through fork belongs to the parent process, so it is dropped (not closed) and
+        a fresh one is opened for this process.
+        """
+        pid = os.getpid()
+        if self._file is None or self._file_pid != pid:
+            self._file = h5py.File(self.data_dir, "r")
+            self._stage1_file = h5py.File(self.stage1_path, "r") if self.stage1_path else None
+            self._file_pid = pid
+            self._datasets = {}
+        return self._file
+
+    def close(self):
+        """Closes the handle owned by the current process and clears the cached datasets."""
+        if self._file is not None and self._file_pid == os.getpid():
+            for file in (self._file, self._stage1_file):
+                try:
+                    if file is not None:
+                        file.close()
+                except Exception:  # interpreter shutdown may already have released HDF5
+                    pass
+        self._file = None
+        self._stage1_file = None
+        self._file_pid = None
+        self._datasets = {}
+
+    def __getstate__(self):
+        # h5py objects cannot be pickled (spawn / persistent workers); every worker opens its own handle
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_stage1_file"] = None
+        state["_file_pid"] = None
+        state["_datasets"] = {}
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def _file_context(self):
+        if self.persistent_handles:
+            return nullcontext(self.open())
+        return h5py.File(self.data_dir, "r")
+
+    def _stage1_context(self):
+        if not self.stage1_path:
+            return nullcontext(None)
+        if self.persistent_handles:
+            self.open()
+            return nullcontext(self._stage1_file)
+        return h5py.File(self.stage1_path, "r")
+
+    def _get_dataset(self, file, group, patient_key):
+        if not self.persistent_handles:
+            return file[group][patient_key]
+        key = (group, patient_key)
+        if key not in self._datasets:
+            self._datasets[key] = file[group][patient_key]
+        return self._datasets[key]
+
+    def _read_volume(self, file, group, patient_key):
+        """Reads a whole patient volume as [H, W, D] regardless of the file layout."""
+        volume = self._get_dataset(file, group, patient_key)[...]
+        if self.slice_major:
+            volume = np.ascontiguousarray(np.transpose(volume, (1, 2, 0)))
+        return volume
+
+    def _read_slice(self, file, group, patient_key, slice_idx):
+        """Reads one [H, W] slice; a single contiguous chunk for slice-major files."""
+        dataset = self._get_dataset(file, group, patient_key)
+        if self.slice_major:
+            return dataset[slice_idx]
+        return dataset[..., slice_idx]
+
     def __getitem__(self, idx):
-        if self.is_3d:
+        return self._with_index(self._get_sample(idx), idx)
+
+    def _with_index(self, sample, idx):
+        return (*sample, int(idx)) if self.return_index else sample
+
+    def _get_sample(self, idx):
+        if self.slice_cache is not None:
+            groups = [self.data_group_1, self.data_group_2] + ([self.data_group_3] if self.data_group_3 else [])
+            if self.is_3d:
+                images = [self.slice_cache.read_volume(group, idx) for group in groups]
+            else:
+                images = [self.slice_cache.read_slice(group, idx) for group in groups]
+            A, B = images[0], images[1]
+            if self.data_group_3:
+                C = images[2]
+        elif self.is_3d:
             patient_key = self.patient_keys[idx]
-            with h5py.File(self.data_dir, "r") as file:
-                A = file[self.data_group_1][patient_key][...]
-                B = file[self.data_group_2][patient_key][...]
+            with self._file_context() as file:
+                A = self._read_volume(file, self.data_group_1, patient_key)
+                B = self._read_volume(file, self.data_group_2, patient_key)
                 if self.data_group_3:
-                    C = file[self.data_group_3][patient_key][...]
+                    C = self._read_volume(file, self.data_group_3, patient_key)
         else:
             patient_idx = np.searchsorted(self.cumulative_slice_counts, idx + 1) - 1
             slice_idx = idx - self.cumulative_slice_counts[patient_idx]
             patient_key = self.patient_keys[patient_idx]
-            with h5py.File(self.data_dir, "r") as file:
-                A = file[self.data_group_1][patient_key][..., slice_idx]
-                B = file[self.data_group_2][patient_key][..., slice_idx]
+            with self._file_context() as file, self._stage1_context() as stage1_file:
+                A = self._read_slice(file, self.data_group_1, patient_key, slice_idx)
+                B = self._read_slice(file, self.data_group_2, patient_key, slice_idx)
                 if self.data_group_3:
-                    C = file[self.data_group_3][patient_key][..., slice_idx]
-
+                    C = self._read_slice(file, self.data_group_3, patient_key, slice_idx)
+                if self.stage1_groups:
+                    synth_img = self._read_slice(stage1_file, self.stage1_groups[0], patient_key, slice_idx)
+                    deform_field = self._read_slice(stage1_file, self.stage1_groups[1], patient_key, slice_idx)
+                    return self._transform_stage1(A, B, synth_img, deform_field)
+
+        return self._transform(A, B, C if self.data_group_3 else None)
+
+    def __getitems__(self, indices):
+        """Batch-level fetch used by the DataLoader when a batch sampler is set.
+
+        Indices are grouped by patient and every patient's slices are read with a single H5 call
+        per group; padding, augmentation and cropping stay per sample.
+        """
+        if self.is_3d or self.slice_cache is not None:
+            return [self[idx] for idx in indices]
+
+        indices = np.asarray(indices)
+        patient_idxs = np.searchsorted(self.cumulative_slice_counts, indices + 1) - 1
+        groups = [self.data_group_1, self.data_group_2] + ([self.data_group_3] if self.data_group_3 else [])
+        images = [[None] * len(indices) for _ in groups + list(self.stage1_groups or ())]
+
+        with self._file_context() as file, self._stage1_context() as stage1_file:
+            sources = [(file, group) for group in groups] + [(stage1_file, group) for group in self.stage1_groups or ()]
+            for patient_idx in np.unique(patient_idxs):
+                positions = np.nonzero(patient_idxs == patient_idx)[0]
+                slice_idxs = indices[positions] - self.cumulative_slice_counts[patient_idx]
+                # h5py point selections need strictly increasing indices
+                unique_slices, inverse = np.unique(slice_idxs, return_inverse=True)
+                patient_key = self.patient_keys[patient_idx]
+                for group_idx, (source, group) in enumerate(sources):
+                    dataset = self._get_dataset(source, group, patient_key)
+                    if self.slice_major:
+                        slices = dataset[unique_slices.tolist()]
+                    else:
+                        slices = np.moveaxis(dataset[..., unique_slices.tolist()], -1, 0)
+                    for position, slice_pos in zip(positions, inverse):
+                        images[group_idx][position] = slices[slice_pos]
+
+        transform = self._transform_stage1 if self.stage1_groups else self._transform
+        return [
+            self._with_index(transform(*(group_images[i] for group_images in images)), idx)
+            for i, idx in enumerate(indices)
+        ]
+
+    def _transform_stage1(self, A, B, synth_img, deform_field):
+        """Returns (input, ref, synth_img, deform_field) cropped consistently; deform_field is [2, H, W]."""
         A = torch.from_numpy(A).unsqueeze(0).float()
         B = torch.from_numpy(B).unsqueeze(0).float()
+        synth_img = torch.from_numpy(synth_img).unsqueeze(0).float()
+        deform_field = torch.from_numpy(deform_field).float()
+
+        if not self.augment_on_device:
+            # Displacements are in pixels, so cropping does not change their values
+            if self.crop_size:
+                A, B, synth_img, deform_field = random_crop_height_width(A, B, synth_img, deform_field, target_size=self.crop_size)
+            else:
+                A, B, synth_img, deform_field = even_crop_height_width(A, B, synth_img, deform_field, multiple=(16, 16))
+
+        if self.reverse:
+            return B, A, synth_img, deform_field
+        return A, B, synth_img, deform_field
+
+    def _transform(self, A, B, C=None):
+        """Converts the [H, W] (or [H, W, D]) arrays to tensors and applies padding, augmentation and cropping.
+
+        Slices from the slice cache stay int16 (no copy here); the datamodule dequantizes them on the device.
+        """
+        quantized = self.slice_cache is not None
+        A = self._to_tensor(A, quantized)
+        B = self._to_tensor(B, quantized)
         if self.data_group_3:
-            C = torch.from_numpy(C).unsqueeze(0).float()
+            C = self._to_tensor(C, quantized)
+
+        if self.augment_on_device:
+            return self._order(A, B, C)
 
         # Create a dictionary for the data
         data_dict = {"A": A, "B": B}
@@ -276,10 +509,11 @@ class dataset_SynthRAD(Dataset):
             C = data_dict["C"]
 
         if self.padding_size:
+            pad_value = -QUANT_SCALE if quantized else -1
             if self.data_group_3:
-                A, B, C = padding_height_width(A, B, C, target_size=self.padding_size)
+                A, B, C = padding_height_width(A, B, C, target_size=self.padding_size, pad_value=pad_value)
             else:
-                A, B = padding_height_width(A, B, target_size=self.padding_size)
+                A, B = padding_height_width(A, B, target_size=self.padding_size, pad_value=pad_value)
 
         data_dict = self.aug_func(data_dict)
 
@@ -293,7 +527,15 @@ class dataset_SynthRAD(Dataset):
                 A, B, C = even_crop_height_width(A, B, C, multiple=(16, 16)) # 16의 배수로 Crop
             else:
                 A, B = even_crop_height_width(A, B, multiple=(16, 16)) # 16의 배수로 Crop
-                
+
+        return self._order(A, B, C)
+
+    @staticmethod
+    def _to_tensor(array, quantized=False):
+        tensor = torch.from_numpy(array).unsqueeze(0)
+        return tensor if quantized else tensor.float()
+
+    def _order(self, A, B, C=None):
         if self.reverse:
             if self.data_group_3:
                 return C, B, A
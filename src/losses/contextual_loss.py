@@ -5,6 +5,7 @@ import torch.nn.functional as F
 import torch.nn as nn
 import torch
 from collections import OrderedDict
+from torch.utils.checkpoint import checkpoint
 
 
 class ResNet_Model(nn.Module):
@@ -35,14 +36,14 @@ class ResNet_Model(nn.Module):
             self.listen = []
         else:
             self.listen = set(listen_list)
-        self.features = OrderedDict()
 
     def forward(self, x):
+        features = OrderedDict()
         for name, layer in self.resnet_model.named_children():
             x = layer(x)
             if name in self.listen:
-                self.features[name] = x
-        return self.features
+                features[name] = x
+        return features
 
 
 import sys
@@ -138,31 +139,58 @@ vgg_layer_inv = {
 
 
 class VGG_Model(nn.Module):
-    def __init__(self, listen_list=None):
+    def __init__(self, listen_list=None, channels_last=False):
+        """VGG19 features truncated after the deepest layer in listen_list.
+
+        The ReLUs of vgg19 are in-place, so a listened conv_x_y output is the activation after its
+        ReLU; the ReLU following the deepest listened conv is therefore kept. Checkpoints holding the
+        full vgg19.features still load (the layers past the truncation point are dropped).
+
+        Args:
+            listen_list: Layer names (see vgg_layer) returned by forward.
+            channels_last: Run the convolutions in channels_last memory format (faster on tensor cores).
+                Returned features are contiguous either way.
+        """
         super(VGG_Model, self).__init__()
         vgg = vgg19(pretrained=True)
-        self.vgg_model = vgg.features
-        vgg_dict = vgg.state_dict()
-        vgg_f_dict = self.vgg_model.state_dict()
-        vgg_dict = {k: v for k, v in vgg_dict.items() if k in vgg_f_dict}
-        vgg_f_dict.update(vgg_dict)
-        # no grad
-        for p in self.vgg_model.parameters():
-            p.requires_grad = False
-        if listen_list == []:
-            self.listen = []
+        if listen_list == [] or listen_list is None:
+            self.listen = set()
         else:
             self.listen = set()
             for layer in listen_list:
                 self.listen.add(vgg_layer[layer])
-        self.features = OrderedDict()
+        end = max(self.listen) + 1 if self.listen else 0
+        if end < len(vgg.features) and isinstance(vgg.features[end], nn.ReLU):
+            end += 1
+        # slicing keeps the module names, so state_dict keys are those of vgg19.features
+        self.vgg_model = vgg.features[:end]
+        # no grad
+        for p in self.vgg_model.parameters():
+            p.requires_grad = False
+        self.channels_last = channels_last
+        if channels_last:
+            self.vgg_model = self.vgg_model.to(memory_format=torch.channels_last)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # drop the layers of older (untruncated) checkpoints past the truncation point
+        kept = {f"{prefix}vgg_model.{name}." for name, _ in self.vgg_model.named_children()}
+        for key in list(state_dict.keys()):
+            if key.startswith(f"{prefix}vgg_model.") and not any(key.startswith(k) for k in kept):
+                state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
+        """Returns a new OrderedDict {layer name: feature} per call, in depth order."""
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        features = OrderedDict()
         for index, layer in enumerate(self.vgg_model):
             x = layer(x)
             if index in self.listen:
-                self.features[vgg_layer_inv[index]] = x
-        return self.features
+                features[vgg_layer_inv[index]] = x
+        if self.channels_last:
+            features = OrderedDict((k, v.contiguous()) for k, v in features.items())
+        return features
 
 
 """
@@ -186,6 +214,10 @@ class Contextual_Loss(nn.Module):
         b=1.0,
         h=0.5,
         weight_sp=0.1,
+        feature_extractor=None,
+        channels_last=False,
+        target_no_grad=False,
+        chunk_size=None,
     ):
         super(Contextual_Loss, self).__init__()
         listen_list = []
@@ -195,8 +227,11 @@ class Contextual_Loss(nn.Module):
             self.layers_weights = layers_weights
         except:
             pass
-        if vgg == True:
-            self.vgg_pred = VGG_Model(listen_list=listen_list)
+        if feature_extractor is not None:
+            # shared with other losses (must listen to at least the layers in layers_weights)
+            self.vgg_pred = feature_extractor
+        elif vgg == True:
+            self.vgg_pred = VGG_Model(listen_list=listen_list, channels_last=channels_last)
         else:
             self.vgg_pred = ResNet_Model(listen_list=listen_list)
         self.crop_quarter = crop_quarter
@@ -207,8 +242,17 @@ class Contextual_Loss(nn.Module):
         self.cobi = cobi
         self.l1 = l1
         self.weight_sp = weight_sp
+        # gt features without autograd (for targets that never need gradients)
+        self.target_no_grad = target_no_grad
+        # CX over blocks of chunk_size query positions: O(chunk_size * H*W) instead of O((H*W)^2) memory
+        self.chunk_size = chunk_size
+
+    def forward(self, images, gt, images_feats=None, gt_feats=None):
+        # images_feats / gt_feats: features already extracted by vgg_pred (e.g. shared with PatchNCE)
+        if images_feats is not None and gt_feats is not None:
+            loss = torch.zeros(images.shape[0], 1, 1, 1) if self.l1 else torch.zeros(1)
+            return self._layers_loss(loss.to(images.device), dict(images_feats), dict(gt_feats))
 
-    def forward(self, images, gt):
         if images.shape[1] == 1 and gt.shape[1] == 1:
             images = images.repeat(1, 3, 1, 1)
             gt = gt.repeat(1, 3, 1, 1)
@@ -217,24 +261,27 @@ class Contextual_Loss(nn.Module):
             images.shape[1] == 3 and gt.shape[1] == 3
         ), "VGG model takes 3 channel images."
 
+        # VGG_Model returns a new dict per call, so the image features need no clone
+        vgg_images = self.vgg_pred(images)
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.target_no_grad):
+            vgg_gt = self.vgg_pred(gt)
         if images.device.type == "cpu":
             loss = torch.zeros(1)
-            vgg_images = self.vgg_pred(images)
-            vgg_images = {k: v.clone() for k, v in vgg_images.items()}
-            vgg_gt = self.vgg_pred(gt)
+            vgg_images = dict(vgg_images)
+            vgg_gt = dict(vgg_gt)
         else:
             id_cuda = torch.cuda.current_device()
             if self.l1:
                 loss = torch.zeros(images.shape[0], 1, 1, 1).cuda(id_cuda)
             else:
                 loss = torch.zeros(1).cuda(id_cuda)
-            vgg_images = self.vgg_pred(images)
-            vgg_images = {k: v.clone().cuda(id_cuda) for k, v in vgg_images.items()}
-            vgg_gt = self.vgg_pred(gt)
+            vgg_images = {k: v.cuda(id_cuda) for k, v in vgg_images.items()}
             vgg_gt = {k: v.cuda(id_cuda) for k, v in vgg_gt.items()}
         # print('images', [v.device for k, v in vgg_images.items()])
         # print('gt', [v.device for k, v in vgg_gt.items()])
+        return self._layers_loss(loss, vgg_images, vgg_gt)
 
+    def _layers_loss(self, loss, vgg_images, vgg_gt):
         for key in self.layers_weights.keys():
             N, C, H, W = vgg_images[key].size()
 
@@ -325,60 +372,51 @@ class Contextual_Loss(nn.Module):
         feature_tensor = torch.cat(quarters_list, dim=0)
         return feature_tensor
 
+    @staticmethod
+    def _feature_vectors(I_features, T_features, distance_type):
+        """[N, C, H*W] feature vectors of I and T (centered by T and normalized for the cosine distance)."""
+        assert I_features.size() == T_features.size()
+        if distance_type == Distance_Type.Cosine_Distance:
+            I_features, T_features = Contextual_Loss._centered_by_T(I_features, T_features)
+            I_features = Contextual_Loss._normalized_L2_channelwise(I_features)
+            T_features = Contextual_Loss._normalized_L2_channelwise(T_features)
+        N, C = I_features.shape[:2]
+        return I_features.reshape(N, C, -1), T_features.reshape(N, C, -1)
+
+    @staticmethod
+    def _pairwise_distance(Ivecs, Tvecs, distance_type):
+        """
+        Batched distance between vectors of I and T
+        :param Ivecs: [N, C, P] query vectors (all or a block of the positions of I)
+        :param Tvecs: [N, C, H*W] vectors of T, from _feature_vectors
+        :return: raw_distance: [N, P, H*W]
+        """
+        if distance_type == Distance_Type.L1_Distance:
+            return torch.cdist(Ivecs.transpose(1, 2), Tvecs.transpose(1, 2), p=1)
+        AB = torch.bmm(Ivecs.transpose(1, 2), Tvecs)
+        if distance_type == Distance_Type.L2_Distance:
+            square_I = torch.sum(Ivecs * Ivecs, dim=1)
+            square_T = torch.sum(Tvecs * Tvecs, dim=1)
+            return torch.clamp(square_I.unsqueeze(2) + square_T.unsqueeze(1) - 2 * AB, 0.0)
+        return ((1 - AB) / 2).clamp(min=0.0)
+
     @staticmethod
     def _create_using_L2(I_features, T_features):
         """
         Calculating the distance between each feature of I and T
         :param I_features:
         :param T_features:
-        :return: raw_distance: [N, C, H, W, H*W], each element of which is the distance between I and T at each position
+        :return: raw_distance: [N, H, W, H*W], each element of which is the distance between I and T at each position
         """
-        assert I_features.size() == T_features.size()
         N, C, H, W = I_features.size()
-
-        Ivecs = I_features.view(N, C, -1)
-        Tvecs = T_features.view(N, C, -1)
-        #
-        square_I = torch.sum(Ivecs * Ivecs, dim=1, keepdim=False)
-        square_T = torch.sum(Tvecs * Tvecs, dim=1, keepdim=False)
-        # raw_distance
-        raw_distance = []
-
-        for i in range(N):
-            Ivec, Tvec, s_I, s_T = (
-                Ivecs[i, ...],
-                Tvecs[i, ...],
-                square_I[i, ...],
-                square_T[i, ...],
-            )
-            # matrix multiplication
-            AB = Ivec.permute(1, 0) @ Tvec
-            dist = s_I.view(-1, 1) + s_T.view(1, -1) - 2 * AB
-
-            raw_distance.append(dist.view(1, H, W, H * W))
-        raw_distance = torch.cat(raw_distance, dim=0)
-        raw_distance = torch.clamp(raw_distance, 0.0)
-        return raw_distance
+        Ivecs, Tvecs = Contextual_Loss._feature_vectors(I_features, T_features, Distance_Type.L2_Distance)
+        return Contextual_Loss._pairwise_distance(Ivecs, Tvecs, Distance_Type.L2_Distance).view(N, H, W, H * W)
 
     @staticmethod
     def _create_using_L1(I_features, T_features):
-        assert I_features.size() == T_features.size()
         N, C, H, W = I_features.size()
-
-        Ivecs = I_features.view(N, C, -1)
-        Tvecs = T_features.view(N, C, -1)
-
-        raw_distance = []
-        for i in range(N):
-            Ivec, Tvec = Ivecs[i, ...], Tvecs[i, ...]
-            dist = torch.sum(
-                torch.abs(Ivec.view(C, -1, 1) - Tvec.view(C, 1, -1)),
-                dim=0,
-                keepdim=False,
-            )
-            raw_distance.append(dist.view(1, H, W, H * W))
-        raw_distance = torch.cat(raw_distance, dim=0)
-        return raw_distance
+        Ivecs, Tvecs = Contextual_Loss._feature_vectors(I_features, T_features, Distance_Type.L1_Distance)
+        return Contextual_Loss._pairwise_distance(Ivecs, Tvecs, Distance_Type.L1_Distance).view(N, H, W, H * W)
 
     @staticmethod
     def _centered_by_T(I, T):
@@ -397,24 +435,9 @@ class Contextual_Loss(nn.Module):
     
     @staticmethod
     def _create_using_dotP(I_features, T_features):
-        assert I_features.size() == T_features.size()
-        I_features, T_features = Contextual_Loss._centered_by_T(I_features, T_features)
-        I_features = Contextual_Loss._normalized_L2_channelwise(I_features)
-        T_features = Contextual_Loss._normalized_L2_channelwise(T_features)
-
         N, C, H, W = I_features.size()
-        cosine_dist = []
-        for i in range(N):
-            T_features_i = (
-                T_features[i].view(1, 1, C, H * W).permute(3, 2, 0, 1).contiguous()
-            )
-            I_features_i = I_features[i].unsqueeze(0)
-            dist = F.conv2d(I_features_i, T_features_i).permute(0, 2, 3, 1).contiguous()
-            cosine_dist.append(dist)
-        cosine_dist = torch.cat(cosine_dist, dim=0)
-        cosine_dist = (1 - cosine_dist) / 2
-        cosine_dist = cosine_dist.clamp(min=0.0)
-        return cosine_dist
+        Ivecs, Tvecs = Contextual_Loss._feature_vectors(I_features, T_features, Distance_Type.Cosine_Distance)
+        return Contextual_Loss._pairwise_distance(Ivecs, Tvecs, Distance_Type.Cosine_Distance).view(N, H, W, H * W)
 
     @staticmethod
     def _calculate_relative_distance(raw_distance, epsilon=1e-5):
@@ -575,58 +598,62 @@ class Contextual_Loss(nn.Module):
             print(T_features)
             raise ValueError("NaN or Inf in T_features")
 
-        if self.distanceType == Distance_Type.L1_Distance:
-            raw_distance = Contextual_Loss._create_using_L1(I_features, T_features)
-        elif self.distanceType == Distance_Type.L2_Distance:
-            raw_distance = Contextual_Loss._create_using_L2(I_features, T_features)
+        if self.chunk_size is not None and self.chunk_size < I_features.shape[2] * I_features.shape[3]:
+            max_gt_sim = self._chunked_max_gt_sim(I_features, T_features)
         else:
-            raw_distance = Contextual_Loss._create_using_dotP(I_features, T_features)
-        if torch.sum(torch.isnan(raw_distance)) == torch.numel(
-            raw_distance
-        ) or torch.sum(torch.isinf(raw_distance)) == torch.numel(raw_distance):
-            print(raw_distance)
-            raise ValueError("NaN or Inf in raw_distance")
-
-        relative_distance = Contextual_Loss._calculate_relative_distance(raw_distance + 1e-8) # 내가 추가함
-
-        if torch.sum(torch.isnan(relative_distance)) == torch.numel(
-            relative_distance
-        ) or torch.sum(torch.isinf(relative_distance)) == torch.numel(
-            relative_distance
-        ):
-            print(relative_distance)
-            raise ValueError("NaN or Inf in relative_distance")
-        del raw_distance
-
-        exp_distance = torch.exp((self.b - relative_distance) / self.h)
-        if torch.sum(torch.isnan(exp_distance)) == torch.numel(
-            exp_distance
-        ) or torch.sum(torch.isinf(exp_distance)) == torch.numel(exp_distance):
-            print(exp_distance)
-            raise ValueError("NaN or Inf in exp_distance")
-        ######################################################################################
-        del relative_distance
-
-        ######################################################################################
-        contextual_sim = exp_distance / (torch.sum(exp_distance, dim=-1, keepdim=True) + 1e-8)
-
-        if torch.sum(torch.isnan(contextual_sim)) > 0 or torch.sum(torch.isinf(contextual_sim)) > 0:
-            print(contextual_sim)
-            raise ValueError("NaN or Inf in contextual_sim")
-        ######################################################################################
-        # Similarity
-        # contextual_sim = exp_distance / torch.sum(exp_distance, dim=-1, keepdim=True)
-        # if torch.sum(torch.isnan(contextual_sim)) == torch.numel(
-        #     contextual_sim
-        # ) or torch.sum(torch.isinf(contextual_sim)) == torch.numel(contextual_sim):
-        #     print(contextual_sim)
-        #     raise ValueError("NaN or Inf in contextual_sim")
-        ######################################################################################
-
-        del exp_distance
-        if average_over_scales:
+            if self.distanceType == Distance_Type.L1_Distance:
+                raw_distance = Contextual_Loss._create_using_L1(I_features, T_features)
+            elif self.distanceType == Distance_Type.L2_Distance:
+                raw_distance = Contextual_Loss._create_using_L2(I_features, T_features)
+            else:
+                raw_distance = Contextual_Loss._create_using_dotP(I_features, T_features)
+            if torch.sum(torch.isnan(raw_distance)) == torch.numel(
+                raw_distance
+            ) or torch.sum(torch.isinf(raw_distance)) == torch.numel(raw_distance):
+                print(raw_distance)
+                raise ValueError("NaN or Inf in raw_distance")
+
+            relative_distance = Contextual_Loss._calculate_relative_distance(raw_distance + 1e-8) # 내가 추가함
+
+            if torch.sum(torch.isnan(relative_distance)) == torch.numel(
+                relative_distance
+            ) or torch.sum(torch.isinf(relative_distance)) == torch.numel(
+                relative_distance
+            ):
+                print(relative_distance)
+                raise ValueError("NaN or Inf in relative_distance")
+            del raw_distance
+
+            exp_distance = torch.exp((self.b - relative_distance) / self.h)
+            if torch.sum(torch.isnan(exp_distance)) == torch.numel(
+                exp_distance
+            ) or torch.sum(torch.isinf(exp_distance)) == torch.numel(exp_distance):
+                print(exp_distance)
+                raise ValueError("NaN or Inf in exp_distance")
+            ######################################################################################
+            del relative_distance
+
+            ######################################################################################
+            contextual_sim = exp_distance / (torch.sum(exp_distance, dim=-1, keepdim=True) + 1e-8)
+
+            if torch.sum(torch.isnan(contextual_sim)) > 0 or torch.sum(torch.isinf(contextual_sim)) > 0:
+                print(contextual_sim)
+                raise ValueError("NaN or Inf in contextual_sim")
+            ######################################################################################
+            # Similarity
+            # contextual_sim = exp_distance / torch.sum(exp_distance, dim=-1, keepdim=True)
+            # if torch.sum(torch.isnan(contextual_sim)) == torch.numel(
+            #     contextual_sim
+            # ) or torch.sum(torch.isinf(contextual_sim)) == torch.numel(contextual_sim):
+            #     print(contextual_sim)
+            #     raise ValueError("NaN or Inf in contextual_sim")
+            ######################################################################################
+
+            del exp_distance
             max_gt_sim = torch.max(torch.max(contextual_sim, dim=1)[0], dim=1)[0]
             del contextual_sim
+
+        if average_over_scales:
             CS = torch.mean(max_gt_sim, dim=1)
             if weight is not None:
                 CX_loss = torch.sum(-weight * torch.log(CS))
@@ -636,14 +663,39 @@ class Contextual_Loss(nn.Module):
                 raise ValueError("NaN in computing CX_loss")
             return CX_loss
         else:
-            max_gt_sim = torch.max(torch.max(contextual_sim, dim=1)[0], dim=1)[0]
-            del contextual_sim
             if torch.isnan(max_gt_sim).any():
                 raise ValueError("NaN in computing max_gt_sim")
             CS = torch.mean(max_gt_sim, dim=1)
             CX_loss = -torch.log(CS)  # batch * patch
             return CX_loss
 
+    def _cx_block_max_sim(self, Ivecs, Tvecs):
+        # contextual similarity of a block of query positions, maximized over the block: [N, H*W]
+        raw_distance = Contextual_Loss._pairwise_distance(Ivecs, Tvecs, self.distanceType)
+        relative_distance = Contextual_Loss._calculate_relative_distance(raw_distance + 1e-8)
+        exp_distance = torch.exp((self.b - relative_distance) / self.h)
+        contextual_sim = exp_distance / (torch.sum(exp_distance, dim=-1, keepdim=True) + 1e-8)
+        return torch.max(contextual_sim, dim=1)[0]
+
+    def _chunked_max_gt_sim(self, I_features, T_features):
+        """max_gt_sim of calculate_CX_Loss over blocks of chunk_size query positions.
+
+        The relative distance and the normalization are row-wise (per query position), so every block
+        is exact and the running max over blocks equals the max over all positions. Blocks are
+        checkpointed under autograd, bounding memory to O(chunk_size * H*W).
+        """
+        Ivecs, Tvecs = Contextual_Loss._feature_vectors(I_features, T_features, self.distanceType)
+        needs_grad = torch.is_grad_enabled() and (Ivecs.requires_grad or Tvecs.requires_grad)
+        max_gt_sim = None
+        for start in range(0, Ivecs.shape[2], self.chunk_size):
+            block = Ivecs[:, :, start : start + self.chunk_size]
+            if needs_grad:
+                block_max = checkpoint(self._cx_block_max_sim, block, Tvecs, use_reentrant=False)
+            else:
+                block_max = self._cx_block_max_sim(block, Tvecs)
+            max_gt_sim = block_max if max_gt_sim is None else torch.maximum(max_gt_sim, block_max)
+        return max_gt_sim
+
 
 def compute_meshgrid(shape):
     N, C, H, W = shape
@@ -18,60 +18,59 @@ def get_gausian_filter(sigma, sz):
     return gauss
 
 
-def gaussian_filter(img, n, sigma):
+# (xshift, yshift) whose Dp estimate the local variance
+VARIANCE_SHIFTS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+
+def neighbour_shifts(neigh_size):
+    """(xshift, yshift) of the MIND neighbourhood, in the order of the descriptor channels."""
+    shift_vec = np.arange(-neigh_size // 2, neigh_size - neigh_size // 2)
+    return [(int(xshift), int(yshift)) for xshift in shift_vec for yshift in shift_vec if (xshift, yshift) != (0, 0)]
+
+
+def shifted_square_diffs(image, shifts):
     """
-    img: image tensor of size (1, 1, height, width)
-    n: size of the Gaussian filter (n, n)
-    sigma: standard deviation of the Gaussian distribution
+    image: image tensor of size (batch, channel, height, width)
+    shifts: list of (xshift, yshift)
+    Returns (image - torch.roll(image, (xshift, yshift), dims=(-1, -2)))**2 of every shift, stacked on dim 1.
+    The rolls are slices of one circularly padded copy of the image.
     """
-    # Create a Gaussian filter
-    gaussian_filter = get_gausian_filter(sigma, n)
-    # Add extra dimensions for the color channels and batch size
-    gaussian_filter = gaussian_filter.view(1, 1, n, n)
-    gaussian_filter = gaussian_filter.to(img.device)
-    # Perform 2D convolution
-    filtered_img = F.conv2d(img, gaussian_filter, padding=n // 2)
-    return filtered_img
+    pad = max(max(abs(xshift), abs(yshift)) for xshift, yshift in shifts)
+    height, width = image.shape[-2:]
+    padded = F.pad(image, (pad, pad, pad, pad), mode="circular")
+    shift_image = torch.stack(
+        [padded[..., pad - yshift : pad - yshift + height, pad - xshift : pad - xshift + width] for xshift, yshift in shifts],
+        dim=1,
+    )
+    return (image.unsqueeze(1) - shift_image) ** 2
 
 
-def Dp(image, sigma, patch_size, xshift, yshift):
-    shift_image = torch.roll(image, shifts=(xshift, yshift), dims=(-1, -2))
-    diff = image - shift_image
-    diff_square = diff**2
-    res = gaussian_filter(diff_square, patch_size, sigma)
-    return res
+def mind(image, sigma=2.0, eps=1e-5, neigh_size=9, patch_size=7, kernel=None):
+    """
+    image: image tensor of size (batch, channel, height, width)
+    kernel: Gaussian filter of size (patch_size, patch_size), built from sigma if not given
+    Returns the MIND descriptor of size (batch, channel, height', width', neighbours).
+    Every Dp (4 for the variance, one per neighbour) is filtered at once by a grouped convolution.
+    """
+    reduce_size = (patch_size + neigh_size - 2) // 2
+    if kernel is None:
+        kernel = get_gausian_filter(sigma, patch_size)
+    shifts = VARIANCE_SHIFTS + neighbour_shifts(neigh_size)
+    n, c, h, w = image.shape
+    groups = len(shifts) * c
 
+    diff_square = shifted_square_diffs(image, shifts).view(n, groups, h, w)
+    gaussian_filter = kernel.to(image).view(1, 1, patch_size, patch_size).expand(groups, -1, -1, -1)
+    Dp = F.conv2d(diff_square, gaussian_filter, padding=patch_size // 2, groups=groups)
+    Dp = Dp.unflatten(1, (len(shifts), c))
 
-def mind(image, sigma=2.0, eps=1e-5, neigh_size=9, patch_size=7):
-    reduce_size = (patch_size + neigh_size - 2) // 2
     # estimate the local variance of each pixel within the input image.
-    Vimg = (
-        Dp(image, sigma, patch_size, -1, 0)
-        + Dp(image, sigma, patch_size, 1, 0)
-        + Dp(image, sigma, patch_size, 0, -1)
-        + Dp(image, sigma, patch_size, 0, 1)
-    )
-    Vimg = Vimg / 4 + eps * torch.ones_like(Vimg)
-
-    # estimate the (R*R)-length MIND feature by shifting the input image by R*R times.
-    xshift_vec = np.arange(-neigh_size // 2, neigh_size - neigh_size // 2)
-    yshift_vec = np.arange(-neigh_size // 2, neigh_size - neigh_size // 2)
-
-    # print(xshift_vec, yshift_vec)
-
-    iter_pos = 0
-    for xshift in xshift_vec:
-        for yshift in yshift_vec:
-            if (xshift, yshift) == (0, 0):
-                continue
-            MIND_tmp = torch.exp(
-                -Dp(image, sigma, patch_size, xshift, yshift) / Vimg
-            )  # MIND_tmp : 1x1x256x256
-            tmp = MIND_tmp[
-                ..., reduce_size:-reduce_size, reduce_size:-reduce_size, None
-            ]  # 1x1x250x250x1
-            output = tmp if iter_pos == 0 else torch.cat((output, tmp), -1)
-            iter_pos += 1
+    Vimg = Dp[:, :4].sum(dim=1) / 4 + eps
+
+    # estimate the (R*R)-length MIND feature from the Dp of every shift.
+    crop = (..., slice(reduce_size, -reduce_size), slice(reduce_size, -reduce_size))
+    output = torch.exp(-Dp[:, 4:][crop] / Vimg[crop].unsqueeze(1))
+    output = output.permute(0, 2, 3, 4, 1)  # batch x channel x 250 x 250 x neighbours
 
     # normalization.
     output = torch.divide(output, torch.max(output, dim=-1, keepdim=True)[0])
@@ -86,9 +85,13 @@ class MINDLoss(nn.Module):
         self.eps = eps
         self.neigh_size = neigh_size
         self.patch_size = patch_size
+        # not saved in checkpoints
+        self.register_buffer("kernel", get_gausian_filter(sigma, patch_size), persistent=False)
 
     def forward(self, pred, gt):
-        pred_mind = mind(pred, self.sigma, self.eps, self.neigh_size, self.patch_size)
-        gt_mind = mind(gt, self.sigma, self.eps, self.neigh_size, self.patch_size)
+        # descriptors of pred and gt in one batched call
+        pred_mind, gt_mind = mind(
+            torch.cat([pred, gt]), self.sigma, self.eps, self.neigh_size, self.patch_size, self.kernel
+        ).split([pred.shape[0], gt.shape[0]])
         mind_loss = F.l1_loss(pred_mind, gt_mind)
         return mind_loss
@@ -483,8 +483,9 @@ class OcclusionContextualLoss(nn.Module):
         with torch.no_grad():
             pred = pred[:, 0, :, :].unsqueeze(1)
             target = target[:, 0, :, :].unsqueeze(1)
-            pred, moving_padding = self.pad_tensor_to_multiple(pred, height_multiple=768, width_multiple=576)
-            target, fixed_padding = self.pad_tensor_to_multiple(target, height_multiple=768, width_multiple=576)
+            multiple = self.flow_model.shape_multiple
+            pred, moving_padding = self.pad_tensor_to_multiple(pred, height_multiple=multiple, width_multiple=multiple)
+            target, fixed_padding = self.pad_tensor_to_multiple(target, height_multiple=multiple, width_multiple=multiple)
             # print(" -------------------- ")
             # print("pred max", pred.max())
             # print("pred min", pred.min())
@@ -1,8 +1,83 @@
-import cv2
-import numpy as np
+import math
+
 import torch
+import torch.nn.functional as F
 from torchmetrics.metric import Metric
 
+# Port of cv2.Canny (apertureSize=3, L1 gradient) and cv2.Sobel (ksize=3) for [N, 1, H, W] batches on any device.
+# Integer-valued inputs give the same edges as OpenCV; gradients are computed in float32, which is exact for uint8 images.
+
+# tan(22.5 deg) in the fixed point of OpenCV (CANNY_SHIFT = 15)
+CANNY_SHIFT = 15
+TG22 = int(0.4142135623730950488016887242097 * (1 << CANNY_SHIFT) + 0.5)
+
+# The 3x3 stencils below are sums of shifted slices of the padded images, which is much faster than a
+# single-channel conv2d / max_pool2d (and exact for integer values).
+
+
+def sobel(imgs: torch.Tensor, padding_mode: str = "reflect"):
+    """x and y Sobel derivatives (ksize=3) of [N, 1, H, W] images. reflect is cv2.BORDER_DEFAULT (reflect 101)."""
+    padded = F.pad(imgs, (1, 1, 1, 1), mode=padding_mode)
+    diff_x = padded[..., 2:] - padded[..., :-2]
+    grad_x = diff_x[..., :-2, :] + 2 * diff_x[..., 1:-1, :] + diff_x[..., 2:, :]
+    diff_y = padded[..., 2:, :] - padded[..., :-2, :]
+    grad_y = diff_y[..., :-2] + 2 * diff_y[..., 1:-1] + diff_y[..., 2:]
+    return grad_x, grad_y
+
+
+def dilate(mask: torch.Tensor):
+    """3x3 binary dilation of a [N, 1, H, W] bool mask."""
+    padded = F.pad(mask, (1, 1, 1, 1))
+    rows = padded[..., :-2] | padded[..., 1:-1] | padded[..., 2:]
+    return rows[..., :-2, :] | rows[..., 1:-1, :] | rows[..., 2:, :]
+
+
+def canny(imgs: torch.Tensor, low_threshold: float, high_threshold: float):
+    """cv2.Canny of [N, 1, H, W] images with values in [0, 255]. Returns float edge maps of 0 and 255."""
+    if low_threshold > high_threshold:
+        low_threshold, high_threshold = high_threshold, low_threshold
+    low, high = math.floor(low_threshold), math.floor(high_threshold)
+
+    # OpenCV takes the derivatives with replicated borders
+    grad_x, grad_y = sobel(imgs.float(), padding_mode="replicate")
+    grad_x, grad_y = grad_x.to(torch.int32), grad_y.to(torch.int32)
+    magnitude = grad_x.abs() + grad_y.abs()
+
+    # non-maximum suppression along the gradient direction, with the magnitude outside the image at 0
+    padded = F.pad(magnitude, (1, 1, 1, 1))
+    height, width = magnitude.shape[-2:]
+
+    def neighbour(dy, dx):
+        return padded[..., 1 + dy : 1 + dy + height, 1 + dx : 1 + dx + width]
+
+    x = grad_x.abs()
+    y = grad_y.abs() << CANNY_SHIFT
+    tg22x = x * TG22
+    tg67x = tg22x + (x << (CANNY_SHIFT + 1))
+    horizontal = y < tg22x
+    vertical = ~horizontal & (y > tg67x)
+    diagonal = ~horizontal & ~vertical
+    # where the signs of the derivatives differ, the 45 degree neighbours are at (-1, +1) and (+1, -1)
+    anti_diagonal = (grad_x ^ grad_y) < 0
+
+    local_max = (
+        (horizontal & (magnitude > neighbour(0, -1)) & (magnitude >= neighbour(0, 1)))
+        | (vertical & (magnitude > neighbour(-1, 0)) & (magnitude >= neighbour(1, 0)))
+        | (diagonal & anti_diagonal & (magnitude > neighbour(-1, 1)) & (magnitude > neighbour(1, -1)))
+        | (diagonal & ~anti_diagonal & (magnitude > neighbour(-1, -1)) & (magnitude > neighbour(1, 1)))
+    )
+    candidates = local_max & (magnitude > low)
+    edges = candidates & (magnitude > high)
+
+    # hysteresis: grow the strong edges into 8-connected candidates until nothing changes
+    while True:
+        grown = candidates & dilate(edges)
+        if torch.equal(grown, edges):
+            break
+        edges = grown
+    return edges.float() * 255
+
+
 class GradientCorrelationMetric(Metric):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -10,32 +85,24 @@ class GradientCorrelationMetric(Metric):
 
     def update(self, imgs1: torch.Tensor, imgs2: torch.Tensor):
         assert imgs1.ndim == 4 and imgs2.ndim == 4, "Inputs must be 4D tensors"
-        assert imgs1.is_cuda and imgs2.is_cuda, "Inputs must be CUDA tensors"
+        assert imgs1.size(1) == 1 and imgs2.size(1) == 1, "Inputs must be single-channel images"
         assert imgs1.size(0) == imgs2.size(0), "Input tensors must have the same batch size"
 
-        for img1, img2 in zip(imgs1, imgs2):
-            img1 = img1.cpu().numpy().squeeze()
-            img2 = img2.cpu().numpy().squeeze()
-            
-            # Canny edge detection
-            edges1 = cv2.Canny(img1, 170, 190)
-            edges2 = cv2.Canny(img2, 30, 50)
-            
-            # Sobel gradients
-            grad_x1, grad_y1 = cv2.Sobel(edges1, cv2.CV_64F, 1, 0, ksize=3), cv2.Sobel(edges1, cv2.CV_64F, 0, 1, ksize=3)
-            grad_x2, grad_y2 = cv2.Sobel(edges2, cv2.CV_64F, 1, 0, ksize=3), cv2.Sobel(edges2, cv2.CV_64F, 0, 1, ksize=3)
-            
-            # Gradient magnitudes
-            magnitude1 = np.sqrt(grad_x1**2 + grad_y1**2)
-            magnitude2 = np.sqrt(grad_x2**2 + grad_y2**2)
-            
-            if magnitude1.size == 0 or magnitude2.size == 0 or np.std(magnitude1) == 0 or np.std(magnitude2) == 0:
-                continue
-            
-            # Compute correlation
-            correlation = np.corrcoef(magnitude1.flatten(), magnitude2.flatten())[0, 1]
-            correlation = torch.tensor(correlation, device=self.device)
-            self.correlations = torch.cat([self.correlations, correlation.unsqueeze(0)])
+        # Canny edge detection
+        edges1 = canny(imgs1, 170, 190)
+        edges2 = canny(imgs2, 30, 50)
+
+        # Gradient magnitudes of the Sobel gradients
+        magnitude1 = torch.hypot(*sobel(edges1)).flatten(1).double()
+        magnitude2 = torch.hypot(*sobel(edges2)).flatten(1).double()
+
+        # Pearson correlation per image, skipping images with a constant magnitude
+        magnitude1 = magnitude1 - magnitude1.mean(dim=1, keepdim=True)
+        magnitude2 = magnitude2 - magnitude2.mean(dim=1, keepdim=True)
+        var1, var2 = magnitude1.square().sum(dim=1), magnitude2.square().sum(dim=1)
+        valid = (var1 > 0) & (var2 > 0)
+        correlation = (magnitude1 * magnitude2).sum(dim=1) / torch.sqrt(var1 * var2)
+        self.correlations = torch.cat([self.correlations, correlation[valid].to(self.correlations.device)])
 
     def compute(self):
-        return self.correlations.mean() if self.correlations.numel() > 0 else torch.tensor(float('nan'), device=self.device)
\ No newline at end of file
+        return self.correlations.mean() if self.correlations.numel() > 0 else torch.tensor(float('nan'), device=self.device)
@@ -1,9 +1,17 @@
-import cv2
-import numpy as np
 import torch
 import torch.nn.functional as F
 from torchmetrics.metric import Metric
 
+
+def laplacian(imgs: torch.Tensor):
+    """cv2.Laplacian (ksize=1) of [N, 1, H, W] images, with the cv2.BORDER_DEFAULT (reflect 101) border."""
+    padded = F.pad(imgs, (1, 1, 1, 1), mode="reflect")
+    return (
+        padded[..., :-2, 1:-1] + padded[..., 2:, 1:-1] + padded[..., 1:-1, :-2] + padded[..., 1:-1, 2:]
+        - 4 * padded[..., 1:-1, 1:-1]
+    )
+
+
 # Check: If you define metric variables with add_state, you should not implement def reset(), sync_dist(). Because it is implemented internally in lightning.
 # https://lightning.ai/docs/torchmetrics/stable/pages/implement.html
 
@@ -14,23 +22,18 @@ class SharpnessMetric(Metric):
         # self.score_list = []
 
     def update(self, imgs: torch.Tensor):
-        # Ensure input is a 4D CUDA tensor [batch, channel, height, width]
-        assert imgs.ndim == 4 and imgs.is_cuda, "Input must be a 4D CUDA tensor"
+        # Ensure input is a 4D tensor [batch, channel, height, width]
+        assert imgs.ndim == 4, "Input must be a 4D tensor"
 
         # Convert images to grayscale by averaging across the color channels
+        imgs = imgs.float()
         if imgs.size(1) == 3:
             imgs = imgs.mean(dim=1, keepdim=True)
 
-        imgs = imgs.squeeze(1)
-
-        for i in range(imgs.size(0)):
-            img = imgs[i].cpu().numpy().astype(np.float32)
-            blur_map = cv2.Laplacian(img, cv2.CV_32F)
-            sharpness_score = np.var(blur_map)
-            sharpness_score = torch.tensor(sharpness_score, device=self.device)
-            self.scores = torch.cat([self.scores, sharpness_score.unsqueeze(0)])
-            # self.scores.append(sharpness_score)
-            # self.score_list.append(sharpness_score)
+        # Variance of the Laplacian of every image in the batch
+        blur_map = laplacian(imgs)
+        sharpness_score = blur_map.flatten(1).var(dim=1, unbiased=False)
+        self.scores = torch.cat([self.scores, sharpness_score.to(self.scores.device)])
 
     def compute(self):
         return self.scores.mean() if self.scores.numel() > 0 else torch.tensor(0.0, device=self.device)
@@ -1,3 +1,5 @@
+import time
+from contextlib import contextmanager
 from typing import Any
 import numpy as np
 
@@ -15,6 +17,8 @@ from src import utils
 
 log = utils.get_pylogger(__name__)
 
+to_rgb = lambda x: x.repeat(1, 3, 1, 1) if x.shape[1] == 1 else x
+
 class RbGModule(BaseModule_AtoB):
 
     def __init__(
@@ -36,20 +40,27 @@ class RbGModule(BaseModule_AtoB):
         self.optimizer = optimizer
         self.params = params
 
-        if self.params.nce_on_vgg: # vgg for patchNCE
-            # choose layers what you want # "conv_1_2", "conv_2_2", "conv_3_4", "conv_4_4", "conv_5_4"
-            listen_list = ["conv_4_2", "conv_5_4"] 
-            self.vgg = VGG_Model(listen_list=listen_list)
-
         # loss function
         # style_feat_layers = {"conv_4_4": 1.0} 
         # style_feat_layers = {"conv_2_2": 1.0, "conv_3_2": 1.0, "conv_4_2": 1.0}
         style_feat_layers = {"conv_1_2": 1.0, "conv_2_2": 1.0, "conv_3_2": 1.0}
-        
+        share_vgg = self.params.nce_on_vgg and params.lambda_ctx != 0 and not params.flag_occlusionCTX
+
+        if self.params.nce_on_vgg: # vgg for patchNCE
+            # choose layers what you want # "conv_1_2", "conv_2_2", "conv_3_4", "conv_4_4", "conv_5_4"
+            self.nce_layers = ["conv_4_2", "conv_5_4"]
+            # shared with the contextual loss: one VGG pass per distinct input and step (extract_vgg_features)
+            listen_list = list(style_feat_layers) + self.nce_layers if share_vgg else self.nce_layers
+            self.vgg = VGG_Model(listen_list=listen_list, channels_last=self.params.get("vgg_channels_last", False))
+
         if params.flag_occlusionCTX:
             self.criterionCTX = OcclusionContextualLoss(flow_model_path=self.params.flow_model_path) if params.lambda_ctx != 0 else None
         else:
-            self.criterionCTX = Contextual_Loss(style_feat_layers) if params.lambda_ctx != 0 else None
+            self.criterionCTX = Contextual_Loss(
+                style_feat_layers, feature_extractor=self.vgg if share_vgg else None,
+                chunk_size=self.params.get("ctx_chunk_size"),
+            ) if params.lambda_ctx != 0 else None
+        self.share_vgg = share_vgg
 
         self.criterionGAN = GANLoss(gan_type="lsgan") if params.lambda_gan != 0 else None  # gan_type = wgan, lsgan, wgangp ..
 
@@ -62,64 +73,119 @@ class RbGModule(BaseModule_AtoB):
         # PatchNCE specific initializations
         self.flip_equivariance = params.flip_equivariance
 
+    def model_step(self, batch: Any):
+        if len(batch) == 4:  # data.use_stage1_cache: frozen synthesis/registration outputs come with the batch
+            real_a, real_b, synth_img, deform_field = batch
+            fake_b = self.netG_A(real_a, real_b, synth_img=synth_img, deform_field=deform_field)
+            return real_a, real_b, fake_b
+        return super().model_step(batch)
+
+    @contextmanager
+    def loss_timer(self, name):
+        # params.log_loss_time: logs the forward time of each loss (ms) as time/<name>
+        if not self.params.get("log_loss_time", False):
+            yield
+            return
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        start = time.perf_counter()
+        yield
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        self.log(f"time/{name}", (time.perf_counter() - start) * 1000)
+
+    def extract_vgg_features(self, real_a, real_b, fake_b):
+        """VGG features of fake_b, real_b and real_a for the contextual and PatchNCE losses.
+
+        Each input goes through the shared VGG once with the union of the requested layers: fake_b with
+        gradients, the targets concatenated in a single pass without. Inputs no loss needs are skipped.
+        """
+        features = {"fake_b": dict(self.vgg(to_rgb(fake_b)))}
+
+        targets = {}
+        if self.share_vgg:
+            targets["real_b"] = real_b
+        if self.criterionNCE is not None:
+            targets["real_a"] = real_a
+        if targets:
+            with torch.no_grad():
+                target_features = self.vgg(torch.cat([to_rgb(x) for x in targets.values()]))
+            start = 0
+            for name, x in targets.items():
+                features[name] = {k: v[start : start + x.shape[0]] for k, v in target_features.items()}
+                start += x.shape[0]
+        return features
+
     def backward_G(self, real_a, real_b, fake_b):
         loss_G = 0.0
 
+        vgg_features = None
+        if self.params.nce_on_vgg and (self.share_vgg or self.criterionNCE is not None):
+            with self.loss_timer("VGG_features"):
+                vgg_features = self.extract_vgg_features(real_a, real_b, fake_b)
+
         if self.criterionCTX:
-            loss_CTX = self.criterionCTX(fake_b, real_b) * self.params.lambda_ctx
+            with self.loss_timer("CTX_Loss"):
+                if self.share_vgg:
+                    loss_CTX = self.criterionCTX(
+                        fake_b, real_b, images_feats=vgg_features["fake_b"], gt_feats=vgg_features["real_b"]
+                    ) * self.params.lambda_ctx
+                else:
+                    loss_CTX = self.criterionCTX(fake_b, real_b) * self.params.lambda_ctx
             self.log("CTX_Loss", loss_CTX.detach(), prog_bar=True)
             loss_G += loss_CTX
 
         if self.criterionGAN:
-            pred_fake = self.netD_A(fake_b)
-            loss_GAN = self.criterionGAN(pred_fake, True) * self.params.lambda_gan
+            with self.loss_timer("GAN_Loss"):
+                pred_fake = self.netD_A(fake_b)
+                loss_GAN = self.criterionGAN(pred_fake, True) * self.params.lambda_gan
             self.log("GAN_Loss", loss_GAN.detach(), prog_bar=True)
             loss_G += loss_GAN
 
         if self.criterionMIND:
-            loss_MIND = self.criterionMIND(real_a, fake_b) * self.params.lambda_mind
+            with self.loss_timer("MIND_Loss"):
+                loss_MIND = self.criterionMIND(real_a, fake_b) * self.params.lambda_mind
             self.log("MIND_Loss", loss_MIND.detach(), prog_bar=True)
             loss_G += loss_MIND
 
         if self.criterionNCE:
-            if self.params.nce_on_vgg:
-                if real_a.shape[1] == 1 and fake_b.shape[1] == 1:
-                    real_a_rgb = real_a.repeat(1, 3, 1, 1)
-                    fake_b_rgb = fake_b.repeat(1, 3, 1, 1)
-                self.vgg.to(real_a.device)
-                feat_b = self.vgg(fake_b_rgb)
-                feat_b = list(feat_b.values())
-            else:
-                feat_b = self.netG_A(real_a, fake_b, for_nce=True, for_src=False)
-
-            flipped_for_equivariance = np.random.random() < 0.5
-            if self.flip_equivariance and flipped_for_equivariance:
-                feat_b = [torch.flip(fb, [3]) for fb in feat_b]
-
-            if self.params.nce_on_vgg:
-                feat_a = feat_a = self.vgg(real_a_rgb)
-                feat_a = list(feat_a.values())
-            else:
-                feat_a = self.netG_A(real_a, real_b, for_nce=True, for_src=True)
-
-            feat_a_pool, sample_ids = self.netF_A(feat_a, 256, None)
-            feat_b_pool, _ = self.netF_A(feat_b, 256, sample_ids)
-
-            total_nce_loss = 0.0
-            for f_a, f_b in zip(feat_b_pool, feat_a_pool):
-                loss = self.criterionNCE(f_a, f_b) * self.params.lambda_nce
-                total_nce_loss += loss.mean()
-            loss_NCE = total_nce_loss / len(feat_b)
+            with self.loss_timer("NCE_Loss"):
+                loss_NCE = self.nce_loss(real_a, real_b, fake_b, vgg_features)
             self.log("NCE_Loss", loss_NCE.detach(), prog_bar=True)
             loss_G += loss_NCE
 
         if self.criterionL1:
-            loss_L1 = self.criterionL1(real_b, fake_b) * self.params.lambda_l1
+            with self.loss_timer("L1_Loss"):
+                loss_L1 = self.criterionL1(real_b, fake_b) * self.params.lambda_l1
             self.log("L1_Loss", loss_L1.detach(), prog_bar=True)
             loss_G += loss_L1
 
         return loss_G
 
+    def nce_loss(self, real_a, real_b, fake_b, vgg_features=None):
+        if self.params.nce_on_vgg:
+            feat_b = [vgg_features["fake_b"][k] for k in self.nce_layers]
+        else:
+            feat_b = self.netG_A(real_a, fake_b, for_nce=True, for_src=False)
+
+        flipped_for_equivariance = np.random.random() < 0.5
+        if self.flip_equivariance and flipped_for_equivariance:
+            feat_b = [torch.flip(fb, [3]) for fb in feat_b]
+
+        if self.params.nce_on_vgg:
+            feat_a = [vgg_features["real_a"][k] for k in self.nce_layers]
+        else:
+            feat_a = self.netG_A(real_a, real_b, for_nce=True, for_src=True)
+
+        feat_a_pool, sample_ids = self.netF_A(feat_a, 256, None)
+        feat_b_pool, _ = self.netF_A(feat_b, 256, sample_ids)
+
+        total_nce_loss = 0.0
+        for f_a, f_b in zip(feat_b_pool, feat_a_pool):
+            loss = self.criterionNCE(f_a, f_b) * self.params.lambda_nce
+            total_nce_loss += loss.mean()
+        return total_nce_loss / len(feat_b)
+
     def training_step(self, batch: Any, batch_idx: int):
         if self.params.lambda_gan != 0:
             if self.params.lambda_nce == 0:
@@ -3,6 +3,7 @@ from typing import Any, Optional
 import torch
 import torch.nn.functional as F
 from lightning import LightningModule
+from src.utils import split_sample_index
 from src.metrics.gradient_correlation import GradientCorrelationMetric
 from torchmetrics.clustering import NormalizedMutualInfoScore
 from torchmetrics.image.fid import FrechetInceptionDistance
@@ -10,6 +11,7 @@ from torchmetrics.image.kid import KernelInceptionDistance
 from src.metrics.sharpness import SharpnessMetric
 from torchmetrics.image import StructuralSimilarityIndexMeasure, PeakSignalNoiseRatio
 from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
+from src.models.components.tiled_inference import build_tiled_inference
 
 gray2rgb = lambda x: torch.cat((x, x, x), dim=1) if x.shape[1] == 1 else x
 # norm_0_to_1 = lambda x: (x + 1) / 2
@@ -20,6 +22,8 @@ class BaseModule_AtoB(LightningModule):  # single direction
     def __init__(self, params, *args: Any, **kwargs: Any):
         super().__init__()
         self.params = params
+        # sliding-window inference for validation/test/image callbacks (data.tiled_inference)
+        self.tiled_inference = build_tiled_inference(self.params.get("tiled_inference"))
 
         if self.params.eval_on_align:
             self.val_ssim_B, self.val_psnr_B, self.val_lpips_B, self.val_sharpness_B = self.define_metrics()
@@ -44,7 +48,7 @@ class BaseModule_AtoB(LightningModule):  # single direction
     def define_metrics(self):
         if self.params.eval_on_align:
             # Following Pytorch lightning metric
-            # PSNR, LPIPS: 'update', 'compute', and 'append' at each step, calculate 'mean and std' at the end of epoch
+            # PSNR, LPIPS: 'forward' at each step (per-step value stays on the device), calculate 'mean and std' at the end of epoch
             # SSIM: initialize with reduction='none', 'update' at each step, 'compute' at the end of epoch, then calculate 'mean and std'
             ssim = StructuralSimilarityIndexMeasure(reduction="none")
             psnr = PeakSignalNoiseRatio()
@@ -68,6 +72,12 @@ class BaseModule_AtoB(LightningModule):  # single direction
         fake_b = self.forward(real_a, real_b)
         return real_a, real_b, fake_b
 
+    def inference_step(self, batch: Any):
+        # model_step over overlapping tiles when data.tiled_inference.tile_size is set
+        if self.tiled_inference is None:
+            return self.model_step(batch)
+        return self.tiled_inference(self.model_step, batch)
+
     def on_train_start(self):
         # by default lightning executes validation step sanity checks before training starts,
         # so it's worth to make sure validation metrics don't store results from these checks
@@ -103,28 +113,13 @@ class BaseModule_AtoB(LightningModule):  # single direction
         return super().on_train_epoch_end()
 
     def validation_step(self, batch: Any, batch_idx: int):
-        if self.params.use_split_inference:
-            half_size = batch[0].shape[2] // 2
-            first_half = [x[:, :, :half_size, :] for x in batch]
-            second_half = [x[:, :, half_size:, :] for x in batch]
-
-            res_first_half = self.model_step(first_half)
-            res_second_half = self.model_step(second_half)
-
-            real_A = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-            real_B = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-            fake_B = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-        else: 
-            real_A, real_B, fake_B = self.model_step(batch)
+        images = self.inference_step(batch)
+        real_A, real_B, fake_B = images
 
         if self.params.eval_on_align:
             self.val_ssim_B.update(real_B, fake_B)
-            self.val_psnr_B.update(real_B, fake_B)
-            self.psnr_values_B.append(self.val_psnr_B.compute().item())
-            self.val_psnr_B.reset()
-            self.val_lpips_B.update(gray2rgb(real_B), gray2rgb(fake_B))
-            self.lpips_values_B.append(self.val_lpips_B.compute().item())
-            self.val_lpips_B.reset()
+            self.psnr_values_B.append(self.val_psnr_B(real_B, fake_B))
+            self.lpips_values_B.append(self.val_lpips_B(gray2rgb(real_B), gray2rgb(fake_B)))
             self.val_sharpness_B.update(norm_to_uint8(fake_B).float())
         else:
             self.val_gc_B.update(norm_to_uint8(real_A), norm_to_uint8(fake_B))
@@ -136,11 +131,14 @@ class BaseModule_AtoB(LightningModule):  # single direction
             self.val_kid_B.update(gray2rgb(norm_to_uint8(fake_B)), real=False)
             self.val_sharpness_B.update(norm_to_uint8(fake_B))
 
+        # reused by the image callbacks instead of running the network again
+        return {"images": images}
+
     def on_validation_epoch_end(self):
         if self.params.eval_on_align:
             ssim_B = self.val_ssim_B.compute().mean()
-            psnr_B = torch.mean(torch.tensor(self.psnr_values_B, device=self.device))
-            lpips_B = torch.mean(torch.tensor(self.lpips_values_B, device=self.device))
+            psnr_B = torch.mean(torch.stack(self.psnr_values_B))
+            lpips_B = torch.mean(torch.stack(self.lpips_values_B))
             sharpness_B = self.val_sharpness_B.compute()
 
             self.log("val/ssim_B", ssim_B.detach(), sync_dist=True)
@@ -171,29 +169,16 @@ class BaseModule_AtoB(LightningModule):  # single direction
             self.nmi_scores = []
 
     def test_step(self, batch: Any, batch_idx: int):
-        if self.params.use_split_inference:
-            half_size = batch[0].shape[2] // 2
-            first_half = [x[:, :, :half_size, :] for x in batch]
-            second_half = [x[:, :, half_size:, :] for x in batch]
-
-            res_first_half = self.model_step(first_half)
-            res_second_half = self.model_step(second_half)
-
-            real_A = torch.cat([res_first_half[0], res_second_half[0]], dim=2)
-            real_B = torch.cat([res_first_half[1], res_second_half[1]], dim=2)
-            fake_B = torch.cat([res_first_half[2], res_second_half[2]], dim=2)
-        else: 
-            real_A, real_B, fake_B = self.model_step(batch)
+        # test samples end with their dataset index (read by ImageSavingCallback from the batch)
+        batch, _ = split_sample_index(batch)
+        images = self.inference_step(batch)
+        real_A, real_B, fake_B = images
 
         if self.params.eval_on_align:
             self.test_ssim_B.update(real_B, fake_B)
-            self.test_psnr_B.update(real_B, fake_B)
-            self.psnr_values_B.append(self.test_psnr_B.compute().item())
-            self.test_psnr_B.reset()
+            self.psnr_values_B.append(self.test_psnr_B(real_B, fake_B))
             # self.test_lpips_B.update(real_B2, fake_B)
-            self.test_lpips_B.update(gray2rgb(real_B), gray2rgb(fake_B))
-            self.lpips_values_B.append(self.test_lpips_B.compute().item())
-            self.test_lpips_B.reset()
+            self.lpips_values_B.append(self.test_lpips_B(gray2rgb(real_B), gray2rgb(fake_B)))
             self.test_sharpness_B.update(norm_to_uint8(fake_B).float())
         else:
             self.test_gc_B.update(norm_to_uint8(real_A), norm_to_uint8(fake_B))
@@ -205,12 +190,15 @@ class BaseModule_AtoB(LightningModule):  # single direction
             self.test_kid_B.update(gray2rgb(norm_to_uint8(fake_B)), real=False)
             self.test_sharpness_B.update(norm_to_uint8(fake_B))
 
+        # reused by the image callbacks instead of running the network again
+        return {"images": images}
+
     def on_test_epoch_end(self):
         if self.params.eval_on_align:
 
             ssim_B = self.test_ssim_B.compute().mean()
-            psnr_B = torch.mean(torch.tensor(self.psnr_values_B, device=self.device))
-            lpips_B = torch.mean(torch.tensor(self.lpips_values_B, device=self.device))
+            psnr_B = torch.mean(torch.stack(self.psnr_values_B))
+            lpips_B = torch.mean(torch.stack(self.lpips_values_B))
             sharpness_B = self.test_sharpness_B.compute()
 
             self.log("test/ssim_B", ssim_B.detach(), sync_dist=True)
@@ -218,9 +206,9 @@ class BaseModule_AtoB(LightningModule):  # single direction
             self.log("test/lpips_B", lpips_B.detach(), sync_dist=True)
             self.log("test/sharpness_B", sharpness_B.detach(), sync_dist=True)
 
-            ssim_B_std = torch.std(torch.tensor([metric.item() for metric in self.test_ssim_B.similarity], device=self.device))
-            psnr_B_std = torch.std(torch.tensor(self.psnr_values_B, device=self.device))
-            lpips_B_std = torch.std(torch.tensor(self.lpips_values_B, device=self.device))
+            ssim_B_std = torch.std(self.test_ssim_B.compute())
+            psnr_B_std = torch.std(torch.stack(self.psnr_values_B))
+            lpips_B_std = torch.std(torch.stack(self.lpips_values_B))
             sharpness_B_std = torch.std(self.test_sharpness_B.scores)
 
             self.log("test/ssim_B_std", ssim_B_std.detach(), sync_dist=True)
@@ -3,6 +3,7 @@ from typing import Any, Optional
 import torch
 import torch.nn.functional as F
 from lightning import LightningModule
+from src.utils import split_sample_index
 from src.metrics.gradient_correlation import GradientCorrelationMetric
 from torchmetrics.clustering import NormalizedMutualInfoScore
 from torchmetrics.image.fid import FrechetInceptionDistance
@@ -54,7 +55,7 @@ class BaseModule_AtoB_BtoA(LightningModule):
     def define_metrics(self):
         if self.params.eval_on_align:
             # Following Pytorch lightning metric
-            # PSNR, LPIPS: 'update', 'compute', and 'append' at each step, calculate 'mean and std' at the end of epoch
+            # PSNR, LPIPS: 'forward' at each step (per-step value stays on the device), calculate 'mean and std' at the end of epoch
             # SSIM: initialize with reduction='none', 'update' at each step, 'compute' at the end of epoch, then calculate 'mean and std'
             ssim = StructuralSimilarityIndexMeasure(reduction="none")
             psnr = PeakSignalNoiseRatio()
@@ -151,30 +152,25 @@ class BaseModule_AtoB_BtoA(LightningModule):
     def validation_step(self, batch: Any, batch_idx: int):
         if self.params.eval_on_align:
             if len(batch) == 4: # histological dataset
-                real_A, real_B, real_A2, real_B2, fake_A, fake_B = self.model_step(batch)    
+                images = self.model_step(batch)
+                real_A, real_B, real_A2, real_B2, fake_A, fake_B = images
             else: # MR 3T 7T dataset
-                real_A2, real_B2, fake_A, fake_B = self.model_step(batch) 
+                images = self.model_step(batch)
+                real_A2, real_B2, fake_A, fake_B = images
         
             self.val_ssim_A.update(real_A2, fake_A)
-            self.val_psnr_A.update(real_A2, fake_A)
-            self.psnr_values_A.append(self.val_psnr_A.compute().item())
-            self.val_psnr_A.reset()
-            self.val_lpips_A.update(gray2rgb(real_A2), gray2rgb(fake_A))
-            self.lpips_values_A.append(self.val_lpips_A.compute().item())
-            self.val_lpips_A.reset()            
+            self.psnr_values_A.append(self.val_psnr_A(real_A2, fake_A))
+            self.lpips_values_A.append(self.val_lpips_A(gray2rgb(real_A2), gray2rgb(fake_A)))
             self.val_sharpness_A.update(norm_to_uint8(fake_A).float())
 
             self.val_ssim_B.update(real_B2, fake_B)
-            self.val_psnr_B.update(real_B2, fake_B)
-            self.psnr_values_B.append(self.val_psnr_B.compute().item())
-            self.val_psnr_B.reset()
-            self.val_lpips_B.update(gray2rgb(real_B2), gray2rgb(fake_B))
-            self.lpips_values_B.append(self.val_lpips_B.compute().item())
-            self.val_lpips_B.reset()
+            self.psnr_values_B.append(self.val_psnr_B(real_B2, fake_B))
+            self.lpips_values_B.append(self.val_lpips_B(gray2rgb(real_B2), gray2rgb(fake_B)))
             self.val_sharpness_B.update(norm_to_uint8(fake_B).float())
             
         else:
-            real_A, real_B, fake_A, fake_B = self.model_step(batch)
+            images = self.model_step(batch)
+            real_A, real_B, fake_A, fake_B = images
 
             self.val_gc_A.update(norm_to_uint8(real_B), norm_to_uint8(fake_A))
             nmi_score_A = self.val_nmi_A(flatten_to_1d(norm_to_uint8(real_B)), flatten_to_1d(norm_to_uint8(fake_A)))
@@ -190,16 +186,19 @@ class BaseModule_AtoB_BtoA(LightningModule):
             self.val_fid_B.update(gray2rgb(norm_to_uint8(fake_B)), real=False)
             self.val_sharpness_B.update(norm_to_uint8(fake_B).float())
 
+        # reused by the image callbacks instead of running the network again
+        return {"images": images}
+
     def on_validation_epoch_end(self):
         if self.params.eval_on_align:
             ssim_A = self.val_ssim_A.compute().mean()
-            psnr_A = torch.mean(torch.tensor(self.psnr_values_A, device=self.device))
-            lpips_A = torch.mean(torch.tensor(self.lpips_values_A, device=self.device))
+            psnr_A = torch.mean(torch.stack(self.psnr_values_A))
+            lpips_A = torch.mean(torch.stack(self.lpips_values_A))
             sharpness_A = self.val_sharpness_A.compute()
 
             ssim_B = self.val_ssim_B.compute().mean()
-            psnr_B = torch.mean(torch.tensor(self.psnr_values_B, device=self.device))
-            lpips_B = torch.mean(torch.tensor(self.lpips_values_B, device=self.device))
+            psnr_B = torch.mean(torch.stack(self.psnr_values_B))
+            lpips_B = torch.mean(torch.stack(self.lpips_values_B))
             sharpness_B = self.val_sharpness_B.compute()
 
             self.log("val/ssim_A", ssim_A.detach(), sync_dist=True)
@@ -246,34 +245,31 @@ class BaseModule_AtoB_BtoA(LightningModule):
             self.nmi_scores_B = []
 
     def test_step(self, batch: Any, batch_idx: int):
+        # test samples end with their dataset index (read by ImageSavingCallback from the batch)
+        batch, _ = split_sample_index(batch)
         if self.params.eval_on_align:
             if len(batch) == 4:
-                real_A, real_B, real_A2, real_B2, fake_A, fake_B = self.model_step(batch)    
+                images = self.model_step(batch)
+                real_A, real_B, real_A2, real_B2, fake_A, fake_B = images
             else:
-                real_A2, real_B2, fake_A, fake_B = self.model_step(batch) 
+                images = self.model_step(batch)
+                real_A2, real_B2, fake_A, fake_B = images
 
             self.test_ssim_A.update(real_A2, fake_A)
-            self.test_psnr_A.update(real_A2, fake_A)
-            self.psnr_values_A.append(self.test_psnr_A.compute().item())
-            self.test_psnr_A.reset()
+            self.psnr_values_A.append(self.test_psnr_A(real_A2, fake_A))
             # self.test_lpips_A.update(real_A2, fake_A)
-            self.test_lpips_A.update(gray2rgb(real_A2), gray2rgb(fake_A))
-            self.lpips_values_A.append(self.test_lpips_A.compute().item())
-            self.test_lpips_A.reset()
+            self.lpips_values_A.append(self.test_lpips_A(gray2rgb(real_A2), gray2rgb(fake_A)))
             self.test_sharpness_A.update(norm_to_uint8(fake_A).float())
 
             self.test_ssim_B.update(real_B2, fake_B)
-            self.test_psnr_B.update(real_B2, fake_B)
-            self.psnr_values_B.append(self.test_psnr_B.compute().item())
-            self.test_psnr_B.reset()
+            self.psnr_values_B.append(self.test_psnr_B(real_B2, fake_B))
             # self.test_lpips_B.update(real_B2, fake_B)
-            self.test_lpips_B.update(gray2rgb(real_B2), gray2rgb(fake_B))
-            self.lpips_values_B.append(self.test_lpips_B.compute().item())
-            self.test_lpips_B.reset()
+            self.lpips_values_B.append(self.test_lpips_B(gray2rgb(real_B2), gray2rgb(fake_B)))
             self.test_sharpness_B.update(norm_to_uint8(fake_B).float())
 
         else:
-            real_A, real_B, fake_A, fake_B = self.model_step(batch)
+            images = self.model_step(batch)
+            real_A, real_B, fake_A, fake_B = images
 
             self.test_gc_A.update(norm_to_uint8(real_B), norm_to_uint8(fake_A))
             nmi_score_A = self.test_nmi_A(flatten_to_1d(norm_to_uint8(real_B)), flatten_to_1d(norm_to_uint8(fake_A)))
@@ -289,17 +285,19 @@ class BaseModule_AtoB_BtoA(LightningModule):
             self.test_fid_B.update(gray2rgb(norm_to_uint8(fake_B)), real=False)
             self.test_sharpness_B.update(norm_to_uint8(fake_B))
 
+        # reused by the image callbacks instead of running the network again
+        return {"images": images}
 
     def on_test_epoch_end(self):
         if self.params.eval_on_align:
             ssim_A = self.test_ssim_A.compute().mean()
-            psnr_A = torch.mean(torch.tensor(self.psnr_values_A, device=self.device))
-            lpips_A = torch.mean(torch.tensor(self.lpips_values_A, device=self.device))
+            psnr_A = torch.mean(torch.stack(self.psnr_values_A))
+            lpips_A = torch.mean(torch.stack(self.lpips_values_A))
             sharpness_A = self.test_sharpness_A.compute()
 
             ssim_B = self.test_ssim_B.compute().mean()
-            psnr_B = torch.mean(torch.tensor(self.psnr_values_B, device=self.device))
-            lpips_B = torch.mean(torch.tensor(self.lpips_values_B, device=self.device))
+            psnr_B = torch.mean(torch.stack(self.psnr_values_B))
+            lpips_B = torch.mean(torch.stack(self.lpips_values_B))
             sharpness_B = self.test_sharpness_B.compute()
 
             self.log("test/ssim_A", ssim_A.detach(), sync_dist=True)
@@ -312,14 +310,14 @@ class BaseModule_AtoB_BtoA(LightningModule):
             self.log("test/lpips_B", lpips_B.detach(), sync_dist=True)
             self.log("test/sharpness_B", sharpness_B.detach(), sync_dist=True)
 
-            ssim_A_std = torch.std(torch.tensor([metric.item() for metric in self.test_ssim_A.similarity], device=self.device))
-            psnr_A_std = torch.std(torch.tensor(self.psnr_values_A, device=self.device))
-            lpips_A_std = torch.std(torch.tensor(self.lpips_values_A, device=self.device))
+            ssim_A_std = torch.std(self.test_ssim_A.compute())
+            psnr_A_std = torch.std(torch.stack(self.psnr_values_A))
+            lpips_A_std = torch.std(torch.stack(self.lpips_values_A))
             sharpness_A_std = torch.std(self.test_sharpness_A.scores)
 
-            ssim_B_std = torch.std(torch.tensor([metric.item() for metric in self.test_ssim_B.similarity], device=self.device))
-            psnr_B_std = torch.std(torch.tensor(self.psnr_values_B, device=self.device))
-            lpips_B_std = torch.std(torch.tensor(self.lpips_values_B, device=self.device))
+            ssim_B_std = torch.std(self.test_ssim_B.compute())
+            psnr_B_std = torch.std(torch.stack(self.psnr_values_B))
+            lpips_B_std = torch.std(torch.stack(self.lpips_values_B))
             sharpness_B_std = torch.std(self.test_sharpness_B.scores)
 
             self.log("test/ssim_A_std", ssim_A_std.detach(), sync_dist=True)
@@ -3,10 +3,11 @@ from typing import Any, Optional
 import torch
 import torch.nn.functional as F
 from lightning import LightningModule
+from src.utils import split_sample_index
 from src.metrics.gradient_correlation import GradientCorrelationMetric
-from torchmetrics.clustering import NormalizedMutualInfoScore
 from torchmetrics.image.fid import FrechetInceptionDistance
 from torchmetrics.image.kid import KernelInceptionDistance
+from src.metrics.mutual_info import normalized_mutual_info
 from src.metrics.sharpness import SharpnessMetric
 from torchmetrics import MeanSquaredError
 
@@ -14,30 +15,31 @@ gray2rgb = lambda x: torch.cat((x, x, x), dim=1)
 # norm_0_to_1 = lambda x: (x + 1) / 2
 flatten_to_1d = lambda x: x.view(-1)
 norm_to_uint8 = lambda x: ((x + 1) / 2 * 255).to(torch.uint8)
+# B x C x H x W x D -> (D*B) x C x H x W, slice by slice
+slices_to_batch = lambda x: x.permute(4, 0, 1, 2, 3).reshape(-1, *x.shape[1:4])
 
 class BaseModule_Registration(LightningModule):  # single direction
     def __init__(self, params, *args: Any, **kwargs: Any):
         super().__init__()
         self.params = params
 
-        self.val_gc_B, self.val_nmi_B, self.val_fid_B, self.val_kid_B, self.val_sharpness_B, self.val_l2_B = self.define_metrics()
-        self.test_gc_B, self.test_nmi_B, self.test_fid_B, self.test_kid_B, self.test_sharpness_B, self.test_l2_B = self.define_metrics()
+        self.val_gc_B, self.val_fid_B, self.val_kid_B, self.val_sharpness_B, self.val_l2_B = self.define_metrics()
+        self.test_gc_B, self.test_fid_B, self.test_kid_B, self.test_sharpness_B, self.test_l2_B = self.define_metrics()
 
-        self.val_metrics = [self.val_gc_B, self.val_nmi_B, self.val_fid_B, self.val_kid_B, self.val_sharpness_B, self.val_l2_B]
-        self.test_metrics = [self.test_gc_B, self.test_nmi_B, self.test_fid_B, self.test_kid_B, self.test_sharpness_B, self.test_l2_B]
+        self.val_metrics = [self.val_gc_B, self.val_fid_B, self.val_kid_B, self.val_sharpness_B, self.val_l2_B]
+        self.test_metrics = [self.test_gc_B, self.test_fid_B, self.test_kid_B, self.test_sharpness_B, self.test_l2_B]
 
         self.nmi_scores = []
 
     @staticmethod
     def define_metrics():
         gc = GradientCorrelationMetric()
-        nmi = NormalizedMutualInfoScore()
         fid = FrechetInceptionDistance()
         kid = KernelInceptionDistance(subset_size=2)
         sharpness = SharpnessMetric()
         l2 = MeanSquaredError()
 
-        return gc, nmi, fid, kid, sharpness, l2
+        return gc, fid, kid, sharpness, l2
 
     # def forward(self, a: torch.Tensor, b: torch.Tensor):
     #     return self.netG_A(a, b)
@@ -81,36 +83,51 @@ class BaseModule_Registration(LightningModule):  # single direction
     def on_train_epoch_end(self):
         return super().on_train_epoch_end()
 
+    def update_metrics(self, gc, fid, kid, sharpness, l2, evaluation_img, moving_img, fixed_img, warped_img, num_slices=1):
+        """Updates the metrics with one [N, C, H, W] batch of each image.
+
+        For 3D batches the N images are num_slices groups of batch images, slice by slice (slices_to_batch),
+        and NMI is scored per group, i.e. per slice over the whole batch.
+        """
+        evaluation_uint8, moving_uint8, warped_uint8 = norm_to_uint8(evaluation_img), norm_to_uint8(moving_img), norm_to_uint8(warped_img)
+
+        gc.update(evaluation_uint8, warped_uint8)
+        self.nmi_scores.append(
+            normalized_mutual_info(evaluation_uint8.reshape(num_slices, -1), warped_uint8.reshape(num_slices, -1))
+        )
+        fid.update(gray2rgb(moving_uint8), real=True)
+        fid.update(gray2rgb(warped_uint8), real=False)
+        kid.update(gray2rgb(moving_uint8), real=True)
+        kid.update(gray2rgb(warped_uint8), real=False)
+        sharpness.update(warped_uint8)
+        l2.update(fixed_img, warped_img)
+
     def validation_step(self, batch: Any, batch_idx: int):
-        evaluation_img, moving_img, fixed_img, warped_img = self.model_step(batch, is_3d=self.params.is_3d) # MR, CT, syn_CT, _
+        images = self.model_step(batch, is_3d=self.params.is_3d)
+        evaluation_img, moving_img, fixed_img, warped_img = images # MR, CT, syn_CT, _
         
         if len(evaluation_img.size()) == 5: # B x C x H x W x D (3D image)
-            for i in range(evaluation_img.size(4)):  # slice dim
-                self.val_gc_B.update(norm_to_uint8(evaluation_img[:, :, :, :, i]), norm_to_uint8(warped_img[:, :, :, :, i]))
-                nmi_score = self.val_nmi_B(flatten_to_1d(norm_to_uint8(evaluation_img[:, :, :, :, i])), flatten_to_1d(norm_to_uint8(warped_img[:, :, :, :, i])))
-                self.nmi_scores.append(nmi_score)
-                self.val_fid_B.update(gray2rgb(norm_to_uint8(moving_img[:, :, :, :, i])), real=True)
-                self.val_fid_B.update(gray2rgb(norm_to_uint8(warped_img[:, :, :, :, i])), real=False)
-                self.val_kid_B.update(gray2rgb(norm_to_uint8(moving_img[:, :, :, :, i])), real=True)
-                self.val_kid_B.update(gray2rgb(norm_to_uint8(warped_img[:, :, :, :, i])), real=False)
-                self.val_sharpness_B.update(norm_to_uint8(warped_img[:, :, :, :, i]))
-                self.val_l2_B.update(fixed_img[:, :, :, :, i], warped_img[:, :, :, :, i])
+            # slices folded into the batch, metric_chunk_size slices per metric update
+            chunk_size = self.params.get("metric_chunk_size", 32)
+            for start in range(0, evaluation_img.size(4), chunk_size):
+                chunk = [slices_to_batch(img[..., start : start + chunk_size]) for img in images]
+                self.update_metrics(
+                    self.val_gc_B, self.val_fid_B, self.val_kid_B, self.val_sharpness_B, self.val_l2_B,
+                    *chunk, num_slices=min(chunk_size, evaluation_img.size(4) - start),
+                )
         elif len(evaluation_img.size()) == 4: # 2D image)
-            self.val_gc_B.update(norm_to_uint8(evaluation_img), norm_to_uint8(warped_img))
-            nmi_score = self.val_nmi_B(flatten_to_1d(norm_to_uint8(evaluation_img)), flatten_to_1d(norm_to_uint8(warped_img)))
-            self.nmi_scores.append(nmi_score)
-            self.val_fid_B.update(gray2rgb(norm_to_uint8(moving_img)), real=True)
-            self.val_fid_B.update(gray2rgb(norm_to_uint8(warped_img)), real=False)
-            self.val_kid_B.update(gray2rgb(norm_to_uint8(moving_img)), real=True)
-            self.val_kid_B.update(gray2rgb(norm_to_uint8(warped_img)), real=False)
-            self.val_sharpness_B.update(norm_to_uint8(warped_img))
-            self.val_l2_B.update(fixed_img, warped_img)
+            self.update_metrics(
+                self.val_gc_B, self.val_fid_B, self.val_kid_B, self.val_sharpness_B, self.val_l2_B, *images
+            )
         else:
             ValueError(f"Unexpected number of dimensions in Image: {len(evaluation_img.size())}. Expected 4 or 5.")
 
+        # reused by the image callbacks instead of running the network again
+        return {"images": images}
+
     def on_validation_epoch_end(self):
         gc = self.val_gc_B.compute()
-        nmi = torch.mean(torch.stack(self.nmi_scores))
+        nmi = torch.mean(torch.cat(self.nmi_scores))
         fid = self.val_fid_B.compute()
         kid_mean, _ = self.val_kid_B.compute()
         sharpness = self.val_sharpness_B.compute()
@@ -128,36 +145,33 @@ class BaseModule_Registration(LightningModule):  # single direction
         self.nmi_scores = []
 
     def test_step(self, batch: Any, batch_idx: int):
-
-        evaluation_img, moving_img, fixed_img, warped_img = self.model_step(batch, is_3d=self.params.is_3d) # MR, CT, syn_CT, _
+        # test samples end with their dataset index (read by ImageSavingCallback from the batch)
+        batch, _ = split_sample_index(batch)
+        images = self.model_step(batch, is_3d=self.params.is_3d)
+        evaluation_img, moving_img, fixed_img, warped_img = images # MR, CT, syn_CT, _
         
         if len(evaluation_img.size()) == 5:
-            for i in range(evaluation_img.size(4)):  # slice dim
-                self.test_gc_B.update(norm_to_uint8(evaluation_img[:, :, :, :, i]), norm_to_uint8(warped_img[:, :, :, :, i]))
-                nmi_score = self.test_nmi_B(flatten_to_1d(norm_to_uint8(evaluation_img[:, :, :, :, i])), flatten_to_1d(norm_to_uint8(warped_img[:, :, :, :, i])))
-                self.nmi_scores.append(nmi_score)
-                self.test_fid_B.update(gray2rgb(norm_to_uint8(moving_img[:, :, :, :, i])), real=True)
-                self.test_fid_B.update(gray2rgb(norm_to_uint8(warped_img[:, :, :, :, i])), real=False)
-                self.test_kid_B.update(gray2rgb(norm_to_uint8(moving_img[:, :, :, :, i])), real=True)
-                self.test_kid_B.update(gray2rgb(norm_to_uint8(warped_img[:, :, :, :, i])), real=False)
-                self.test_sharpness_B.update(norm_to_uint8(warped_img[:, :, :, :, i]))
-                self.test_l2_B.update(fixed_img[:, :, :, :, i], warped_img[:, :, :, :, i])
+            # slices folded into the batch, metric_chunk_size slices per metric update
+            chunk_size = self.params.get("metric_chunk_size", 32)
+            for start in range(0, evaluation_img.size(4), chunk_size):
+                chunk = [slices_to_batch(img[..., start : start + chunk_size]) for img in images]
+                self.update_metrics(
+                    self.test_gc_B, self.test_fid_B, self.test_kid_B, self.test_sharpness_B, self.test_l2_B,
+                    *chunk, num_slices=min(chunk_size, evaluation_img.size(4) - start),
+                )
         elif len(evaluation_img.size()) == 4: # 4D tensor
-            self.test_gc_B.update(norm_to_uint8(evaluation_img), norm_to_uint8(warped_img))
-            nmi_score = self.test_nmi_B(flatten_to_1d(norm_to_uint8(evaluation_img)), flatten_to_1d(norm_to_uint8(warped_img)))
-            self.nmi_scores.append(nmi_score)
-            self.test_fid_B.update(gray2rgb(norm_to_uint8(moving_img)), real=True)
-            self.test_fid_B.update(gray2rgb(norm_to_uint8(warped_img)), real=False)
-            self.test_kid_B.update(gray2rgb(norm_to_uint8(moving_img)), real=True)
-            self.test_kid_B.update(gray2rgb(norm_to_uint8(warped_img)), real=False)
-            self.test_sharpness_B.update(norm_to_uint8(warped_img))
-            self.test_l2_B.update(fixed_img, warped_img)
+            self.update_metrics(
+                self.test_gc_B, self.test_fid_B, self.test_kid_B, self.test_sharpness_B, self.test_l2_B, *images
+            )
         else:
             raise ValueError(f"Unexpected number of dimensions in evaluation_img: {len(evaluation_img.size())}. Expected 4 or 5.")
 
+        # reused by the image callbacks instead of running the network again
+        return {"images": images}
+
     def on_test_epoch_end(self):
         gc = self.test_gc_B.compute()
-        nmi = torch.mean(torch.stack(self.nmi_scores))
+        nmi = torch.mean(torch.cat(self.nmi_scores))
         fid = self.test_fid_B.compute()
         kid_mean, kid_std = self.test_kid_B.compute()
         sharpness = self.test_sharpness_B.compute()
@@ -171,7 +185,7 @@ class BaseModule_Registration(LightningModule):  # single direction
         self.log("test/l2_B", l2.detach(), sync_dist=True)
 
         gc_std = torch.std(self.test_gc_B.correlations)
-        nmi_std = torch.std(torch.stack(self.nmi_scores))
+        nmi_std = torch.std(torch.cat(self.nmi_scores))
         sharpness_std = torch.std(self.test_sharpness_B.scores)
 
         self.log("test/gc_B_std", gc_std.detach(), sync_dist=True)
@@ -1,3 +1,5 @@
+import functools
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -11,6 +13,7 @@ class PAdaINSynthesisModule(nn.Module):
             self.feat_ch = kwargs['feat_ch']
             self.output_nc = kwargs['output_nc']
             self.demodulate = kwargs['demodulate']
+            self.block_modulation = kwargs.get('block_modulation', False)
 
         except KeyError as e:
             raise ValueError(f"Missing required parameter: {str(e)}")
@@ -25,29 +28,29 @@ class PAdaINSynthesisModule(nn.Module):
         )
         
         self.conv0 = StyleConv(self.input_nc, self.feat_ch, kernel_size=3,
-                                                 activate=True, demodulate=self.demodulate)
+                                                 activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv11 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                downsample=True, activate=True, demodulate=self.demodulate)
+                                downsample=True, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv12 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                downsample=False, activate=True, demodulate=self.demodulate)
+                                downsample=False, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv21 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                downsample=True, activate=True, demodulate=self.demodulate)
+                                downsample=True, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv22 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                downsample=False, activate=True, demodulate=self.demodulate)
+                                downsample=False, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv31 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                downsample=False, activate=True, demodulate=self.demodulate)
+                                downsample=False, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv32 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                downsample=False, activate=True, demodulate=self.demodulate)
+                                downsample=False, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv41 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3, 
-                                upsample=True, activate=True, demodulate=self.demodulate)
+                                upsample=True, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv42 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                upsample=False, activate=True, demodulate=self.demodulate)
+                                upsample=False, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv51 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                upsample=True, activate=True, demodulate=self.demodulate)
+                                upsample=True, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv52 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                upsample=False, activate=True, demodulate=self.demodulate)
+                                upsample=False, activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
         self.conv6 = StyleConv(self.feat_ch, self.feat_ch, kernel_size=3,
-                                activate=True, demodulate=self.demodulate)
+                                activate=True, demodulate=self.demodulate, block_modulation=self.block_modulation)
 
 
         self.conv_final = nn.Conv2d(self.feat_ch, self.output_nc, kernel_size=3, padding=1)
@@ -102,6 +105,7 @@ class StyleConv(nn.Module):
                 #  blur_kernel=[1, 3, 3, 1],
                  demodulate=True,
                  style_denorm=True,
+                 block_modulation=False,
                  eps=1e-8,):
         super(StyleConv, self).__init__()
         self.eps = eps
@@ -114,6 +118,8 @@ class StyleConv(nn.Module):
         self.kernel_size = kernel_size
         self.padding = kernel_size // 2
         self.style_denorm = style_denorm
+        # Compute gamma/beta once per distinct neighbourhood of the upsampled style instead of per pixel
+        self.block_modulation = block_modulation
 
         if self.upsample:
             factor = 2
@@ -183,11 +189,7 @@ class StyleConv(nn.Module):
         x = x + noise
         
         if self.style_denorm:
-            style = F.interpolate(style, size=x.size()[2:], mode='nearest') 
-            
-            actv = self.mlp_shared(style)
-            gamma = self.mlp_gamma(actv)
-            beta = self.mlp_beta(actv)
+            gamma, beta = self.modulation(style, x.size()[2:])
 
             x = x * gamma + beta
         
@@ -195,6 +197,65 @@ class StyleConv(nn.Module):
         if self.activate:
             x = self.activation(x)
         return x
+
+    def modulation(self, style, size):
+        if self.block_modulation:
+            taps = block_taps(tuple(size), tuple(style.size()[2:]), style.device)
+            # only worth it while the feature map has more pixels than distinct neighbourhoods
+            if taps is not None:
+                return self.block_modulation_maps(style, *taps)
+
+        style = F.interpolate(style, size=size, mode='nearest') 
+        actv = self.mlp_shared(style)
+        return self.mlp_gamma(actv), self.mlp_beta(actv)
+
+    def block_modulation_maps(self, style, shared_rows, shared_cols, modulation_rows, modulation_cols, rows, cols):
+        """Exact gamma/beta of the nearest-upsampled style, evaluated once per distinct neighbourhood.
+
+        The two 3x3 convs run with stride 3 on tiles gathered from the guidance (then from the
+        compact activations), one tile per distinct row/column neighbourhood; index -1 picks the
+        zero padding appended to each input. See block_taps.
+        """
+        shared = self.mlp_shared[0]
+        tiles = F.pad(style, (0, 1, 0, 1))[:, :, shared_rows.flatten()][..., shared_cols.flatten()]
+        actv = self.mlp_shared[1](F.conv2d(tiles, shared.weight, shared.bias, stride=3))
+
+        weight = torch.cat([self.mlp_gamma.weight, self.mlp_beta.weight])
+        bias = torch.cat([self.mlp_gamma.bias, self.mlp_beta.bias])
+        tiles = F.pad(actv, (0, 1, 0, 1))[:, :, modulation_rows.flatten()][..., modulation_cols.flatten()]
+        modulation = F.conv2d(tiles, weight, bias, stride=3)
+        modulation = modulation[:, :, rows][..., cols]
+        return modulation.split(self.feat_ch, dim=1)
+
+
+@functools.lru_cache(maxsize=32)
+def block_taps(size, guidance_size, device):
+    """Tap indices of StyleConv.block_modulation_maps for features of size (H, W) and a guidance of guidance_size.
+
+    Built on `device` and cached per (size, guidance_size, device).
+
+    Along each axis, a feature row sees the guidance rows of its 3 neighbours through mlp_shared, and
+    the activation rows of its 3 neighbours through mlp_gamma/mlp_beta, so its output only depends
+    on the guidance rows of its 5 neighbours: block interiors share one value and only the 2-pixel
+    bands at block edges differ. Per axis, returns the distinct 3-tap windows of guidance rows, the
+    distinct 3-tap windows into those, and the window of every feature row (-1 = zero padding), as
+    (shared_rows, shared_cols, modulation_rows, modulation_cols, rows, cols). Returns None when this
+    is not smaller than the feature map.
+    """
+    shared, modulation, feature_windows = [], [], []
+    for length, guidance_length in zip(size, guidance_size):
+        # guidance row of every feature row, as picked by F.interpolate(mode='nearest')
+        rows = torch.arange(guidance_length, dtype=torch.float32, device=device).view(1, 1, -1, 1)
+        rows = F.interpolate(rows, size=(length, 1), mode='nearest').view(-1).long()
+        for taps in (shared, modulation):
+            windows = F.pad(rows, (1, 1), value=-1).unfold(0, 3, 1)
+            window_taps, rows = torch.unique(windows, dim=0, return_inverse=True)
+            taps.append(window_taps)
+        feature_windows.append(rows)
+
+    if len(modulation[0]) * len(modulation[1]) >= size[0] * size[1]:
+        return None
+    return (*shared, *modulation, *feature_windows)
     
     
 class Blur(nn.Module):
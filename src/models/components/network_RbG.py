@@ -1,12 +1,16 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+import functools
 import math
 import os
-import copy
 
 
 class RbG_framework(nn.Module):
+    # Submodules loaded from Stage-1 / registration checkpoints (never re-initialized by define_G)
+    pretrained_modules = ("regist_net", "synth_net", "synth_net_a", "synth_net_b")
+
     def __init__(self, **kwargs):
         super().__init__()
         try:
@@ -17,11 +21,13 @@ class RbG_framework(nn.Module):
             self.num_head = kwargs['num_head']
             self.mlp_ratio = kwargs['mlp_ratio']
             self.p_size = kwargs['p_size']
+            self.attn_chunk_size = kwargs.get('attn_chunk_size', None)
             self.main_train = kwargs['main_train']
             self.synth_train = kwargs['synth_train']
             self.synth_type = kwargs['synth_type']
             self.synth_path = kwargs['synth_path']
             self.synth_feat = kwargs['synth_feat']
+            self.synth_block_modulation = kwargs.get('synth_block_modulation', False)
             self.regist_train = kwargs['regist_train']
             self.regist_type = kwargs['regist_type']
             self.regist_path = kwargs['regist_path']
@@ -39,7 +45,7 @@ class RbG_framework(nn.Module):
         ## Define Registration Network (R)
         if self.regist_type == "voxelmorph_original" or self.regist_type == "zero":
             from src.models.components.network_voxelmorph_original import VxmDense
-            self.regist_net = VxmDense(inshape=self.regist_size,
+            self.regist_net = VxmDense(inshape=self.regist_size or (768, 576),  # only ndims is used
                                            nb_unet_features=[[16, 32, 32, 32], [32, 32, 32, 32, 32, 16, 16]],
                                            nb_unet_levels=None,
                                            unet_feat_mult=1,
@@ -56,9 +62,6 @@ class RbG_framework(nn.Module):
             adjusted_state_dict = {k.replace("netR_A.", ""): v for k, v in model_state_dict.items()}
             self.regist_net.load_state_dict(adjusted_state_dict, strict=False)
             self.regist_net.eval()
-
-            # Use deepcopy to prevent overwriting Lightning model weights
-            self._regist_net_backup_weights = copy.deepcopy(self.regist_net.state_dict()) 
         else:
             raise ValueError(f"Unrecognized regist type: {self.regist_type}.")
 
@@ -85,20 +88,20 @@ class RbG_framework(nn.Module):
             self.synth_net_b.load_state_dict(adjusted_state_dict, strict=False)
             self.synth_net_b.eval()
 
-            self._synth_net_a_backup_weights = copy.deepcopy(self.synth_net_a.state_dict()) 
-            self._synth_net_b_backup_weights = copy.deepcopy(self.synth_net_b.state_dict()) 
-
         elif self.synth_type == "padain_synthesis":
             from src.models.components.network_PAdaIN_synthesis import PAdaINSynthesisModule
-            self.synth_net = PAdaINSynthesisModule(input_nc=1, feat_ch=256, output_nc=1, demodulate=True)
+            self.synth_net = PAdaINSynthesisModule(input_nc=1, feat_ch=256, output_nc=1, demodulate=True,
+                                                   block_modulation=self.synth_block_modulation)
             checkpoint = torch.load(self.synth_path, map_location=lambda storage, loc: storage)
             model_state_dict = checkpoint["state_dict"]
             adjusted_state_dict = {k.replace("netG_A.", ""): v for k, v in model_state_dict.items()}
             self.synth_net.load_state_dict(adjusted_state_dict, strict=False)
             self.synth_net.eval()
 
-            # Use deepcopy to prevent overwriting Lightning model weights
-            self._synth_net_backup_weights = copy.deepcopy(self.synth_net.state_dict()) 
+        for name in ("synth_net", "synth_net_a", "synth_net_b"):
+            if hasattr(self, name):
+                for param in getattr(self, name).parameters():
+                    param.requires_grad = self.synth_train
 
         ## Define FE1, FE2 (Feature Extractor) (= Net1, Net2)
         self.FE1 = UNet(self.in_ch * 2, self.feat_dim, self.feat_dim)
@@ -112,18 +115,21 @@ class RbG_framework(nn.Module):
                     self.num_head,
                     self.mlp_ratio,
                     self.p_size,
+                    self.attn_chunk_size,
                 ),
                 Transformer(
                     self.feat_dim,
                     self.num_head,
                     self.mlp_ratio,
                     self.p_size,
+                    self.attn_chunk_size,
                 ),
                 Transformer(
                     self.feat_dim,
                     self.num_head,
                     self.mlp_ratio,
                     self.p_size,
+                    self.attn_chunk_size,
                 ),
             ]
         )
@@ -150,67 +156,92 @@ class RbG_framework(nn.Module):
                 if "regist_net" not in key and "synth_net" not in key:
                     param.requires_grad = True
 
-    def forward(self, input_img, ref_img):
-        assert (
-            input_img.shape == ref_img.shape
-        ), "Shapes of source and reference images \
-                                        mismatch."
-        device = input_img.device
-        self.regist_net.to(device)
+    @property
+    def frozen_modules(self):
+        """Names of the pretrained submodules that are kept frozen (no grad, always in eval mode)."""
+        frozen = []
+        if not self.regist_train:
+            frozen.append("regist_net")
+        if not self.synth_train:
+            frozen += [name for name in ("synth_net", "synth_net_a", "synth_net_b") if hasattr(self, name)]
+        return frozen
+
+    def train(self, mode=True):
+        # Lightning calls model.train() every epoch; frozen submodules must stay in eval mode
+        super().train(mode)
+        for name in self.frozen_modules:
+            getattr(self, name).eval()
+        return self
+
+    def stage1(self, input_img, ref_img):
+        """Runs the synthesis and registration networks. Returns (synth_img, deform_field)."""
         moved = None
 
         ## Getting Initial Output (= Synth-CT) (Stage1)
-        if self.synth_type == "munit":
-            self.synth_net_a.load_state_dict(self._synth_net_a_backup_weights)
-            self.synth_net_b.load_state_dict(self._synth_net_b_backup_weights)
-
-            c_input, s_input = self.synth_net_a.encode(input_img)
-            c_ref, s_ref = self.synth_net_b.encode(ref_img)
-            synth_img = self.synth_net_b.decode(c_input, s_ref)
-
-        elif self.synth_type == "padain_synthesis":
-            self.synth_net.load_state_dict(self._synth_net_backup_weights)
+        with torch.set_grad_enabled(self.synth_train and torch.is_grad_enabled()):
+            if self.synth_type == "munit":
+                c_input, s_input = self.synth_net_a.encode(input_img)
+                c_ref, s_ref = self.synth_net_b.encode(ref_img)
+                synth_img = self.synth_net_b.decode(c_input, s_ref)
 
-            synth_img = self.synth_net(input_img, ref_img, encode_only=False)
+            elif self.synth_type == "padain_synthesis":
+                synth_img = self.synth_net(input_img, ref_img, encode_only=False)
 
-        else:
-            raise ValueError(
-                "Invalid synth_type provided. Expected 'munit' or 'padain_synthesis'."
-            )
+            else:
+                raise ValueError(
+                    "Invalid synth_type provided. Expected 'munit' or 'padain_synthesis'."
+                )
 
-        height_multiple = self.regist_size[0] if self.regist_size else 768
-        width_multiple = self.regist_size[1] if self.regist_size else 576
+        # Registration runs at native resolution, padded only to the UNet stride
+        height_multiple = width_multiple = self.regist_net.shape_multiple
 
         ## Getting Deformation field (phi)
         if self.regist_type == "voxelmorph_original":
-            if not self.regist_train:
-                self.regist_net.load_state_dict(self._regist_net_backup_weights)
-
             if self.synth_type in ["munit", "padain_synthesis"]:
                 synth_img, moving_padding = self.pad_tensor_to_multiple(synth_img, height_multiple=height_multiple, width_multiple=width_multiple)
                 ref_img, fixed_padding = self.pad_tensor_to_multiple(ref_img, height_multiple=height_multiple, width_multiple=width_multiple)
-                
-                moved, deform_field = self.regist_net(synth_img, ref_img, registration=True) 
+
+                with torch.set_grad_enabled(self.regist_train and torch.is_grad_enabled()):
+                    moved, deform_field = self.regist_net(synth_img, ref_img, registration=True)
 
                 moved = self.crop_tensor_to_original(moved, fixed_padding)
                 synth_img = self.crop_tensor_to_original(synth_img, fixed_padding)
-                ref_img = self.crop_tensor_to_original(ref_img, fixed_padding)
                 deform_field = self.crop_tensor_to_original(deform_field, fixed_padding)
     
             else:
                 raise ValueError("Invalid synth_type")
 
+        return synth_img, deform_field
+
+    def forward(self, input_img, ref_img, synth_img=None, deform_field=None):
+        assert (
+            input_img.shape == ref_img.shape
+        ), "Shapes of source and reference images \
+                                        mismatch."
+
+        # synth_img / deform_field can be precomputed offline (src/precompute_stage1.py) when both nets are frozen
+        if synth_img is None or deform_field is None:
+            synth_img, deform_field = self.stage1(input_img, ref_img)
+
         ## FE1, FE2 (Feature Extractor) (= Net1, Net2)
         input_synth_cat = torch.cat((input_img, synth_img), dim=1)
         F_input_synth_cat = self.FE1(input_synth_cat)
         F_ref = self.FE2(ref_img)
 
         ## DACA block
+        # the per-scale sampling grids are shared by key and value of each block
+        sampling_grids = deformation_grids(
+            deform_field, [F_input_synth_cat[i + 3].shape[-2:] for i in range(3)], self.p_size
+        )
         outputs = []
         for i in range(3):
             outputs.append(
                 self.DACA_block[i](
-                    F_input_synth_cat[i + 3], F_ref[i + 3], F_ref[i + 3], deform_field
+                    F_input_synth_cat[i + 3],
+                    F_ref[i + 3],
+                    F_ref[i + 3],
+                    deform_field,
+                    sampling_grid=sampling_grids[tuple(F_input_synth_cat[i + 3].shape[-2:])],
                 )
             )
 
@@ -434,18 +465,20 @@ class Transformer(nn.Module):
         num_head=8,
         mlp_ratio=2,
         p_size=5,
+        attn_chunk_size=None,
     ):
         super().__init__()
         self.feat_dim = feat_dim
 
-        self.attention = MultiHeadAttention(feat_dim, num_head, p_size=p_size)
+        self.attention = MultiHeadAttention(feat_dim, num_head, p_size=p_size, chunk_size=attn_chunk_size)
 
         mlp_hidden_dim = int(feat_dim * mlp_ratio)
         self.mlp = MLP(in_features=feat_dim, hidden_features=mlp_hidden_dim)
         self.normalization = nn.GroupNorm(1, self.feat_dim)
 
-    def forward(self, query, key, value, deform_field):
-        if query.shape[-2:] != deform_field.shape[-2:]:
+    def forward(self, query, key, value, deform_field, sampling_grid=None):
+        # sampling_grid can be precomputed once per forward with deformation_grids
+        if sampling_grid is None and query.shape[-2:] != deform_field.shape[-2:]:
             deform_field = resize_deform_field(deform_field, "shape", query.shape[-2:])
 
         output, attn = self.attention(
@@ -453,6 +486,7 @@ class Transformer(nn.Module):
             key=key,
             value=value,
             deform_field=deform_field,
+            sampling_grid=sampling_grid,
         )
 
         # feed forward
@@ -491,7 +525,7 @@ class UNet(nn.Module):
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, feat_dim, num_head, p_size=5, d_k=None, d_v=None):
+    def __init__(self, feat_dim, num_head, p_size=5, d_k=None, d_v=None, chunk_size=None):
         super().__init__()
         if d_k is None:
             d_k = feat_dim // num_head
@@ -500,6 +534,7 @@ class MultiHeadAttention(nn.Module):
 
         self.num_head = num_head
         self.p_size = p_size
+        self.chunk_size = chunk_size  # k^2 neighbours per attention chunk, None = all at once
         self.d_k = d_k
         self.d_v = d_v
 
@@ -511,9 +546,10 @@ class MultiHeadAttention(nn.Module):
         # after-attention combine heads
         self.fc = nn.Conv2d(num_head * d_v, feat_dim, 1, bias=False)
 
-    def forward(self, query, key, value, deform_field):
+    def forward(self, query, key, value, deform_field, sampling_grid=None, need_weights=False):
         # input: n x c x h x w
         # regist: n x 2 x h x w
+        # The k^2 attention weights are only materialized (and returned) when need_weights is set
         d_k, d_v, n_head = self.d_k, self.d_v, self.num_head
 
         # Pass through the pre-attention projection:
@@ -525,16 +561,25 @@ class MultiHeadAttention(nn.Module):
         n, c, h, w = query.shape
 
         # ------ Sampling K and V features ---------
-        sampling_grid = deformation_grid(deform_field, self.p_size)
-        sample_key = deformation_aware_sampler(key, sampling_grid, p_size=self.p_size)
-        sample_value = deformation_aware_sampler(value, sampling_grid, p_size=self.p_size)
-
-        query = query.view(n, 1, n_head, d_k, h, w) 
-        key = sample_key.view(n, self.p_size**2, n_head, d_k, h, w)
-        value = sample_value.view(n, self.p_size**2, n_head, d_v, h, w)
+        # key and value share the sampling grid, so they are gathered in one call
+        if sampling_grid is None:
+            sampling_grid = deformation_grid(deform_field, self.p_size)
+        feat_kv = torch.cat([key, value], dim=1)
 
         # -------------- Attention -----------------
-        query, attn = softmax_attention(query, key, value)
+        attn = None
+        if need_weights:
+            sample_kv = deformation_aware_sampler(feat_kv, sampling_grid)
+            sample_key, sample_value = sample_kv.split([n_head * d_k, n_head * d_v], dim=1)
+
+            query = query.view(n, 1, n_head, d_k, h, w) 
+            key = sample_key.unflatten(1, (n_head, d_k)).permute(0, 3, 1, 2, 4, 5)  # n x k^2 x nhead x dk x h x w
+            value = sample_value.unflatten(1, (n_head, d_v)).permute(0, 3, 1, 2, 4, 5)  # n x k^2 x nhead x dv x h x w
+            query, attn = softmax_attention(query, key, value)
+        else:
+            query = chunked_softmax_attention(
+                query, feat_kv, sampling_grid, n_head, d_k, d_v, chunk_size=self.chunk_size
+            )
 
         query = query.reshape(n, -1, h, w)
         query = query.float()
@@ -543,28 +588,83 @@ class MultiHeadAttention(nn.Module):
         return query, attn
 
 
-def deformation_grid(deform_field, p_size=5):
-    n, _, h, w = deform_field.size() 
-    padding = (p_size - 1) // 2
+def _attention_chunk(query, feat_kv, grid, acc, norm, running_max, d_k, d_v):
+    # One online-softmax update over a chunk of m neighbours.
+    # query: n x nhead x dk x 1 x h x w (pre-scaled), grid: (n*m, h, w, 2)
+    # acc: n x nhead x dv x h x w, norm / running_max: n x nhead x h x w
+    n, n_head, _, _, h, w = query.shape
+    sample_kv = deformation_aware_sampler(feat_kv, grid)  # n x nhead*(dk+dv) x m x h x w
+    key, value = sample_kv.split([n_head * d_k, n_head * d_v], dim=1)
+    key = key.unflatten(1, (n_head, d_k))  # n x nhead x dk x m x h x w
+    value = value.unflatten(1, (n_head, d_v))  # n x nhead x dv x m x h x w
 
-    grid_y, grid_x = torch.meshgrid(torch.arange(0, h), torch.arange(0, w))
-    grid_y = grid_y[None, ...].expand(p_size**2, -1, -1).type_as(deform_field)
-    grid_x = grid_x[None, ...].expand(p_size**2, -1, -1).type_as(deform_field)
+    scores = (query * key).sum(2)  # n x nhead x m x h x w
+    new_max = torch.maximum(running_max, scores.amax(2))
+    correction = torch.exp(running_max - new_max)
+    weights = torch.exp(scores - new_max.unsqueeze(2))
 
-    shift = torch.arange(0, p_size).type_as(deform_field) - padding 
-    shift_y, shift_x = torch.meshgrid(shift, shift)  
-    shift_y = shift_y.reshape(-1, 1, 1).expand(-1, h, w)  # k^2, h, w
-    shift_x = shift_x.reshape(-1, 1, 1).expand(-1, h, w)  # k^2, h, w
+    norm = norm * correction + weights.sum(2)
+    acc = acc * correction.unsqueeze(2) + (weights.unsqueeze(2) * value).sum(3)
+    return acc, norm, new_max
 
-    samples_y = grid_y + shift_y  # k^2, h, w
-    samples_x = grid_x + shift_x  # k^2, h, w
 
-    samples_grid = torch.stack((samples_x, samples_y), 3)  # k^2, h, w, 2
-    samples_grid = samples_grid[None, ...].expand(n, -1, -1, -1, -1)  # n, k^2, h, w, 2
+def chunked_softmax_attention(query, feat_kv, grid, num_head, d_k, d_v, chunk_size=None):
+    """Local softmax attention over the k^2 deformed neighbours, streamed in chunks.
+
+    Keys/values are sampled chunk by chunk and combined with an online softmax, so only
+    chunk_size neighbours are alive at a time; under autograd every chunk is checkpointed.
+    query: n x (nhead*dk) x h x w, feat_kv: n x nhead*(dk+dv) x h x w (key and value maps
+    concatenated), grid: (n*k^2, h, w, 2). Returns n x nhead x dv x h x w.
+    """
+    n, _, h, w = query.shape
+    n_samples = grid.shape[0] // n
+    chunk_size = min(chunk_size or n_samples, n_samples)
+
+    query = query.view(n, num_head, d_k, 1, h, w) / d_k**0.5  # scaled attention
+    grid = grid.view(n, n_samples, h, w, 2)
+
+    acc = query.new_zeros(n, num_head, d_v, h, w)
+    norm = query.new_zeros(n, num_head, h, w)
+    running_max = query.new_full((n, num_head, h, w), float("-inf"))
+
+    use_checkpoint = torch.is_grad_enabled() and chunk_size < n_samples
+    for start in range(0, n_samples, chunk_size):
+        grid_chunk = grid[:, start : start + chunk_size].reshape(-1, h, w, 2)
+        if use_checkpoint:
+            acc, norm, running_max = checkpoint(
+                _attention_chunk, query, feat_kv, grid_chunk, acc, norm, running_max, d_k, d_v,
+                use_reentrant=False,
+            )
+        else:
+            acc, norm, running_max = _attention_chunk(query, feat_kv, grid_chunk, acc, norm, running_max, d_k, d_v)
+
+    return acc / norm.unsqueeze(2)
 
-    deform_field = deform_field.permute(0, 2, 3, 1)[:, None, ...].expand(-1, p_size**2, -1, -1, -1) 
 
-    vgrid = samples_grid + deform_field 
+@functools.lru_cache(maxsize=16)
+def sampling_base_grid(h, w, p_size, device, dtype):
+    """Static part of deformation_grid: pixel grid + k^2 neighbourhood shifts, (1, k^2, h, w, 2).
+
+    Cached per (h, w, p_size, device, dtype); sampling_base_grid.cache_info() gives the hit counters.
+    """
+    padding = (p_size - 1) // 2
+
+    grid_y, grid_x = torch.meshgrid(
+        torch.arange(0, h, device=device, dtype=dtype), torch.arange(0, w, device=device, dtype=dtype), indexing="ij"
+    )
+    shift = torch.arange(0, p_size, device=device, dtype=dtype) - padding
+    shift_y, shift_x = torch.meshgrid(shift, shift, indexing="ij")
+
+    samples_y = grid_y[None] + shift_y.reshape(-1, 1, 1)  # k^2, h, w
+    samples_x = grid_x[None] + shift_x.reshape(-1, 1, 1)  # k^2, h, w
+    return torch.stack((samples_x, samples_y), 3)[None]  # 1, k^2, h, w, 2
+
+
+def deformation_grid(deform_field, p_size=5):
+    n, _, h, w = deform_field.size() 
+    samples_grid = sampling_base_grid(h, w, p_size, deform_field.device, deform_field.dtype)  # 1, k^2, h, w, 2
+
+    vgrid = samples_grid + deform_field.permute(0, 2, 3, 1)[:, None]  # n, k^2, h, w, 2
     # scale grid to [-1,1]
     vgrid_x = 2.0 * vgrid[..., 0] / max(w - 1, 1) - 1.0
     vgrid_y = 2.0 * vgrid[..., 1] / max(h - 1, 1) - 1.0
@@ -573,26 +673,43 @@ def deformation_grid(deform_field, p_size=5):
     return vgrid_scaled  # n x k^2, h, w, 2
 
 
+def deformation_grids(deform_field, shapes, p_size=5):
+    """Sampling grids for every feature shape in `shapes`, each resized field and grid computed once.
+
+    Returns a dict {(h, w): grid} so DACA blocks at the same scale share one grid.
+    """
+    grids = {}
+    for shape in shapes:
+        shape = tuple(shape)
+        if shape in grids:
+            continue
+        field = deform_field
+        if field.shape[-2:] != shape:
+            field = resize_deform_field(field, "shape", shape)
+        grids[shape] = deformation_grid(field, p_size)
+    return grids
+
+
 def deformation_aware_sampler(
     feat,
     grid,
-    p_size=5,
     interp_mode="bilinear",
     padding_mode="zeros",
     align_corners=True,
 ):  # feat: [4, 64, 48, 48]
     # feat (Tensor): Tensor with size (n, c, h, w).
     # vgrid (Tensor): Tensor with size (nk^2, h, w, 2)
+    # The k^2 grids are stacked along the height axis, so every neighbour is gathered from
+    # the same source map in a single grid_sample instead of replicating feat k^2 times.
     n, c, h, w = feat.size()
-    feat = (
-        feat.view(n, 1, c, h, w).expand(-1, p_size**2, -1, -1, -1).reshape(-1, c, h, w)
-    )  # (nk^2, c, h, w)
+    n_samples = grid.shape[0] // n  # k^2, or fewer for a chunk of the neighbourhood
+    grid = grid.reshape(n, n_samples * h, w, 2)  # (n, k^2*h, w, 2)
     sample_feat = F.grid_sample(
         feat,
         grid,
         mode=interp_mode,
         padding_mode=padding_mode,
         align_corners=align_corners,
-    ).view(n, p_size**2, c, h, w)
-    return sample_feat
+    ).view(n, c, n_samples, h, w)
+    return sample_feat  # (n, c, k^2, h, w)
 
@@ -1,6 +1,5 @@
 import torch.nn as nn
 from torch.nn import init
-import numpy as np
 import torch
 
 class PatchSampleF(nn.Module):
@@ -17,7 +16,12 @@ class PatchSampleF(nn.Module):
 
         except KeyError as e:
             raise ValueError(f"Missing required parameter: {str(e)}")
-        
+        # mlp and l2norm over the samples of all layers at once (layers must have the same channels)
+        self.fuse_layers = kwargs.get('fuse_layers', False)
+        # seed of the patch id generators (one per device), None for the global RNG
+        self.seed = kwargs.get('seed', None)
+        self.generators = {}
+
         self.l2norm = Normalize(2)
         self.mlp_init = False
 
@@ -30,9 +34,23 @@ class PatchSampleF(nn.Module):
             # init_net(self.mlp, self.init_type, self.init_gain)
             # self.mlp_init = True
 
+    def generator(self, device):
+        if self.seed is None:
+            return None
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device).manual_seed(self.seed)
+        return self.generators[device]
+
+    def sample_ids(self, num_positions, num_patches, device):
+        # random positions without replacement, drawn on the feature's device (no host-to-device copy and sync per layer).
+        # torch.randperm produces cudaErrorIllegalAddress for newer versions of PyTorch. https://github.com/taesungp/contrastive-unpaired-translation/issues/83
+        scores = torch.rand(num_positions, device=device, generator=self.generator(device))
+        return scores.topk(int(min(num_patches, num_positions))).indices
+
     def forward(self, feats, num_patches=64, patch_ids=None):
         return_ids = []
         return_feats = []
+        fuse_layers = self.fuse_layers and num_patches > 0
         # if self.use_mlp and not self.mlp_init:
         #     self.create_mlp(feats)
         for feat_id, feat in enumerate(feats):
@@ -40,26 +58,33 @@ class PatchSampleF(nn.Module):
             feat_reshape = feat.permute(0, 2, 3, 1).flatten(1, 2)
             if num_patches > 0:
                 if patch_ids is not None:
-                    patch_id = patch_ids[feat_id]
+                    # ids of a previous call are already on the device
+                    patch_id = torch.as_tensor(patch_ids[feat_id], dtype=torch.long, device=feat.device)
                 else:
-                    # torch.randperm produces cudaErrorIllegalAddress for newer versions of PyTorch. https://github.com/taesungp/contrastive-unpaired-translation/issues/83
-                    #patch_id = torch.randperm(feat_reshape.shape[1], device=feats[0].device)
-                    patch_id = np.random.permutation(feat_reshape.shape[1])
-                    patch_id = patch_id[:int(min(num_patches, patch_id.shape[0]))]  # .to(patch_ids.device)
-                patch_id = torch.tensor(patch_id, dtype=torch.long)
+                    patch_id = self.sample_ids(feat_reshape.shape[1], num_patches, feat.device)
                 x_sample = feat_reshape[:, patch_id, :].flatten(0, 1)  # reshape(-1, x.shape[1])
             else:
                 x_sample = feat_reshape
                 patch_id = []
+            return_ids.append(patch_id)
+            if fuse_layers:
+                return_feats.append(x_sample)
+                continue
             if self.use_mlp:
                 # mlp = getattr(self, 'mlp_%d' % feat_id)
                 x_sample = self.mlp(x_sample)
-            return_ids.append(patch_id)
             x_sample = self.l2norm(x_sample)
 
             if num_patches == 0:
                 x_sample = x_sample.permute(0, 2, 1).reshape([B, x_sample.shape[-1], H, W])
             return_feats.append(x_sample)
+
+        if fuse_layers:
+            sizes = [x_sample.shape[0] for x_sample in return_feats]
+            x_sample = torch.cat(return_feats)
+            if self.use_mlp:
+                x_sample = self.mlp(x_sample)
+            return_feats = list(self.l2norm(x_sample).split(sizes))
         return return_feats, return_ids
 
 
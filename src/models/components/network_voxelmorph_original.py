@@ -197,15 +197,13 @@ class VxmDense(nn.Module):
         self.bidir = bidir
 
         # configure optional integration layer for diffeomorphic warp
-        down_shape = [int(dim / int_downsize) for dim in inshape]
-        self.integrate = (
-            VecInt(down_shape, int_steps) if int_steps > 0 else None
-        )  # [192, 96] / 7. down_shape는 처음 모델 선언할때 들어오는 input으로 정해지네.
+        self.integrate = VecInt(nsteps=int_steps) if int_steps > 0 else None
 
         # configure transformer
-        self.transformer = SpatialTransformer(inshape)
-        # print("shape: @@@@@@@@@@@")
-        # print(inshape.shape)
+        self.transformer = SpatialTransformer()
+
+        # spatial dims of the inputs must be divisible by this (UNet pooling and flow downsampling)
+        self.shape_multiple = int(np.lcm(2 ** (self.unet_model.nb_levels - 1), int_downsize if int_steps > 0 else 1))
 
     def forward(self, source, target, registration=False):
         """
@@ -527,69 +525,55 @@ class VecInt(nn.Module):
     Integrates a vector field via scaling and squaring.
     """
 
-    def __init__(self, inshape, nsteps):  # [192, 96] / 7
+    def __init__(self, inshape=None, nsteps=7):  # inshape is unused: grids follow the input shape
         super().__init__()
 
         assert nsteps >= 0, "nsteps should be >= 0, found: %d" % nsteps
         self.nsteps = nsteps
         self.scale = 1.0 / (2**self.nsteps)
-        self.transformer = SpatialTransformer(
-            inshape
-        )  # 여기서 grid크기 정해져. inshape로
+        self.transformer = SpatialTransformer()
 
     # vec: [1, 2, 384, 192]
-    def forward(
-        self, vec
-    ):  # 여기서 vec는 pos_flow(flow field) 이다. 학습때 쓰이는 input에 크기를 맞추는거라서.정적으로 초기에 할당한 grid와 shape가 안맞는 문제.
+    def forward(self, vec):  # 여기서 vec는 pos_flow(flow field) 이다.
         vec = vec * self.scale  # vector를 정규화하는 느낌
         for _ in range(self.nsteps):
             vec = vec + self.transformer(
                 vec, vec
-            )  # vec를 정규화시켜서 아주작게 줄여주고, vec방향만큼 누적시켜주는거. 작게해서 같은방향으로 자주 하겠다는 뜻. #TODO: 아주 엄밀히 어떻게 연산되는지는 이해못하고 pass 너무 걸림.
+            )  # vec를 정규화시켜서 아주작게 줄여주고, vec방향만큼 누적시켜주는거. 작게해서 같은방향으로 자주 하겠다는 뜻.
             # 어쨌든 이 과정은 vec를 더 정밀하고 연속적이게 만들어준다.
         return vec
 
 
+@functools.lru_cache(maxsize=32)
+def identity_grid(shape, device, dtype):
+    """Identity sampling grid [1, ndims, *shape] in voxel coordinates, cached per (shape, device, dtype)."""
+    vectors = [torch.arange(0, s, device=device, dtype=dtype) for s in shape]
+    grids = torch.meshgrid(vectors, indexing="ij")
+    return torch.stack(grids).unsqueeze(0)
 
 
 class SpatialTransformer(nn.Module):
     """
     N-D Spatial Transformer
+
+    The identity grid is built for the shape of each flow (see identity_grid) instead of being a
+    fixed-size buffer, so any input size divisible by the UNet stride can be registered.
     """
 
-    def __init__(self, size, mode="bilinear"):  # size: [192, 96]
+    def __init__(self, size=None, mode="bilinear"):  # size is unused and kept for compatibility
         super().__init__()
 
         self.mode = mode
 
-        # create sampling grid
-        vectors = [
-            torch.arange(0, s) for s in size
-        ]  # 0~191, 0~95 두개의 벡터를 리스트로
-        grids = torch.meshgrid(
-            vectors
-        )  # 192x96의 2차원 그리드 두개 생성. 하나는 x축 좌표 하나는 y축 좌표
-        grid = torch.stack(grids)  # [2, 192, 96] 두 그리드를 쌓는다.
-        grid = torch.unsqueeze(grid, 0)  #  [1, 2, 192, 96]
-        grid = grid.type(torch.FloatTensor)
-
-        # registering the grid as a buffer cleanly moves it to the GPU, but it also
-        # adds it to the state dict. this is annoying since everything in the state dict
-        # is included when saving weights to disk, so the model files are way bigger
-        # than they need to be. so far, there does not appear to be an elegant solution.
-        # see: https://discuss.pytorch.org/t/how-to-register-buffer-without-polluting-state-dict
-        self.register_buffer("grid", grid)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the grid cache still contain the fixed-size grid buffer
+        state_dict.pop(prefix + "grid", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, src, flow):
-        # new locations
-        # print("self grid")
-        # print(self.grid.shape)
-        # print("flow")
-        # print(flow.shape)
-        new_locs = (
-            self.grid + flow
-        )  # [1, 2, 192, 96]  // [1, 2, 384, 288]+[8, 2, 32, 32]
         shape = flow.shape[2:]
+        # new locations
+        new_locs = identity_grid(tuple(shape), flow.device, flow.dtype) + flow
 
         # need to normalize grid values to [-1, 1] for resampler
         for i in range(len(shape)):
@@ -605,7 +589,7 @@ class SpatialTransformer(nn.Module):
             new_locs = new_locs[..., [2, 1, 0]]
         return nnf.grid_sample(
             src, new_locs, align_corners=True, mode=self.mode
-        )  # torch.nn.functional.grid_sample 새로운 좌표로 이미지를 샘플링. 샘플링은 어떻게 될까. interpolation은 bilinear으로 설정.
+        )  # torch.nn.functional.grid_sample 새로운 좌표로 이미지를 샘플링. interpolation은 bilinear으로 설정.
 
 
 def default_unet_features():
@@ -0,0 +1,121 @@
+from typing import Callable, Optional, Sequence
+
+import torch
+
+
+class SlidingWindowInference:
+    """Runs a model step over overlapping tiles of [N, C, H, W] inputs and blends the outputs.
+
+    Replaces the old use_split_inference (two height halves, visible seams). Every tensor returned
+    by step_fn is accumulated with a per-tile weight map (gaussian or linear fall-off towards the
+    tile border) and normalized by the summed weights, so full-resolution slices run in bounded
+    memory without seams. tile_batch_size tiles are stacked into one step_fn call.
+
+    Args:
+        tile_size: [H, W] of a tile. Dimensions larger than the image are clipped to the image.
+            Tiles should respect the model's size constraints (RbG: multiples of 16).
+        overlap: Fraction of the tile shared with the neighbouring tile, in [0, 1).
+        blend: "gaussian" or "linear" blending weights.
+        tile_batch_size: Number of tiles per step_fn call.
+        sigma_scale: Gaussian sigma as a fraction of the tile size.
+    """
+
+    def __init__(
+        self,
+        tile_size: Sequence[int],
+        overlap: float = 0.25,
+        blend: str = "gaussian",
+        tile_batch_size: int = 4,
+        sigma_scale: float = 0.125,
+    ):
+        if len(tile_size) != 2:
+            raise ValueError(f"tile_size should be [H, W], but got {tile_size}.")
+        if not 0 <= overlap < 1:
+            raise ValueError(f"overlap should be in [0, 1), but got {overlap}.")
+        if blend not in ("gaussian", "linear"):
+            raise ValueError(f"blend should be gaussian or linear, but got {blend}.")
+
+        self.tile_size = tuple(int(s) for s in tile_size)
+        self.overlap = overlap
+        self.blend = blend
+        self.tile_batch_size = max(int(tile_batch_size), 1)
+        self.sigma_scale = sigma_scale
+        self._weights = {}
+
+    def tile_starts(self, size: int, tile: int):
+        if tile >= size:
+            return [0]
+        stride = max(int(round(tile * (1 - self.overlap))), 1)
+        starts = list(range(0, size - tile, stride))
+        return starts + [size - tile]  # last tile flush with the border
+
+    def _weight_1d(self, tile: int):
+        center = (tile - 1) / 2
+        coords = torch.arange(tile, dtype=torch.float32)
+        if self.blend == "gaussian":
+            sigma = max(tile * self.sigma_scale, 1e-3)
+            weight = torch.exp(-((coords - center) ** 2) / (2 * sigma**2))
+        else:
+            weight = torch.minimum(coords + 1, tile - coords)
+        return weight / weight.max()
+
+    def weight_map(self, tile_h: int, tile_w: int, device: torch.device):
+        key = (tile_h, tile_w, device)
+        if key not in self._weights:
+            # keep the border strictly positive: pixels at the image edge may be covered by one tile only.
+            # Clamped per axis, so tiles overlapping along one axis keep their relative weights near the other edge
+            weight = self._weight_1d(tile_h).clamp_min(1e-3)[:, None] * self._weight_1d(tile_w).clamp_min(1e-3)[None, :]
+            self._weights[key] = weight.to(device)[None, None]
+        return self._weights[key]
+
+    def __call__(self, step_fn: Callable, batch: Sequence[torch.Tensor]):
+        batch = list(batch)
+        n = batch[0].shape[0]
+        h, w = batch[0].shape[-2:]
+        tile_h, tile_w = min(self.tile_size[0], h), min(self.tile_size[1], w)
+        if (tile_h, tile_w) == (h, w):
+            return step_fn(batch)
+
+        positions = [(y, x) for y in self.tile_starts(h, tile_h) for x in self.tile_starts(w, tile_w)]
+        weight = self.weight_map(tile_h, tile_w, batch[0].device)
+        norm = torch.zeros(1, 1, h, w, device=batch[0].device)
+        outputs, dtypes, passthrough = None, None, None
+
+        for i in range(0, len(positions), self.tile_batch_size):
+            chunk = positions[i : i + self.tile_batch_size]
+            tiles = [torch.cat([t[..., y : y + tile_h, x : x + tile_w] for y, x in chunk], dim=0) for t in batch]
+            results = step_fn(tiles)
+
+            if outputs is None:
+                # inputs passed straight through by step_fn (e.g. real_a, real_b) are returned untouched
+                passthrough = [next((k for k, t in enumerate(tiles) if r is t), None) for r in results]
+                outputs = [
+                    None if k is not None else r.new_zeros(n, *r.shape[1:-2], h, w, dtype=torch.float32)
+                    for r, k in zip(results, passthrough)
+                ]
+                dtypes = [r.dtype for r in results]
+            for result, output in zip(results, outputs):
+                if output is None:
+                    continue
+                for j, (y, x) in enumerate(chunk):
+                    output[..., y : y + tile_h, x : x + tile_w] += result[j * n : (j + 1) * n].float() * weight
+            for y, x in chunk:
+                norm[..., y : y + tile_h, x : x + tile_w] += weight
+
+        return tuple(
+            batch[k] if k is not None else (output / norm).to(dtype)
+            for output, dtype, k in zip(outputs, dtypes, passthrough)
+        )
+
+
+def build_tiled_inference(cfg: Optional[dict]) -> Optional[SlidingWindowInference]:
+    """SlidingWindowInference from a data.tiled_inference config node, or None when tile_size is unset."""
+    if cfg is None or cfg.get("tile_size") is None:
+        return None
+    return SlidingWindowInference(
+        tile_size=list(cfg["tile_size"]),
+        overlap=cfg.get("overlap", 0.25),
+        blend=cfg.get("blend", "gaussian"),
+        tile_batch_size=cfg.get("tile_batch_size", 4),
+        sigma_scale=cfg.get("sigma_scale", 0.125),
+    )
@@ -0,0 +1,119 @@
+import os
+from typing import Tuple
+
+import h5py
+import hydra
+import numpy as np
+import pyrootutils
+import torch
+from omegaconf import DictConfig
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src import utils
+from src.data.components.h5_layout import LAYOUT_ATTR, SLICE_MAJOR, is_slice_major
+from src.data.components.transforms import stage1_cache_path
+
+log = utils.get_pylogger(__name__)
+
+# Runs the frozen Stage-1 synthesis network and the registration network of RbG once over the H5 files and
+# stores synth_img and deform_field in a sidecar file (Train.h5 -> Train_stage1.h5, see stage1_cache_path),
+# so Stage-2 training (data.use_stage1_cache=True) can skip both networks. The source H5 is only read.
+#
+# This is not bit-equivalent to running Stage 1 inside training: both networks see the full slice here
+# (padded to a multiple of 16), as at validation/test time, and the training crops are then cut from
+# their outputs. Without the cache, training runs them on the 96x96 random crops, where instance norm
+# statistics, the /16 style guidance and the registration context all come from the crop only. The
+# StyleConv noise of PAdaIN is also sampled once here and then fixed.
+#
+# python src/precompute_stage1.py model=RbG.yaml data.train_file=Train.h5 model.netG_A.synth_path=... \
+#     model.netG_A.regist_path=... model.netG_A.regist_size=[384,320] +stage1_splits=[train] +stage1_batch_size=16
+
+
+@torch.no_grad()
+def compute_patient(net, input_volume, ref_volume, batch_size, device):
+    """Returns synth_img [D, H, W] and deform_field [D, 2, H, W] for [D, H, W] input/ref volumes."""
+    synth_slices, deform_slices = [], []
+    for start in range(0, input_volume.shape[0], batch_size):
+        input_img = torch.from_numpy(input_volume[start : start + batch_size]).unsqueeze(1).float().to(device)
+        ref_img = torch.from_numpy(ref_volume[start : start + batch_size]).unsqueeze(1).float().to(device)
+
+        # The synthesis network downsamples by 16
+        input_img, padding = net.pad_tensor_to_multiple(input_img, height_multiple=16, width_multiple=16)
+        ref_img, _ = net.pad_tensor_to_multiple(ref_img, height_multiple=16, width_multiple=16)
+        synth_img, deform_field = net.stage1(input_img, ref_img)
+
+        synth_slices.append(net.crop_tensor_to_original(synth_img, padding)[:, 0].cpu().numpy())
+        deform_slices.append(net.crop_tensor_to_original(deform_field, padding).cpu().numpy())
+    return np.concatenate(synth_slices), np.concatenate(deform_slices)
+
+
+@utils.task_wrapper
+def precompute_stage1(cfg: DictConfig) -> Tuple[dict, dict]:
+    """Writes the Stage-1 sidecar of every split in `stage1_splits` (default: train)."""
+    splits = list(cfg.get("stage1_splits", ["train"]))
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    log.info(f"Instantiating generator <{cfg.model.netG_A._target_}>")
+    net = hydra.utils.instantiate(cfg.model.netG_A).to(device)
+    net.eval()
+
+    input_group, ref_group = (
+        (cfg.data.data_group_2, cfg.data.data_group_1) if cfg.data.reverse else (cfg.data.data_group_1, cfg.data.data_group_2)
+    )
+    synth_group, deform_group = cfg.data.stage1_synth_group, cfg.data.stage1_deform_group
+    batch_size = cfg.get("stage1_batch_size", 16)
+    num_patients, num_slices = 0, 0
+
+    for split in splits:
+        h5_path = os.path.join(cfg.data.data_dir, split, cfg.data[f"{split}_file"])
+        cache_path = stage1_cache_path(h5_path)
+        log.info(f"Precomputing Stage-1 outputs for {h5_path} into {cache_path}")
+        # written under a temporary name and renamed once complete, so an interrupted run leaves no partial cache
+        tmp_path = cache_path + ".tmp"
+        with h5py.File(h5_path, "r") as file, h5py.File(tmp_path, "w") as cache:
+            slice_major = is_slice_major(file)
+            if slice_major:
+                cache.attrs[LAYOUT_ATTR] = SLICE_MAJOR
+            groups = {name: cache.create_group(name) for name in (synth_group, deform_group)}
+            for group in groups.values():
+                group.attrs["input_group"] = input_group
+                group.attrs["ref_group"] = ref_group
+
+            for key in file[input_group].keys():
+                input_volume = file[input_group][key][...]
+                ref_volume = file[ref_group][key][...]
+                if not slice_major:
+                    input_volume = np.transpose(input_volume, (2, 0, 1))
+                    ref_volume = np.transpose(ref_volume, (2, 0, 1))
+
+                synth_img, deform_field = compute_patient(net, input_volume, ref_volume, batch_size, device)
+                num_patients += 1
+                num_slices += synth_img.shape[0]
+
+                # Same layout as the image groups: [D, H, W] / [D, 2, H, W] or [H, W, D] / [2, H, W, D]
+                if slice_major:
+                    groups[synth_group].create_dataset(key, data=synth_img, chunks=(1,) + synth_img.shape[1:])
+                    groups[deform_group].create_dataset(key, data=deform_field, chunks=(1,) + deform_field.shape[1:])
+                else:
+                    groups[synth_group].create_dataset(key, data=np.transpose(synth_img, (1, 2, 0)))
+                    groups[deform_group].create_dataset(key, data=np.transpose(deform_field, (1, 2, 3, 0)))
+        os.replace(tmp_path, cache_path)
+
+    metric_dict = {"stage1/patients": num_patients, "stage1/slices": num_slices}
+    object_dict = {"cfg": cfg, "net": net}
+
+    return metric_dict, object_dict
+
+
+@hydra.main(version_base="1.3", config_path="../configs", config_name="defaults.yaml")
+def main(cfg: DictConfig) -> None:
+    # apply extra utilities
+    # (e.g. ask for tags if none are provided in cfg, print cfg tree, etc.)
+    utils.extras(cfg)
+
+    precompute_stage1(cfg)
+
+
+if __name__ == "__main__":
+    main()
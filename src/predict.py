@@ -0,0 +1,196 @@
+import os
+import resource
+import time
+
+import h5py
+import hydra
+import nibabel as nib
+import numpy as np
+import pyrootutils
+import torch
+import torch.nn.functional as F
+from lightning import LightningModule
+from omegaconf import DictConfig
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src import utils
+from src.data.components.h5_layout import is_slice_major
+
+log = utils.get_pylogger(__name__)
+
+# Loads a checkpoint once and writes one synthesized volume per patient of an H5 file, without a Trainer.
+# Slices are streamed from the H5 file predict.batch_size at a time (the test dataloader is fixed at
+# batch_size=1) and go through the model's inference_step, so data.tiled_inference applies here too.
+#
+# python src/predict.py model=RbG.yaml ckpt_path=<CKPT>.ckpt data.test_file=Test_Demo.h5 predict.batch_size=16 \
+#     model.netG_A.synth_path=... model.netG_A.regist_path=... model.netG_A.regist_size=[384,320]
+
+
+def read_slices(dataset, start, stop, slice_major):
+    """Returns slices [start, stop) of a patient dataset as a [N, H, W] array."""
+    if slice_major:
+        return dataset[start:stop]
+    return np.transpose(dataset[..., start:stop], (2, 0, 1))
+
+
+def pad_to_multiple(tensor, multiple):
+    h, w = tensor.shape[-2:]
+    h_pad, w_pad = (multiple - h % multiple) % multiple, (multiple - w % multiple) % multiple
+    # -1 is the background value of the [-1, 1] normalized images
+    return F.pad(tensor, (0, w_pad, 0, h_pad), mode="constant", value=-1), (h, w)
+
+
+def peak_memory_mib(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10  # KiB on Linux
+
+
+def save_nifti(volume, path, flag_normalize=True):
+    """Saves an [H, W, D] volume the way ImageSavingCallback does."""
+    if flag_normalize:
+        volume = (((volume + 1) / 2) * 255).astype(np.int16)
+    nib.save(nib.Nifti1Image(volume[::-1, ::-1, :], np.eye(4)), path)
+
+
+@torch.no_grad()
+def predict_patient(model, input_dataset, ref_dataset, write_fn, slice_major, batch_size, pad_multiple, device):
+    """Runs the model over one patient, batch_size slices at a time, and passes [N, H, W] outputs to write_fn."""
+    step = getattr(model, "inference_step", model.model_step)
+    num_slices = input_dataset.shape[0] if slice_major else input_dataset.shape[-1]
+
+    for start in range(0, num_slices, batch_size):
+        stop = min(start + batch_size, num_slices)
+        real_a = torch.from_numpy(read_slices(input_dataset, start, stop, slice_major)).unsqueeze(1).float()
+        real_b = torch.from_numpy(read_slices(ref_dataset, start, stop, slice_major)).unsqueeze(1).float()
+
+        real_a, (h, w) = pad_to_multiple(real_a.to(device, non_blocking=True), pad_multiple)
+        real_b, _ = pad_to_multiple(real_b.to(device, non_blocking=True), pad_multiple)
+        fake_b = step([real_a, real_b])[-1]
+
+        write_fn(start, stop, fake_b[:, 0, :h, :w].float().cpu().numpy())
+    return num_slices
+
+
+@utils.task_wrapper
+def predict(cfg: DictConfig):
+    """Writes the model output of every patient in data.<predict.split>_file.
+
+    Args:
+        cfg (DictConfig): Configuration composed by Hydra.
+
+    Returns:
+        Tuple[dict, dict]: Dict with throughput and peak memory and dict with all instantiated objects.
+    """
+
+    assert cfg.ckpt_path
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    log.info(f"Instantiating model <{cfg.model._target_}>")
+    model: LightningModule = hydra.utils.instantiate(cfg.model)
+
+    log.info(f"Loading checkpoint {cfg.ckpt_path}")
+    checkpoint = torch.load(cfg.ckpt_path, map_location="cpu")
+    model.load_state_dict(checkpoint["state_dict"])
+    model = model.to(device).eval()
+
+    input_group, ref_group = (
+        (cfg.data.data_group_2, cfg.data.data_group_1) if cfg.data.reverse else (cfg.data.data_group_1, cfg.data.data_group_2)
+    )
+    split = cfg.predict.split
+    h5_path = os.path.join(cfg.data.data_dir, split, cfg.data[f"{split}_file"])
+    output_dir = cfg.predict.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    output_format = cfg.predict.output_format
+    if output_format not in ("h5", "nifti"):
+        raise ValueError(f"predict.output_format should be h5 or nifti, but got {output_format}.")
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    total_slices, total_time = 0, 0.0
+    output_file = (
+        h5py.File(os.path.join(output_dir, cfg.predict.output_file), "w") if output_format == "h5" else None
+    )
+    log.info(f"Predicting {h5_path} ({input_group} -> {ref_group}) into {output_dir}")
+    try:
+        with h5py.File(h5_path, "r") as file:
+            slice_major = is_slice_major(file)
+            if output_file is not None:
+                output_file.attrs.update(dict(file.attrs))
+                output_group = output_file.create_group(cfg.predict.output_group)
+            keys = list(file[input_group].keys()) if cfg.predict.patients is None else list(cfg.predict.patients)
+
+            for key in keys:
+                input_dataset, ref_dataset = file[input_group][key], file[ref_group][key]
+
+                if output_file is not None:
+                    # streamed into the output file batch by batch, in the layout of the input file
+                    output = output_group.create_dataset(
+                        key, shape=input_dataset.shape, dtype=np.float32,
+                        chunks=(1,) + input_dataset.shape[1:] if slice_major else None,
+                    )
+                    if slice_major:
+                        def write_fn(start, stop, pred):
+                            output[start:stop] = pred
+                    else:
+                        def write_fn(start, stop, pred):
+                            output[..., start:stop] = np.transpose(pred, (1, 2, 0))
+                else:
+                    h, w = input_dataset.shape[1:] if slice_major else input_dataset.shape[:2]
+                    output = np.empty((h, w, input_dataset.shape[0] if slice_major else input_dataset.shape[-1]), np.float32)
+
+                    def write_fn(start, stop, pred):
+                        output[..., start:stop] = np.transpose(pred, (1, 2, 0))
+
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start_time = time.perf_counter()
+                num_slices = predict_patient(
+                    model, input_dataset, ref_dataset, write_fn, slice_major,
+                    cfg.predict.batch_size, cfg.predict.pad_multiple, device,
+                )
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                elapsed = time.perf_counter() - start_time
+
+                if output_file is None:
+                    save_nifti(
+                        output, os.path.join(output_dir, f"preds_b_{key}.nii.gz"), cfg.predict.flag_normalize
+                    )
+
+                total_slices += num_slices
+                total_time += elapsed
+                log.info(f"{key}: {num_slices} slices, {num_slices / elapsed:.2f} slices/sec")
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    metric_dict = {
+        "predict/slices": total_slices,
+        "predict/slices_per_sec": total_slices / max(total_time, 1e-12),
+        "predict/peak_memory_mib": peak_memory_mib(device),
+    }
+    log.info(
+        f"Predicted {total_slices} slices at {metric_dict['predict/slices_per_sec']:.2f} slices/sec, "
+        f"peak {'GPU' if device.type == 'cuda' else 'RSS'} memory {metric_dict['predict/peak_memory_mib']:.0f} MiB"
+    )
+
+    object_dict = {"cfg": cfg, "model": model}
+
+    return metric_dict, object_dict
+
+
+@hydra.main(version_base="1.3", config_path="../configs", config_name="predict.yaml")
+def main(cfg: DictConfig) -> None:
+    # apply extra utilities
+    # (e.g. ask for tags if none are provided in cfg, print cfg tree, etc.)
+    utils.extras(cfg)
+
+    predict(cfg)
+
+
+if __name__ == "__main__":
+    main()
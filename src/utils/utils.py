@@ -2,6 +2,7 @@ import warnings
 from importlib.util import find_spec
 from typing import Callable
 
+import torch
 from omegaconf import DictConfig
 
 from src.utils import pylogger, rich_utils
@@ -92,6 +93,17 @@ def task_wrapper(task_func: Callable) -> Callable:
     return wrap
 
 
+def split_sample_index(batch):
+    """Splits the dataset indices appended by dataset_SynthRAD(return_index=True) off a collated batch.
+
+    The indices are a 1D tensor after the image tensors (which are at least 4D). Returns (batch, indices),
+    with indices None when the batch carries none.
+    """
+    if isinstance(batch, (list, tuple)) and len(batch) > 0 and torch.is_tensor(batch[-1]) and batch[-1].ndim == 1:
+        return batch[:-1], batch[-1]
+    return batch, None
+
+
 def get_metric_value(metric_dict: dict, metric_name: str) -> float:
     """Safely retrieves value of the metric logged in LightningModule."""
 
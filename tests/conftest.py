@@ -0,0 +1,4 @@
+import pyrootutils
+
+# makes `src` importable when pytest is run from any directory of the project
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
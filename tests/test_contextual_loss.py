@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from src.benchmarks.contextual_loss import LoopContextual_Loss
+from src.losses.contextual_loss import Contextual_Loss, Distance_Type
+
+
+def cx_loss_and_grads(loss, feats):
+    feats = [feat.clone().requires_grad_() for feat in feats]
+    value = loss.calculate_CX_Loss(*feats)
+    value.backward()
+    return [value] + [feat.grad for feat in feats]
+
+
+@pytest.mark.parametrize(
+    "distance_type", [Distance_Type.Cosine_Distance, Distance_Type.L2_Distance, Distance_Type.L1_Distance]
+)
+@pytest.mark.parametrize("chunk_size", [None, 16, 24])
+def test_cx_loss_matches_per_sample_distances(distance_type, chunk_size):
+    generator = torch.Generator().manual_seed(0)
+    feats = [torch.randn(2, 16, 8, 8, generator=generator) for _ in range(2)]
+    # feature_extractor is only stored, so no VGG is built
+    kwargs = dict(layers_weights={}, distance_type=distance_type, feature_extractor=torch.nn.Identity())
+
+    expected = cx_loss_and_grads(LoopContextual_Loss(**kwargs), feats)
+    actual = cx_loss_and_grads(Contextual_Loss(chunk_size=chunk_size, **kwargs), feats)
+    for a, e in zip(actual, expected):
+        torch.testing.assert_close(a, e, rtol=1e-4, atol=1e-6)
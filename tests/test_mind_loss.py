@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from src.benchmarks.mind_loss import LoopMINDLoss, loop_mind
+from src.losses.mind_loss import MINDLoss, mind
+
+
+@pytest.mark.parametrize("size", [(32, 32), (40, 28)])
+def test_mind_matches_per_shift_loop(size):
+    image = torch.rand(2, 1, *size, generator=torch.Generator().manual_seed(0))
+    expected = loop_mind(image, neigh_size=9, patch_size=7)
+    torch.testing.assert_close(mind(image, neigh_size=9, patch_size=7), expected, rtol=1e-4, atol=1e-7)
+
+
+def test_mind_loss_matches_per_shift_loop():
+    generator = torch.Generator().manual_seed(0)
+    pred = torch.rand(2, 1, 32, 32, generator=generator)
+    gt = torch.rand(2, 1, 32, 32, generator=generator)
+
+    results = []
+    for loss in (LoopMINDLoss(), MINDLoss(neigh_size=9, patch_size=7)):
+        pred_leaf = pred.clone().requires_grad_()
+        value = loss(pred_leaf, gt)
+        value.backward()
+        results.append((value, pred_leaf.grad))
+
+    for expected, actual in zip(*results):
+        torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-7)
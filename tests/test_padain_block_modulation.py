@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+pytest.importorskip("mmcv")  # network_PAdaIN_synthesis imports mmcv's upfirdn2d
+
+from src.models.components.network_PAdaIN_synthesis import PAdaINSynthesisModule, StyleConv, block_taps
+
+
+@pytest.mark.parametrize("size", [(96, 80), (48, 40), (100, 76), (17, 13)])
+def test_block_modulation_matches_per_pixel(size):
+    torch.manual_seed(0)
+    conv = StyleConv(8, 16, kernel_size=3)
+    style = torch.randn(2, 1, 6, 5)
+
+    conv.block_modulation = False
+    expected = conv.modulation(style, size)
+    conv.block_modulation = True
+    actual = conv.modulation(style, size)
+    for a, e in zip(actual, expected):
+        torch.testing.assert_close(a, e, rtol=1e-5, atol=1e-6)
+
+
+def test_block_taps_cached_per_device():
+    taps = block_taps((96, 80), (6, 5), torch.device("cpu"))
+    assert taps is block_taps((96, 80), (6, 5), torch.device("cpu"))
+    assert all(t.device.type == "cpu" for t in taps)
+    # no fewer neighbourhoods than pixels: the per-pixel path is used
+    assert block_taps((12, 10), (6, 5), torch.device("cpu")) is None
+
+
+def test_network_output_matches_per_pixel():
+    torch.manual_seed(0)
+    net = PAdaINSynthesisModule(input_nc=1, feat_ch=16, output_nc=1, demodulate=True).eval()
+    x, ref = torch.rand(2, 1, 1, 64, 48) * 2 - 1
+
+    outputs = []
+    for block_modulation in (False, True):
+        for module in net.modules():
+            if isinstance(module, StyleConv):
+                module.block_modulation = block_modulation
+                module.randomize_noise = False
+        with torch.no_grad():
+            outputs.append(net(x, ref))
+    torch.testing.assert_close(outputs[1], outputs[0], rtol=1e-5, atol=1e-6)